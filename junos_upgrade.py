@@ -5,13 +5,18 @@
     John Tishey - 2018
 """
 
-import os, sys, logging, time
+import os, sys, re, logging, time, threading, hashlib, shutil, fcntl, copy, queue, socket, heapq, functools, ipaddress
 from jnpr.junos import Device
 from jnpr.junos.utils.scp import SCP
 from jnpr.junos.utils.config import Config
-from jnpr.junos.exception import ConnectError, CommitError
+from jnpr.junos.exception import ConnectError, CommitError, RpcError, RpcTimeoutError
 from netmiko import ConnectHandler
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+from urllib.error import HTTPError
+from urllib.request import Request, urlopen
 from ltoken import ltoken
 from lxml import etree
 import xmltodict
@@ -20,11 +25,737 @@ import json
 import yaml
 
 
+# Post-reboot health checks, registered with the @health_check decorator.
+# A check is called as func(upgrade) and returns (ok, msg) where ok is:
+#   True  - check passed
+#   None  - not ready yet, retry until HEALTH_CHECK_TIMEOUT
+#   False - check failed, retrying will not help
+# An optional baseline func(upgrade) is run before the upgrade and its result
+# is stored in upgrade.baseline[name] for the check to compare against.
+HEALTH_CHECKS = {}
+DEFAULT_HEALTH_CHECKS = ['re_status', 'core_dumps', 'fpc_pic',
+                         'alarms', 'interfaces', 'adjacencies']
+
+# Install phases reported while streaming package add output, first match wins
+INSTALL_PHASES = [(r'(?i)\berror\b|failed|aborted|abort(ing)? ', 'failed'),
+                  (r'(?i)reboot is required|install(ation)? completed?', 'complete'),
+                  (r'(?i)installing|adding|saving state|mounting', 'installing'),
+                  (r'(?i)extracting|unpacking|copying', 'extracting'),
+                  (r'(?i)verif|validat|checking', 'validating')]
+
+# Automated rollback paths, tried in this order (see RunUpgrade.rollback)
+#   software_rollback - request system software rollback, back to the previous package set
+#   alternate_media   - boot the pre-upgrade snapshot from the alternate media / slice
+#   reinstall         - add the previous image again from the image store / CODE_FOLDER
+ROLLBACK_METHODS = ['software_rollback', 'alternate_media', 'reinstall']
+# request-reboot options to boot the snapshot
+ROLLBACK_ALTERNATE_BOOT = {'slice': 'alternate', 'media': 'internal'}
+
+
+def health_check(name, blocking=True, baseline=None):
+    """ Decorator to register a post-reboot health check """
+    def register(func):
+        HEALTH_CHECKS[name] = {'func': func, 'blocking': blocking, 'baseline': baseline}
+        return func
+    return register
+
+
+def _text(elem, tag):
+    """ findtext() with the whitespace Junos wraps around values stripped """
+    return (elem.findtext(tag) or '').strip()
+
+
+def _core_files(up):
+    """ Set of core dump files on the active RE """
+    rsp = up.dev.rpc.get_system_core_dumps()
+    return set(_text(f, 'file-name') for f in rsp.iter('file-information'))
+
+
+def _fpc_pic_online(up):
+    """ Set of FPCs / PICs in the Online state """
+    online = set()
+    for fpc in up.dev.rpc.get_fpc_information().iter('fpc'):
+        if _text(fpc, 'state') == 'Online':
+            online.add('FPC ' + _text(fpc, 'slot'))
+    try:
+        for fpc in up.dev.rpc.get_pic_information().iter('fpc'):
+            for pic in fpc.iter('pic'):
+                if _text(pic, 'pic-state') == 'Online':
+                    online.add('PIC {0}/{1}'.format(_text(fpc, 'slot'), _text(pic, 'pic-slot')))
+    except RpcError:
+        # Not every platform has "show chassis fpc pic-status"
+        pass
+    return online
+
+
+def _major_alarms(up):
+    """ Set of active major chassis / system alarms """
+    alarms = set()
+    for rpc in [up.dev.rpc.get_alarm_information, up.dev.rpc.get_system_alarm_information]:
+        try:
+            for alarm in rpc().iter('alarm-detail'):
+                if _text(alarm, 'alarm-class') == 'Major':
+                    alarms.add(_text(alarm, 'alarm-description'))
+        except RpcError:
+            pass
+    return alarms
+
+
+def _interfaces_up(up):
+    """ Set of physical interfaces that are admin and oper up """
+    ifaces = set()
+    rsp = up.dev.rpc.get_interface_information(terse=True)
+    for ifd in rsp.iter('physical-interface'):
+        if _text(ifd, 'admin-status') == 'up' and _text(ifd, 'oper-status') == 'up':
+            ifaces.add(_text(ifd, 'name'))
+    return ifaces
+
+
+def _adjacencies(up):
+    """ Set of established IS-IS / OSPF / BGP adjacencies """
+    adj = set()
+    checks = [(up.dev.rpc.get_isis_adjacency_information, 'isis-adjacency',
+               'interface-name', 'adjacency-state', 'Up', 'ISIS'),
+              (up.dev.rpc.get_ospf_neighbor_information, 'ospf-neighbor',
+               'neighbor-address', 'ospf-neighbor-state', 'Full', 'OSPF'),
+              (up.dev.rpc.get_bgp_summary_information, 'bgp-peer',
+               'peer-address', 'peer-state', 'Established', 'BGP')]
+    for rpc, tag, key, state, good, proto in checks:
+        try:
+            for item in rpc().iter(tag):
+                if _text(item, state) == good:
+                    adj.add(proto + ' ' + _text(item, key))
+        except RpcError:
+            # Protocol not configured / running
+            pass
+    return adj
+
+
+@health_check('re_status')
+def check_re_status(up):
+    """ Every present routing-engine reports status OK """
+    rsp = up.dev.rpc.get_route_engine_information()
+    for eng in rsp.iter('route-engine'):
+        if _text(eng, 'mastership-state') in ['master', 'backup'] and _text(eng, 'status') != 'OK':
+            return None, 'RE{0} status is {1}'.format(_text(eng, 'slot'), _text(eng, 'status'))
+    return True, 'Routing-engines OK'
+
+
+@health_check('core_dumps', baseline=_core_files)
+def check_core_dumps(up):
+    """ No new core dumps since the upgrade started """
+    new = _core_files(up) - up.baseline.get('core_dumps', set())
+    if new:
+        return False, 'Found Core Dumps: ' + ', '.join(sorted(new))
+    return True, 'No new core dumps'
+
+
+@health_check('fpc_pic', baseline=_fpc_pic_online)
+def check_fpc_pic(up):
+    """ Every FPC / PIC that was online before the upgrade is online again """
+    missing = up.baseline.get('fpc_pic', set()) - _fpc_pic_online(up)
+    if missing:
+        return None, 'Waiting on ' + ', '.join(sorted(missing))
+    return True, 'FPCs / PICs online'
+
+
+@health_check('alarms', blocking=False, baseline=_major_alarms)
+def check_alarms(up):
+    """ No new major alarms """
+    new = _major_alarms(up) - up.baseline.get('alarms', set())
+    if new:
+        return None, 'New major alarms: ' + ', '.join(sorted(new))
+    return True, 'No new major alarms'
+
+
+@health_check('interfaces', blocking=False, baseline=_interfaces_up)
+def check_interfaces(up):
+    """ Every interface that was up before the upgrade is up again """
+    down = up.baseline.get('interfaces', set()) - _interfaces_up(up)
+    if down:
+        return None, 'Interfaces down: ' + ', '.join(sorted(down))
+    return True, 'Interfaces up'
+
+
+@health_check('adjacencies', blocking=False, baseline=_adjacencies)
+def check_adjacencies(up):
+    """ Every protocol adjacency that was up before the upgrade is up again """
+    missing = up.baseline.get('adjacencies', set()) - _adjacencies(up)
+    if missing:
+        return None, 'Adjacencies down: ' + ', '.join(sorted(missing))
+    return True, 'Adjacencies up'
+
+
+@functools.total_ordering
+class JunosVersion(object):
+    """ Parsed Junos version, e.g. 9.3R4.4, 12.3R12-S15, 14.1X53-D47.6, 16.1R6-S1.1
+        major.minor, release type (R mainline, X special train, F feature, B beta, I internal)
+        and number, then the optional -D build (X trains), -S service release and respin.
+        An X train branches off the major.minor mainline, it sorts below every R release of it
+        (14.1X53-D47 < 14.1R9 < 15.1R1)
+    """
+    PATTERN = r'(\d+)\.(\d+)([RXFBI])(\d+)(?:-D(\d+))?(?:-S(\d+))?(?:\.(\d+))?'
+    TYPES = {'I': 0, 'B': 1, 'X': 2, 'R': 3, 'F': 4}
+
+    def __init__(self, version):
+        found = re.match(self.PATTERN + '$', str(version).strip())
+        if not found:
+            raise ValueError('Unable to parse Junos version "{0}"'.format(version))
+        self.version = found.group(0)
+        major, minor, self.type, num, d, s, respin = found.groups()
+        self.major, self.minor, self.num = int(major), int(minor), int(num)
+        self.build, self.service, self.respin = int(d or 0), int(s or 0), int(respin or 0)
+
+    @classmethod
+    def from_image(cls, name):
+        """ Version in an image file name, None if there isn't one """
+        found = re.search(r'(?<![\w.])' + cls.PATTERN + r'(?=[-_]|\.tgz$)', name)
+        return cls(found.group(0)) if found else None
+
+    def key(self):
+        return (self.major, self.minor, self.TYPES[self.type], self.num,
+                self.build, self.service, self.respin)
+
+    def same_release(self, other):
+        """ Same release apart from the respin (16.1R6-S1 and 16.1R6-S1.1) """
+        return self.key()[:-1] == other.key()[:-1]
+
+    def __eq__(self, other):
+        return isinstance(other, JunosVersion) and self.key() == other.key()
+
+    def __lt__(self, other):
+        return self.key() < other.key()
+
+    def __hash__(self):
+        return hash(self.key())
+
+    def __str__(self):
+        return self.version
+
+    __repr__ = __str__
+
+
+def plan_upgrade_path(current, target, catalog, max_hop=3, preferred=()):
+    """ Shortest chain of supported direct upgrades from current to target through the catalog
+        versions.  A direct upgrade goes forward at most max_hop major releases, every hop is one
+        package add and one reboot.  Ties go to the preferred (configured) images, then the newest.
+        Returns the versions to install in order ([] if already there), None if there is no path
+    """
+    if current == target:
+        return []
+    if target < current:
+        # Downgrade, straight to the target
+        return [target]
+    steps = [v for v in catalog if current < v <= target]
+    # (reboots, package adds, other than preferred, newest first), tie counter, version, path
+    heap = [((0, 0, 0), 0, current, [])]
+    best = {current: (0, 0, 0)}
+    seq = 0
+    while heap:
+        cost, _, version, path = heapq.heappop(heap)
+        if version == target:
+            return path
+        if best.get(version, cost) < cost:
+            continue
+        for nxt in sorted(steps, reverse=True):
+            if not version < nxt or nxt.major - version.major > max_hop:
+                continue
+            new = (cost[0] + 1, cost[1] + 1, cost[2] + (nxt not in preferred))
+            if nxt not in best or new < best[nxt]:
+                best[nxt] = new
+                seq += 1
+                heapq.heappush(heap, (new, seq, nxt, path + [nxt]))
+    return None
+
+
+class ThreadFilter(logging.Filter):
+    """ Only pass records logged by one thread, used to give each device its own
+        log file when several devices are upgraded at once
+    """
+    def __init__(self, thread_name):
+        logging.Filter.__init__(self)
+        self.thread_name = thread_name
+
+    def filter(self, record):
+        return record.threadName == self.thread_name
+
+
+class ImageStore(object):
+    """ Content-addressed image store on the upgrade server
+        Images are kept once under objects/<sha256[:2]>/<sha256>, index.json maps the
+        catalog names (aliases) to hashes and tracks size / last use for LRU eviction.
+        Safe to share between threads and between several copies of this script.
+        Objects held by a device in this process (see resolve) are never evicted.
+    """
+    def __init__(self, root, quota=0):
+        self.root = root
+        self.quota = quota
+        self.index_file = os.path.join(root, 'index.json')
+        self.lock = threading.Lock()
+        # Objects already hashed by this process
+        self.verified = set()
+        # {sha: number of devices in this process using the object}
+        self.holds = {}
+        os.makedirs(os.path.join(root, 'objects'), exist_ok=True)
+
+    def acquire(self):
+        """ Lock the store against other threads and processes, returns the index """
+        self.lock.acquire()
+        self.lock_file = open(os.path.join(self.root, '.lock'), 'w')
+        fcntl.flock(self.lock_file, fcntl.LOCK_EX)
+        try:
+            with open(self.index_file) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return {'aliases': {}, 'objects': {}}
+
+    def release(self, index=None):
+        """ Save the index (if given) and unlock the store """
+        try:
+            if index is not None:
+                with open(self.index_file + '.tmp', 'w') as f:
+                    json.dump(index, f, indent=2, sort_keys=True)
+                os.replace(self.index_file + '.tmp', self.index_file)
+        finally:
+            fcntl.flock(self.lock_file, fcntl.LOCK_UN)
+            self.lock_file.close()
+            self.lock.release()
+
+    def object_path(self, sha):
+        return os.path.join(self.root, 'objects', sha[:2], sha)
+
+    def sha256(self, path):
+        """ SHA-256 of a local file """
+        h = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                h.update(chunk)
+        return h.hexdigest()
+
+    def add(self, path, name):
+        """ Add a file to the store under the alias name, identical images are only kept once """
+        sha = self.sha256(path)
+        index = self.acquire()
+        try:
+            obj = self.object_path(sha)
+            if sha not in index['objects'] or not os.path.isfile(obj):
+                os.makedirs(os.path.dirname(obj), exist_ok=True)
+                try:
+                    # Same filesystem - no need to copy multi-GB images
+                    os.link(path, obj + '.tmp')
+                except OSError:
+                    shutil.copyfile(path, obj + '.tmp')
+                os.replace(obj + '.tmp', obj)
+                index['objects'][sha] = {'size': os.path.getsize(obj), 'names': []}
+            if name not in index['objects'][sha]['names']:
+                index['objects'][sha]['names'].append(name)
+            index['objects'][sha]['last_used'] = time.time()
+            index['aliases'][name] = sha
+            self.verified.add(sha)
+        finally:
+            self.release(index)
+        return sha
+
+    def resolve(self, name, hold=False):
+        """ Local path for an alias after checking its integrity, None if missing or corrupt.
+            With hold the object is kept from eviction until unhold(sha)
+        """
+        index = self.acquire()
+        try:
+            sha = index['aliases'].get(name)
+            obj = self.object_path(sha) if sha else ''
+            if not sha or not os.path.isfile(obj):
+                return None
+            index['objects'][sha]['last_used'] = time.time()
+            if hold:
+                self.holds[sha] = self.holds.get(sha, 0) + 1
+        finally:
+            self.release(index)
+        if sha not in self.verified:
+            if self.sha256(obj) != sha:
+                logging.warn('ERROR: Image {0} is corrupt in the image store, removing it'.format(name))
+                if hold:
+                    self.unhold(sha)
+                self.remove(sha)
+                return None
+            self.verified.add(sha)
+        return obj
+
+    def unhold(self, sha):
+        """ Drop a hold taken by resolve """
+        with self.lock:
+            self.holds[sha] = self.holds.get(sha, 0) - 1
+            if self.holds[sha] <= 0:
+                del self.holds[sha]
+
+    def names(self):
+        """ Every alias in the store """
+        index = self.acquire()
+        try:
+            return sorted(index['aliases'])
+        finally:
+            self.release()
+
+    def remove(self, sha):
+        """ Drop an object and every alias pointing at it """
+        index = self.acquire()
+        try:
+            for name in index['objects'].pop(sha, {}).get('names', []):
+                index['aliases'].pop(name, None)
+            if os.path.isfile(self.object_path(sha)):
+                os.remove(self.object_path(sha))
+            self.verified.discard(sha)
+        finally:
+            self.release(index)
+
+    def disk_usage(self, sha, size):
+        """ Bytes an object takes on disk, 0 if it is hard linked to a file outside the store """
+        try:
+            return size if os.stat(self.object_path(sha)).st_nlink == 1 else 0
+        except OSError:
+            return 0
+
+    def evict(self, pinned=()):
+        """ Remove least recently used images until the store fits in the quota,
+            images with a pinned alias or held by a device are never removed
+        """
+        if not self.quota:
+            return
+        index = self.acquire()
+        try:
+            objects = index['objects']
+            usage = dict((sha, self.disk_usage(sha, o['size'])) for sha, o in objects.items())
+            used = sum(usage.values())
+            lru = sorted(objects, key=lambda sha: objects[sha].get('last_used', 0))
+            for sha in lru:
+                if used <= self.quota:
+                    break
+                # Removing a hard linked object frees nothing
+                if set(objects[sha]['names']) & set(pinned) or sha in self.holds or not usage[sha]:
+                    continue
+                logging.warn('Evicting {0} from the image store...'.format(', '.join(objects[sha]['names'])))
+                used -= usage[sha]
+                for name in objects.pop(sha)['names']:
+                    index['aliases'].pop(name, None)
+                if os.path.isfile(self.object_path(sha)):
+                    os.remove(self.object_path(sha))
+                self.verified.discard(sha)
+        finally:
+            self.release(index)
+
+
+class TokenBucket(object):
+    """ Token bucket for transfer shaping, rate in bytes per second """
+    def __init__(self, rate):
+        self.rate = float(rate)
+        self.burst = max(self.rate / 2, 256 * 1024)
+        self.tokens = self.burst
+        self.stamp = time.time()
+
+    def refill(self):
+        now = time.time()
+        self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+
+    def ready(self, nbytes):
+        # Chunks bigger than the burst go through on a full bucket and leave it in debt
+        return self.tokens >= min(nbytes, self.burst)
+
+
+class TransferScheduler(object):
+    """ Shape concurrent image transfers to a global bandwidth budget and per-site budgets.
+        Transfers waiting for bandwidth are served lowest priority number first (the daemon
+        job priority, rollout and coordinator devices are all 0), transfers with the same
+        priority share the bandwidth equally (start time fair queuing, a new transfer does not catch up on the
+        bytes the others already sent).
+        Actual and allowed throughput are logged every TRANSFER_REPORT_INTERVAL seconds.
+    """
+    def __init__(self, rate=0, site_rates=None, interval=30):
+        self.bucket = TokenBucket(rate) if rate else None
+        self.site_rates = site_rates or {}
+        self.sites = {}
+        self.transfers = []
+        self.vclock = 0
+        self.interval = interval
+        self.cond = threading.Condition()
+        self.reporter = None
+
+    def site_bucket(self, site):
+        if site not in self.sites:
+            rate = self.site_rates.get(site)
+            self.sites[site] = TokenBucket(rate) if rate else None
+        return self.sites[site]
+
+    def start(self, name, size, site='', priority=0):
+        """ Register a new transfer """
+        with self.cond:
+            t = {'name': name, 'site': site, 'priority': priority, 'size': size, 'sent': 0,
+                 'waiting': 0, 'finish': self.vclock, 'rate': 0.0, 'started': time.time(), 'reported': (time.time(), 0)}
+            self.site_bucket(site)
+            self.transfers.append(t)
+            if self.reporter is None:
+                self.reporter = threading.Thread(target=self.report, name='transfers', daemon=True)
+                self.reporter.start()
+        return t
+
+    def finish(self, t):
+        with self.cond:
+            if t in self.transfers:
+                self.transfers.remove(t)
+            self.cond.notify_all()
+
+    def consume(self, t, nbytes):
+        """ Block until the transfer may send nbytes more """
+        if nbytes <= 0:
+            return
+        with self.cond:
+            t['waiting'] = nbytes
+            while True:
+                for bucket in [self.bucket] + list(self.sites.values()):
+                    if bucket:
+                        bucket.refill()
+                # Transfers whose site has bandwidth left compete for the global budget
+                ready = [x for x in self.transfers if x['waiting'] and
+                         (not self.sites[x['site']] or self.sites[x['site']].ready(x['waiting']))]
+                ready.sort(key=lambda x: (x['priority'], max(x['finish'], self.vclock)))
+                if ready and ready[0] is t and (not self.bucket or self.bucket.ready(nbytes)):
+                    break
+                self.cond.wait(0.05)
+            for bucket in [self.bucket, self.sites[t['site']]]:
+                if bucket:
+                    bucket.tokens -= nbytes
+            t['waiting'] = 0
+            t['sent'] += nbytes
+            self.vclock = max(t['finish'], self.vclock)
+            t['finish'] = self.vclock + nbytes
+            self.cond.notify_all()
+
+    def shape(self, client, t):
+        """ Throttle an SCPClient through the progress callback it makes after every chunk """
+        progress = client._progress
+
+        def shaped(filename, size, sent, *args):
+            self.consume(t, sent - t['sent'])
+            if progress:
+                progress(filename, size, sent, *args)
+        client._progress = shaped
+
+    @staticmethod
+    def shares(rate, transfers):
+        """ Split a budget the way consume serves it: strict priority between priorities,
+            equal shares within one, what a priority does not use goes to the next
+        """
+        shares = {}
+        left = rate
+        for priority in sorted(set(t['priority'] for t in transfers)):
+            group = [t for t in transfers if t['priority'] == priority]
+            for t in group:
+                shares[id(t)] = left / len(group)
+            left = max(left - sum(min(t['rate'], left / len(group)) for t in group), 0)
+        return shares
+
+    def allowed(self, t):
+        """ Share of the budgets a transfer gets in bytes per second, None if unlimited """
+        shares = []
+        if self.bucket:
+            shares.append(self.shares(self.bucket.rate, self.transfers)[id(t)])
+        if self.sites.get(t['site']):
+            same_site = [x for x in self.transfers if x['site'] == t['site']]
+            shares.append(self.shares(self.sites[t['site']].rate, same_site)[id(t)])
+        return min(shares) if shares else None
+
+    def status(self):
+        """ Transfers in progress with their actual and allowed throughput in Mbps """
+        mbps = lambda rate: round(rate * 8 / 1000000, 1) if rate is not None else None
+        with self.cond:
+            return {'budget_mbps': mbps(self.bucket.rate) if self.bucket else None,
+                    'actual_mbps': mbps(sum(t['rate'] for t in self.transfers)),
+                    'transfers': [{'name': t['name'], 'site': t['site'], 'priority': t['priority'],
+                                   'sent': t['sent'], 'size': t['size'], 'actual_mbps': mbps(t['rate']),
+                                   'allowed_mbps': mbps(self.allowed(t))} for t in self.transfers]}
+
+    def report(self):
+        """ Update the measured rates and log them while transfers are running """
+        while True:
+            time.sleep(self.interval)
+            with self.cond:
+                now = time.time()
+                for t in self.transfers:
+                    stamp, sent = t['reported']
+                    t['rate'] = (t['sent'] - sent) / max(now - stamp, 0.001)
+                    t['reported'] = (now, t['sent'])
+            status = self.status()
+            if not status['transfers']:
+                continue
+            logging.warn('Transfers: {0} active, {1} Mbps of {2} Mbps budget'.format(
+                         len(status['transfers']), status['actual_mbps'], status['budget_mbps'] or 'unlimited'))
+            for t in status['transfers']:
+                logging.warn('  {0}: {1} Mbps (allowed {2}), {3}%'.format(
+                             t['name'], t['actual_mbps'], t['allowed_mbps'] or 'unlimited',
+                             t['sent'] * 100 // max(t['size'], 1)))
+
+
+# One TransferScheduler per process, shared by every device
+TRANSFER_SCHEDULER = []
+TRANSFER_SCHEDULER_LOCK = threading.Lock()
+
+
+def transfer_scheduler(config):
+    """ Get the shared TransferScheduler, created from the first config that asks for it """
+    with TRANSFER_SCHEDULER_LOCK:
+        if not TRANSFER_SCHEDULER:
+            to_bytes = lambda mbps: float(mbps or 0) * 1000000 / 8
+            sites = dict((site, to_bytes(mbps)) for site, mbps in
+                         (config.get('TRANSFER_SITE_MBPS') or {}).items())
+            TRANSFER_SCHEDULER.append(TransferScheduler(to_bytes(config.get('TRANSFER_BUDGET_MBPS')),
+                                                        sites, config.get('TRANSFER_REPORT_INTERVAL', 30)))
+        return TRANSFER_SCHEDULER[0]
+
+
+class ImageRequestHandler(BaseHTTPRequestHandler):
+    """ Serves registered downloads to the devices, GET / HEAD with single byte ranges """
+    def log_message(self, fmt, *args):
+        pass
+
+    def do_HEAD(self):
+        self.send_image(head=True)
+
+    def do_GET(self):
+        self.send_image()
+
+    def send_image(self, head=False):
+        images = self.server.images
+        download = images.lookup(self.path)
+        if not download:
+            return self.send_error(404)
+        size = os.path.getsize(download['path'])
+        start, end, code = 0, size - 1, 200
+        if self.headers.get('Range'):
+            found = re.match(r'bytes=(\d*)-(\d*)$', self.headers['Range'].strip())
+            if found and found.group(1):
+                start = int(found.group(1))
+                end = min(int(found.group(2)), size - 1) if found.group(2) else size - 1
+            elif found and found.group(2):
+                # Last n bytes
+                start = max(size - int(found.group(2)), 0)
+            if not found or not (found.group(1) or found.group(2)) or start > end:
+                self.send_response(416)
+                self.send_header('Content-Range', 'bytes */{0}'.format(size))
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            code = 206
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('Content-Length', str(end - start + 1))
+        self.send_header('Accept-Ranges', 'bytes')
+        if code == 206:
+            self.send_header('Content-Range', 'bytes {0}-{1}/{2}'.format(start, end, size))
+        self.end_headers()
+        if head:
+            return
+        remaining = end - start + 1
+        try:
+            with open(download['path'], 'rb') as f:
+                f.seek(start)
+                while remaining > 0:
+                    chunk = f.read(min(256 * 1024, remaining))
+                    if not chunk:
+                        break
+                    # Counts the bytes for the download progress and shapes them to the budgets
+                    images.scheduler.consume(download['transfer'], len(chunk))
+                    self.wfile.write(chunk)
+                    remaining -= len(chunk)
+        except (BrokenPipeError, ConnectionResetError):
+            # The device gave up, it reports the error on its side
+            pass
+
+
+class ImageServer(object):
+    """ Built-in HTTP server the devices pull images from in PULL_MODE, so every device
+        downloads in parallel instead of this host pushing each copy over SCP.
+        Only registered downloads are served, each under its own random token.
+    """
+    def __init__(self, listen, port, scheduler):
+        self.scheduler = scheduler
+        self.downloads = {}
+        # SHA-256 of served files, by (path, size, mtime)
+        self.hashes = {}
+        self.lock = threading.Lock()
+        self.httpd = ThreadingHTTPServer((listen, port), ImageRequestHandler)
+        self.httpd.images = self
+        self.port = self.httpd.server_address[1]
+        threading.Thread(target=self.httpd.serve_forever, name='image-server', daemon=True).start()
+        logging.warn('Serving images on http://{0}:{1}'.format(listen, self.port))
+
+    def register(self, path, name, transfer):
+        """ Serve a local file as name for one download, returns the URL path """
+        url = '/{0}/{1}'.format(os.urandom(12).hex(), name)
+        with self.lock:
+            self.downloads[url] = {'path': path, 'transfer': transfer}
+        return url
+
+    def unregister(self, url):
+        with self.lock:
+            self.downloads.pop(urlparse(url).path, None)
+
+    def lookup(self, url):
+        with self.lock:
+            return self.downloads.get(urlparse(url).path)
+
+    def checksum(self, path):
+        """ SHA-256 of a local file, image store objects are named after theirs """
+        name = os.path.basename(path)
+        if re.match(r'[0-9a-f]{64}$', name) and os.path.basename(os.path.dirname(path)) == name[:2]:
+            return name
+        stat = os.stat(path)
+        key = (path, stat.st_size, stat.st_mtime)
+        if key not in self.hashes:
+            h = hashlib.sha256()
+            with open(path, 'rb') as f:
+                for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                    h.update(chunk)
+            self.hashes[key] = h.hexdigest()
+        return self.hashes[key]
+
+
+# One ImageServer per process, started the first time a device pulls an image
+IMAGE_SERVER = []
+IMAGE_SERVER_LOCK = threading.Lock()
+
+
+def image_server(config):
+    """ Get the shared ImageServer, starting it on PULL_SERVER_LISTEN / PULL_SERVER_PORT """
+    with IMAGE_SERVER_LOCK:
+        if not IMAGE_SERVER:
+            IMAGE_SERVER.append(ImageServer(config.get('PULL_SERVER_LISTEN', '0.0.0.0'),
+                                            config.get('PULL_SERVER_PORT', 8702),
+                                            transfer_scheduler(config)))
+        return IMAGE_SERVER[0]
+
+
+# One ImageStore per directory, shared by every device in this process
+IMAGE_STORES = {}
+IMAGE_STORES_LOCK = threading.Lock()
+
+
+def image_store(root, quota=0):
+    """ Get the shared ImageStore for a directory """
+    with IMAGE_STORES_LOCK:
+        if root not in IMAGE_STORES:
+            IMAGE_STORES[root] = ImageStore(root, quota)
+        return IMAGE_STORES[root]
+
+
 class RunUpgrade(object):
-    def __init__(self):
+    def __init__(self, auth=None):
         self.arch = ''
         self.host = ''
-        self.auth = ltoken()
+        self.port = None
+        # Site (for per-site transfer budgets) and transfer priority, lower goes first
+        self.site = ''
+        self.priority = 0
+        self.auth = auth or ltoken()
         self.config = {}
         self.configfile = '/opt/ipeng/scripts/jtishey/junos_upgrade/config.yml'
         self.force = False
@@ -33,15 +764,59 @@ class RunUpgrade(object):
         self.set_enhanced_ip = False
         self.pim_nonstop = False
         self.two_stage = False
+        # Package adds for this device, worked out by plan_upgrade
+        self.plan = []
+        self.baseline = {}
+        self.health_ok = True
+        self.device_list = ''
+        self.daemon = False
+        self.coordinator = False
+        self.worker_url = ''
+        self.region = ''
+        self.log_handlers = []
+        # Local paths of the catalog images, resolved through the image store
+        self.images = {}
+        # (store, sha) of the image store objects in use
+        self.held_images = []
+        self.issu = False
+        self.nssu = False
+        # Virtual chassis members, empty unless the device is a multi-member VC
+        self.members = []
+        # Called with each install progress event (see install_progress)
+        self.progress_callbacks = []
+        # Success criteria, checked by the rollout controller
+        self.completed = False
+        self.core_dumps = False
+        self.version_match = False
+        # The JSU was skipped because it has to be installed by hand (-y)
+        self.jsu_skipped = False
+        # Pre-upgrade state of each RE for the automated rollback (see record_rollback_state)
+        self.pre_upgrade = {}
+        self.snapshots = {}
+        self.rolling_back = False
+        self.rolled_back = False
 
     def get_arguments(self):
         """ Handle input from CLI """
         p = argparse.ArgumentParser(
             description='Parse and compare before/after baseline files.',
             formatter_class=lambda prog: argparse.HelpFormatter(prog, max_help_position=32))
-        p.add_argument('-d', '--device', help='Specify an IP or hostname to upgrade',
-                       required=True, metavar='DEV')
+        devices = p.add_mutually_exclusive_group(required=True)
+        devices.add_argument('--daemon', action='count', default=0,
+                             help='Run as a service taking upgrade jobs over a local REST API (see DAEMON_*)')
+        devices.add_argument('-d', '--device', help='Specify an IP or hostname to upgrade',
+                             metavar='DEV')
+        devices.add_argument('-l', '--list', help='Upgrade every device in FILE in waves (see ROLLOUT_*)',
+                             metavar='FILE')
+        devices.add_argument('-w', '--worker', help='Run as a worker upgrading devices assigned by the coordinator at URL',
+                             metavar='URL')
+        p.add_argument('--coordinator', action='count', default=0,
+                       help='With -l, hand the devices out to workers by region instead of upgrading them here')
+        p.add_argument('-r', '--region', help='Region / site of this worker', default='')
         p.add_argument('-c', '--config', help='Specify an alternate config file', metavar='CFG')
+        p.add_argument('-p', '--port', help='NETCONF port, if not 830', type=int)
+        p.add_argument('-i', '--issu', action='count', default=0,
+                       help='Use ISSU on dual-RE devices that support it, falls back to a normal upgrade')
         p.add_argument('-f', '--force', action='count', default=0,
                        help='Use "force" option on all package adds (DANGER!)')
         p.add_argument('-n', '--noinstall', action='count', default=0,
@@ -49,13 +824,25 @@ class RunUpgrade(object):
         p.add_argument('-y', '--yes_all', action='count', default=0,
                        help='Answer "y" to all questions during the upgrade (DANGER!)')
         args = vars(p.parse_args())
-        self.host = args['device']
+        self.host = args['device'] or ''
+        self.device_list = args['list'] or ''
+        self.port = args['port']
+        self.worker_url = args['worker'] or ''
+        self.region = args['region']
+        if args['daemon']:
+            self.daemon = True
+        if args['coordinator']:
+            if not self.device_list:
+                p.error('--coordinator requires -l / --list')
+            self.coordinator = True
         if args['config']:
             self.configfile = args['config']
         if args['force']:
             self.force - True
         if args['noinstall']:
             self.no_install = True
+        if args['issu']:
+            self.issu = True
         if args['yes_all']:
             self.yes_all = True
 
@@ -63,26 +850,38 @@ class RunUpgrade(object):
     def initial_setup(self):
         """ Setup logging, load config and check for the images on the server """
         logfile = self.host + '_upgrade.log'
-        logging.basicConfig(filename=logfile, level=logging.WARN,
-                            format='%(asctime)s:%(name)s: %(message)s')
-        logging.getLogger().name = self.host
-        logging.getLogger().addHandler(logging.StreamHandler())
+        if threading.current_thread() is threading.main_thread():
+            logging.basicConfig(filename=logfile, level=logging.WARN,
+                                format='%(asctime)s:%(name)s: %(message)s')
+            logging.getLogger().name = self.host
+            logging.getLogger().addHandler(logging.StreamHandler())
+        else:
+            # Running several devices at once, one thread per device named after the host
+            handler = logging.FileHandler(logfile)
+            handler.setFormatter(logging.Formatter('%(asctime)s:%(threadName)s: %(message)s'))
+            handler.addFilter(ThreadFilter(threading.current_thread().name))
+            logging.getLogger().addHandler(handler)
+            self.log_handlers.append(handler)
         logging.warn('Information logged in {0}'.format(logfile))
 
-        # Open config file
-        try:
-            with open(self.configfile) as f:
-                self.config = yaml.load(f)
-        except:
-            logging.warn('ERROR: Issues opening config file "{0}"'.format(self.configfile))
-            exit(1)
+        # Open config file (unless the caller already loaded it)
+        if not self.config:
+            try:
+                with open(self.configfile) as f:
+                    self.config = yaml.load(f)
+            except:
+                logging.warn('ERROR: Issues opening config file "{0}"'.format(self.configfile))
+                exit(1)
 
         # verify needed packages exist on local server
+        store = self.get_image_store()
         for pkg in ['CODE_IMAGE32','CODE_IMAGE64',
                     'CODE_2STAGE32', 'CODE_2STAGE64',
                     'CODE_JSU32', 'CODE_JSU64']:
             if self.config[pkg]:
-                if not (os.path.isfile(self.config['CODE_FOLDER'] + self.config[pkg])):
+                if store:
+                    self.images[self.config[pkg]] = self.store_image(store, self.config[pkg])
+                if not os.path.isfile(self.local_image(self.config[pkg])):
                     msg = 'Software package does not exist locally: {0}'.format(
                            self.config['CODE_FOLDER'] + self.config[pkg])
                     logging.error(msg)
@@ -90,6 +889,52 @@ class RunUpgrade(object):
                         cont = self.input_parse('Continue? (n/n): ')
                         if cont == 'n':
                             exit()
+        if store:
+            store.evict(pinned=list(self.images) + (self.config.get('IMAGE_STORE_PINNED') or []))
+
+
+    def get_image_store(self):
+        """ The shared image store if IMAGE_STORE is set, otherwise None """
+        if not self.config.get('IMAGE_STORE'):
+            return None
+        return image_store(self.config['IMAGE_STORE'],
+                           int(self.config.get('IMAGE_STORE_QUOTA_GB', 0) * 1024 ** 3))
+
+
+    def store_image(self, store, name):
+        """ Resolve a catalog image through the image store, adding it from CODE_FOLDER
+            if it is not stored yet.  Returns the local path or '' if not found
+        """
+        path = store.resolve(name, hold=True)
+        if not path and os.path.isfile(self.config['CODE_FOLDER'] + name):
+            logging.warn('Adding {0} to the image store...'.format(name))
+            store.add(self.config['CODE_FOLDER'] + name, name)
+            path = store.resolve(name, hold=True)
+        if path:
+            # Held until end_script so other devices can't evict it
+            self.held_images.append((store, os.path.basename(path)))
+        return path or ''
+
+
+    def release_images(self):
+        """ Let the image store evict the images this device was using """
+        while self.held_images:
+            store, sha = self.held_images.pop()
+            store.unhold(sha)
+
+
+    def local_image(self, name):
+        """ Local path of a catalog image """
+        return self.images.get(name) or self.config['CODE_FOLDER'] + name
+
+
+    def new_device(self, gather_facts=False):
+        """ A new (unopened) NETCONF session to the device """
+        if self.port:
+            return Device(host=self.host, user=self.auth['username'], password=self.auth['password'],
+                          port=self.port, gather_facts=gather_facts)
+        return Device(host=self.host, user=self.auth['username'], password=self.auth['password'],
+                      gather_facts=gather_facts)
 
 
     def open_connection(self):
@@ -98,10 +943,7 @@ class RunUpgrade(object):
             logging.warn('Running with no_install option - copy files only...')
         try:
             logging.warn('Connecting to ' + self.host + '...')
-            self.dev = Device(host=self.host,
-                              user=self.auth['username'],
-                              password=self.auth['password'],
-                              gather_facts=True)
+            self.dev = self.new_device(gather_facts=True)
             self.dev.open()
         except ConnectError as e:
             logging.error('Cannot connect to device: {0}'.format(e))
@@ -147,27 +989,128 @@ class RunUpgrade(object):
 
 
     def copy_image(self, source, dest):
-        """ Copy files via SCP """
+        """ Copy files via SCP, or have the device pull them over HTTP in PULL_MODE """
         logging.warn("Image not found on active RE, copying now...")
+        # Shared with every other transfer in this process for bandwidth shaping
+        scheduler = transfer_scheduler(self.config)
+        transfer = None
         try:
+            transfer = scheduler.start(self.host + ':' + dest, os.path.getsize(source), self.site, self.priority)
+            if self.config.get('PULL_MODE') and self.pull_image(source, dest, transfer):
+                return
             with SCP(self.dev, progress=True) as scp:
+                scheduler.shape(scp, transfer)
                 logging.warn("Copying image to " + dest + "...")
                 scp.put(source, remote_path=dest)
         except Exception as e:
             logging.warn(str(e))
             self.end_script()
+        finally:
+            if transfer:
+                scheduler.finish(transfer)
+
+
+    def pull_address(self):
+        """ Address of the image server as seen from the device """
+        if self.config.get('PULL_SERVER_ADDRESS'):
+            return self.config['PULL_SERVER_ADDRESS']
+        # The local address this host uses to reach the device
+        s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            s.connect((self.host, self.port or 830))
+            return s.getsockname()[0]
+        finally:
+            s.close()
+
+
+    def pull_image(self, source, dest, transfer):
+        """ Have the device download an image from the built-in HTTP server ([file copy http://...])
+            and verify its SHA-256.  Returns False if the image should be pushed over SCP instead
+        """
+        try:
+            server = image_server(self.config)
+            address = self.pull_address()
+        except OSError as e:
+            logging.warn('Unable to serve the image over HTTP: {0}'.format(e))
+            return False
+        url = 'http://{0}:{1}{2}'.format(address, server.port,
+                                         server.register(source, os.path.basename(dest), transfer))
+        done = threading.Event()
+        monitor = threading.Thread(target=self.pull_monitor, args=(done, transfer, os.path.basename(dest)),
+                                   name=threading.current_thread().name)
+        monitor.start()
+        startTime = datetime.now()
+        self.dev.timeout = self.config.get('PULL_TIMEOUT', 3600)
+        ok = True
+        try:
+            logging.warn('Device downloading ' + url + ' to ' + dest + '...')
+            self.dev.rpc.file_copy(source=url, destination=dest)
+        except Exception as e:
+            self.install_progress('download', 'Download failed: {0}'.format(e))
+            ok = False
+        finally:
+            done.set()
+            monitor.join()
+            server.unregister(url)
+        self.dev.timeout = 120
+        if ok and not self.verify_checksum(source, dest):
+            ok = False
+        if not ok:
+            logging.warn('Falling back to copying the image via SCP...')
+            transfer['sent'] = 0
+            return False
+        self.install_progress('download', '{0} downloaded and verified in {1}'.format(
+                              os.path.basename(dest), str(datetime.now() - startTime).split('.')[0]))
+        return True
+
+
+    def pull_monitor(self, done, transfer, name):
+        """ Report the download progress counted by the image server every PULL_PROGRESS_INTERVAL """
+        interval = self.config.get('PULL_PROGRESS_INTERVAL', 30)
+        last, stamp = 0, time.time()
+        while not done.wait(interval):
+            sent, now = transfer['sent'], time.time()
+            self.install_progress('download', '{0}: {1}% ({2} Mbps)'.format(
+                                  name, min(sent * 100 // max(transfer['size'], 1), 100),
+                                  round((sent - last) * 8 / 1000000 / max(now - stamp, 0.001), 1)))
+            last, stamp = sent, now
+
+
+    def verify_checksum(self, source, dest):
+        """ Compare the SHA-256 of the image on the device with the local copy, a bad copy is deleted """
+        expected = image_server(self.config).checksum(source)
+        self.dev.timeout = 600
+        try:
+            rsp = self.dev.rpc.get_sha256_checksum_information(path=dest)
+            actual = _text(rsp, './/checksum')
+        except RpcError as e:
+            logging.warn('Unable to checksum {0}: {1}'.format(dest, e))
+            actual = ''
+        if actual == expected:
+            logging.warn('SHA-256 verified for ' + dest)
+            return True
+        logging.warn('ERROR: SHA-256 mismatch for {0}, expected {1} got {2}'.format(dest, expected, actual or 'nothing'))
+        try:
+            self.dev.rpc.file_delete(path=dest)
+        except RpcError:
+            pass
+        return False
+
+
+    def ssh_params(self):
+        """ netmiko connection parameters """
+        return {'device_type': 'juniper',
+                'ip': self.host,
+                'username': self.auth['username'],
+                'password': self.auth['password'],
+                'timeout': 3600}
 
 
     def copy_to_other_re(self, source, dest):
         """Use netmiko to copy files from one RE to the other because PyEZ doesnt allow this"""
         logging.warn("Image not found on backup RE, copying now...")
-        d = {'device_type': 'juniper',
-             'ip': self.host,
-             'username': self.auth['username'],
-             'password': self.auth['password'],
-             'timeout': 3600}
         try:
-            net_connect = ConnectHandler(**d)
+            net_connect = ConnectHandler(**self.ssh_params())
             net_connect.send_command("file copy " + source + " " + dest)
             net_connect.disconnect()
         except Exception as e:
@@ -213,114 +1156,233 @@ class RunUpgrade(object):
                 self.arch = '32-bit'
                 logging.warn("Using 32-bit Image...")
 
-        # Are we doing a two-stage upgrade? (Reqd for >3 major version change)
-        if self.config['CODE_2STAGE32'] or self.config['CODE_2STAGE64']:
-            if (int(self.config['CODE_NAME'][:2]) - int(self.dev.facts['version'][:2])) > 3:
-                logging.warn('Two-Stage Upgrade will be performed...')
-                self.two_stage = True
-        # Define all the file names / paths
-        if self.arch == '32-bit':
-            source = self.config['CODE_FOLDER'] + self.config['CODE_IMAGE32']
-            source_2stg = self.config['CODE_FOLDER'] + self.config['CODE_2STAGE32']
-            source_jsu = self.config['CODE_FOLDER'] + self.config['CODE_JSU32']
-            if self.two_stage:
-                dest = self.config['CODE_PRESERVE'] + self.config['CODE_2STAGE32']
-                dest_2stg = self.config['CODE_DEST'] + self.config['CODE_IMAGE32']
-                dest_jsu = self.config['CODE_PRESERVE'] + self.config['CODE_JSU32']
-            else:
-                dest = self.config['CODE_DEST'] + self.config['CODE_IMAGE32']
-                dest_jsu = self.config['CODE_DEST'] + self.config['CODE_JSU32']
-        elif self.arch == '64-bit':
-            source = self.config['CODE_FOLDER'] + self.config['CODE_IMAGE64']
-            source_2stg = self.config['CODE_FOLDER'] + self.config['CODE_2STAGE64']
-            source_jsu = self.config['CODE_FOLDER'] + self.config['CODE_JSU64']
-            if self.two_stage:
-                dest = self.config['CODE_PRESERVE'] + self.config['CODE_2STAGE64']
-                dest_2stg = self.config['CODE_DEST'] + self.config['CODE_IMAGE64']
-                dest_jsu = self.config['CODE_PRESERVE'] + self.config['CODE_JSU64']
-            else:
-                dest = self.config['CODE_DEST'] + self.config['CODE_IMAGE64']
-                dest_jsu = self.config['CODE_DEST'] + self.config['CODE_JSU64']
-
-        # Check for final software image on the device
-        logging.warn('Checking for image on the active RE...')
-        img = xmltodict.parse(etree.tostring(self.dev.rpc.file_list(path=dest)))
-        img_output = json.dumps(img)
-        if 'No such file' in img_output:
-            self.copy_image(source, dest)
-
-        # If dual RE - Check backup RE too
-        if self.dev.facts['2RE']:
-            if self.dev.facts['master'] == 'RE0':
-                active_RE = 're0:'
-                backup_RE = 're1:'
-            else:
-                active_RE = 're1:'
-                backup_RE = 're0:'
-            logging.warn('Checking for image on the backup RE...')
-            img = xmltodict.parse(etree.tostring(self.dev.rpc.file_list(path=backup_RE + dest)))
-            img_output = json.dumps(img)
-            if 'No such file' in img_output:
-                self.copy_to_other_re(active_RE + dest, backup_RE + dest)
-                img = xmltodict.parse(etree.tostring(self.dev.rpc.file_list(path=backup_RE + dest)))
-                img_output = json.dumps(img)
-                if 'No such file' in img_output:
-                    msg = 'file copy ' + dest + ' ' + backup_RE + dest
-                    logging.warn('ERROR: Copy the image to the backup RE, then re-run script')
-                    logging.warn('CMD  : ' + msg)
-                    self.end_script()
-
-        # If 2 stage upgrade, look for intermediate image
+        # Work out the package adds, more than one install is a multi-stage upgrade
+        self.plan = self.plan_upgrade()
+        self.two_stage = len([s for s in self.plan if not s['jsu']]) > 1
         if self.two_stage:
-            logging.warn('Checking for 2-stage image on the active RE...')
-            img = xmltodict.parse(etree.tostring(self.dev.rpc.file_list(path=dest_2stg)))
+            logging.warn('Multi-Stage Upgrade will be performed...')
+
+        # Virtual chassis backup members show up as a second RE, they are handled per member
+        dual_re = self.dev.facts['2RE'] and not self.members
+        if self.dev.facts['master'] == 'RE0':
+            active_RE = 're0:'
+            backup_RE = 're1:'
+        else:
+            active_RE = 're1:'
+            backup_RE = 're0:'
+
+        for step in self.plan:
+            source = self.local_image(step['image'])
+            dest = step['path'] + step['image']
+            # Check for the image on the device
+            logging.warn('Checking for {0} on the active RE...'.format(step['image']))
+            img = xmltodict.parse(etree.tostring(self.dev.rpc.file_list(path=dest)))
             img_output = json.dumps(img)
             if 'No such file' in img_output:
-                self.copy_image(source_2stg, dest_2stg)
+                self.copy_image(source, dest)
+            self.member_image_check(dest)
 
-            # Check for intermediate image file on backup RE
-            if self.dev.facts['2RE']:
-                logging.warn('Checking for 2-stage image on the backup RE...')
-                img = xmltodict.parse(etree.tostring(
-                                      self.dev.rpc.file_list(path=backup_RE + dest_2stg)))
+            # If dual RE - Check backup RE too
+            if dual_re:
+                logging.warn('Checking for {0} on the backup RE...'.format(step['image']))
+                img = xmltodict.parse(etree.tostring(self.dev.rpc.file_list(path=backup_RE + dest)))
                 img_output = json.dumps(img)
                 if 'No such file' in img_output:
-                    self.copy_to_other_re(active_RE + dest_2stg, backup_RE + dest_2stg)
-                    # Check again
-                    img = xmltodict.parse(etree.tostring(
-                                          self.dev.rpc.file_list(path=backup_RE + dest_2stg)))
+                    self.copy_to_other_re(active_RE + dest, backup_RE + dest)
+                    img = xmltodict.parse(etree.tostring(self.dev.rpc.file_list(path=backup_RE + dest)))
                     img_output = json.dumps(img)
                     if 'No such file' in img_output:
-                        msg = 'file copy ' + active_RE + dest_2stg + ' ' + backup_RE + dest_2stg
+                        msg = 'file copy ' + active_RE + dest + ' ' + backup_RE + dest
                         logging.warn('ERROR: Copy the image to the backup RE, then re-run script')
                         logging.warn('CMD  : ' + msg)
                         self.end_script()
 
-        # Check if JSU Install is requested (present in config.yml)
-        if self.config['CODE_JSU32'] or self.config['CODE_JSU64']:
-            # Check for the JSU on the active RE
-            logging.warn('Checking for JSU on the active RE...')
-            img = xmltodict.parse(etree.tostring(self.dev.rpc.file_list(path=dest_jsu)))
-            img_output = json.dumps(img)
-            if 'No such file' in img_output:
-                self.copy_image(source_jsu, dest_jsu)
 
-            # Check for the JSU on the backup RE
-            if self.dev.facts['2RE']:
-                logging.warn('Checking for JSU on the backup RE...')
-                img = xmltodict.parse(etree.tostring(
-                                      self.dev.rpc.file_list(path=backup_RE + dest_jsu)))
-                img_output = json.dumps(img)
-                if 'No such file' in img_output:
-                    self.copy_to_other_re(active_RE + dest_jsu, backup_RE + dest_jsu)
-                    img = xmltodict.parse(etree.tostring(
-                                          self.dev.rpc.file_list(path=backup_RE + dest_jsu)))
-                    img_output = json.dumps(img)
-                    if 'No such file' in img_output:
-                        msg = 'file copy ' + active_RE + dest_jsu + ' ' + backup_RE + dest_jsu
-                        logging.warn('ERROR: Copy the image to the backup RE, then re-run script')
-                        logging.warn('CMD  : ' + msg)
-                        self.end_script()
+    def image_platforms(self):
+        """ Image name prefixes (the part before the version) of this platform and arch: those of
+            the configured CODE_IMAGE / CODE_2STAGE images plus UPGRADE_PLATFORMS
+        """
+        suffix = '64' if self.arch == '64-bit' else '32'
+        platforms = list(self.config.get('UPGRADE_PLATFORMS') or [])
+        for key in ['CODE_IMAGE', 'CODE_2STAGE']:
+            name = self.config[key + suffix]
+            version = JunosVersion.from_image(name) if name else None
+            if version:
+                platforms.append(name.split(str(version))[0])
+        return platforms
+
+
+    def same_platform(self, name, version):
+        """ Is an image of version for this platform and arch? """
+        return name.split(str(version))[0] in self.image_platforms()
+
+
+    def upgrade_catalog(self):
+        """ {JunosVersion: image name} of the install images available for this arch, the
+            configured CODE_IMAGE / CODE_2STAGE images plus, when UPGRADE_CATALOG is set, any
+            others for the same platform in CODE_FOLDER and the image store
+        """
+        suffix = '64' if self.arch == '64-bit' else '32'
+        images = {}
+        for key, name_key in [('CODE_2STAGE', 'CODE_2STAGE_NAME'), ('CODE_IMAGE', 'CODE_NAME')]:
+            if self.config[key + suffix]:
+                images[self.config[key + suffix]] = self.config[name_key]
+        store = self.get_image_store()
+        if self.config.get('UPGRADE_CATALOG', False):
+            names = store.names() if store else []
+            if os.path.isdir(self.config['CODE_FOLDER']):
+                names += sorted(os.listdir(self.config['CODE_FOLDER']))
+            for name in names:
+                if name in images or 'jselective' in name or not name.endswith('.tgz'):
+                    continue
+                try:
+                    version = JunosVersion.from_image(name)
+                except ValueError:
+                    continue
+                if version and self.same_platform(name, version):
+                    images[name] = version
+        stored = store.names() if store else []
+        catalog = {}
+        for name, version in images.items():
+            if name not in stored and not os.path.isfile(self.local_image(name)):
+                continue
+            try:
+                catalog.setdefault(JunosVersion(version), name)
+            except ValueError as e:
+                logging.warn('Skipping {0}: {1}'.format(name, e))
+        return catalog
+
+
+    def plan_upgrade(self):
+        """ Work out the package adds for this device: the shortest path of direct upgrades
+            to CODE_NAME through the catalog, then the JSU if it is for the target release.
+            Each step is {'image', 'path', 'version', 'jsu'}
+        """
+        suffix = '64' if self.arch == '64-bit' else '32'
+        final = self.config['CODE_IMAGE' + suffix]
+        try:
+            current = JunosVersion(self.dev.facts['version'])
+            target = JunosVersion(self.config['CODE_NAME'])
+        except ValueError as e:
+            logging.warn('{0}, installing {1} directly'.format(e, final))
+            versions, catalog = [self.config['CODE_NAME']], {self.config['CODE_NAME']: final}
+        else:
+            catalog = self.upgrade_catalog()
+            catalog[target] = final
+            preferred = [v for v, name in catalog.items()
+                         if name in [final, self.config['CODE_2STAGE' + suffix]]]
+            versions = plan_upgrade_path(current, target, catalog,
+                                         self.config.get('UPGRADE_MAX_HOP', 3), preferred)
+            if versions is None:
+                logging.warn('ERROR: No upgrade path from {0} to {1} with the images in {2}'.format(
+                             current, target, self.config['CODE_FOLDER']))
+                self.end_script()
+            if len(versions) > 1 and not self.config['CODE_PRESERVE']:
+                logging.warn('ERROR: {0} needs {1} package adds, set CODE_PRESERVE to stage the images '
+                             'that must survive an install'.format(' -> '.join(str(v) for v in versions),
+                                                                   len(versions)))
+                self.end_script()
+        plan = []
+        for i, version in enumerate(versions):
+            # /var/tmp does not survive an install, stage everything but the final image in /var/preserve
+            path = self.config['CODE_DEST'] if i == len(versions) - 1 else self.config['CODE_PRESERVE']
+            plan.append({'image': catalog[version], 'path': path, 'version': version, 'jsu': False})
+
+        # JSU goes after the install of the release it is for
+        jsu = self.config['CODE_JSU' + suffix]
+        if jsu:
+            base = re.sub(r'-J\d+$', '', self.config['CODE_JSU_NAME'])
+            try:
+                for_target = JunosVersion(base).same_release(JunosVersion(self.config['CODE_NAME']))
+            except ValueError:
+                for_target = True
+            if for_target:
+                path = self.config['CODE_PRESERVE'] if len(versions) > 1 else self.config['CODE_DEST']
+                plan.append({'image': jsu, 'path': path, 'version': self.config['CODE_JSU_NAME'], 'jsu': True})
+            else:
+                logging.warn('JSU {0} is not for {1}, skipping it'.format(self.config['CODE_JSU_NAME'],
+                                                                          self.config['CODE_NAME']))
+
+        store = self.get_image_store()
+        for step in plan:
+            if store and step['image'] not in self.images:
+                self.images[step['image']] = self.store_image(store, step['image'])
+        logging.warn('Upgrade plan: {0} -> {1} ({2} package add{3})'.format(
+                     self.dev.facts['version'],
+                     ' -> '.join(('JSU ' if s['jsu'] else '') + str(s['version']) for s in plan) or 'nothing to install',
+                     len(plan), '' if len(plan) == 1 else 's'))
+        return plan
+
+
+    def install_needed(self, step, current, re_name=None):
+        """ Does a plan step still need installing on an RE running current? """
+        if step['jsu']:
+            # Only upgrade if the JSU is not already applied
+            if re_name:
+                sw = etree.tostring(self.dev.rpc.get_software_information(**{re_name.lower(): True}))
+            else:
+                sw = etree.tostring(self.dev.rpc.get_software_information())
+            if self.config['CODE_JSU_NAME'] in str(sw):
+                logging.warn('JSU appears to already be applied on {0}'.format(re_name or self.host))
+                return False
+            return True
+        # Not needed once the RE is on this step's version or one later in the plan
+        later = [str(s['version']) for s in self.plan[self.plan.index(step):] if not s['jsu']]
+        if len(later) == 1:
+            # The final image (which could be a downgrade)
+            return current != later[0]
+        try:
+            current = JunosVersion(current)
+            return current not in [JunosVersion(v) for v in later] and current < step['version']
+        except ValueError:
+            return current not in later
+
+
+    def vc_members(self):
+        """ Discover the present virtual chassis members, [] unless the device is a multi-member VC """
+        if not self.dev.facts.get('vc_capable'):
+            return []
+        try:
+            rsp = self.dev.rpc.get_virtual_chassis_information()
+        except RpcError:
+            return []
+        members = []
+        for m in rsp.iter('member'):
+            if _text(m, 'member-status') == 'Prsnt':
+                members.append({'id': _text(m, 'member-id'),
+                                'model': _text(m, 'model'),
+                                'role': _text(m, 'member-role').rstrip('*')})
+        if len(members) < 2:
+            return []
+        logging.warn('Virtual Chassis with {0} members:'.format(len(members)))
+        for m in members:
+            logging.warn('  Member {0}: {1:<10} {2}'.format(m['id'], m['role'], m['model']))
+        return members
+
+
+    def vc_master(self):
+        """ Member ID of the virtual chassis master """
+        for m in self.members:
+            if m['role'] == 'Master':
+                return m['id']
+        return '0'
+
+
+    def member_image_check(self, path):
+        """ Check for an image on every virtual chassis member, copy it from the master if needed """
+        master = self.vc_master()
+        for m in self.members:
+            if m['id'] == master:
+                continue
+            member = 'fpc' + m['id'] + ':'
+            logging.warn('Checking for image on member {0}...'.format(m['id']))
+            img = json.dumps(xmltodict.parse(etree.tostring(self.dev.rpc.file_list(path=member + path))))
+            if 'No such file' in img:
+                self.copy_to_other_re('fpc' + master + ':' + path, member + path)
+                img = json.dumps(xmltodict.parse(etree.tostring(self.dev.rpc.file_list(path=member + path))))
+                if 'No such file' in img:
+                    # Not fatal, the master pushes the package to members during the install
+                    logging.warn('WARNING: Image not on member {0}, it will be copied during the install'.format(m['id']))
 
 
     def system_snapshot(self):
@@ -332,6 +1394,7 @@ class RunUpgrade(object):
             err = self.recursive_search(snap, 'error')
             if err:                
                 logging.warn("Error taking snapshot... {0}".format(err['message']))
+            self.snapshots['RE0'] = not err
 
             if self.dev.facts['2RE']:
                 logging.warn('Requesting system snapshot on RE1...')
@@ -339,6 +1402,7 @@ class RunUpgrade(object):
                 err = self.recursive_search(snap, 'error')
                 if err:                
                     logging.warn("Error taking snapshot... {0}".format(err['message']))
+                self.snapshots['RE1'] = not err
         except Exception as e:
             logging.warn('ERROR: Problem with snapshots')
             logging.warn(str(e))
@@ -442,31 +1506,10 @@ class RunUpgrade(object):
         else:
             backup_RE = 'RE0'
 
-        # First Stage Upgrade
-        if self.two_stage:
-            # Only upgrade if the current version is not the 2stage, or final version:
-            if self.dev.facts['version_' + backup_RE] != self.config['CODE_2STAGE_NAME'] and \
-                    self.dev.facts['version_' + backup_RE] != self.config['CODE_NAME']:
-                # Perform the upgrade
-                self.backup_re_pkg_add(self.config['CODE_2STAGE32'], self.config['CODE_2STAGE64'], self.config['CODE_PRESERVE'])
-        # Second Stage Upgrade
-        # Only upgrade if the current version is not already the final version:
-        if self.dev.facts['version_' + backup_RE] != self.config['CODE_NAME']:
-            self.backup_re_pkg_add(self.config['CODE_IMAGE32'], self.config['CODE_IMAGE64'], self.config['CODE_DEST'])
-        # JSU Upgrade
-        # Only upgrade if the JSU is not already applied:
-        if self.config['CODE_JSU32'] or self.config['CODE_JSU64']:
-            if backup_RE == 'RE0':
-                current_version = etree.tostring(self.dev.rpc.get_software_information(re0=True))
-            else:
-                current_version = etree.tostring(self.dev.rpc.get_software_information(re1=True))
-            if self.config['CODE_JSU_NAME'] not in str(current_version):
-                if self.two_stage:
-                    self.backup_re_pkg_add(self.config['CODE_JSU32'], self.config['CODE_JSU64'], self.config['CODE_PRESERVE'])
-                else:
-                    self.backup_re_pkg_add(self.config['CODE_JSU32'], self.config['CODE_JSU64'], self.config['CODE_DEST'])
-            else:
-                logging.warn('JSU appears to already be applied on {0}'.format(backup_RE))
+        for step in self.plan:
+            # Only upgrade if the backup RE is not already on this (or a later) step
+            if self.install_needed(step, self.dev.facts['version_' + backup_RE], backup_RE):
+                self.backup_re_pkg_add(step['image'], step['image'], step['path'])
 
 
     def backup_re_pkg_add(self, PKG32, PKG64, R_PATH):
@@ -499,35 +1542,37 @@ class RunUpgrade(object):
         startTime = datetime.now()
         logging.warn('Installing ' + PACKAGE + ' on ' + backup_RE + '...')
         # Change flags for JSU vs JINSTALL Package:
+        ok = True
         if 'jselective' in PACKAGE:
-            # JSU installs are failing with RPC call
-            logging.warn("Unable to instsall the JSU remotely, please do it manually...")
-            logging.warn("CMD: request routing-engine login backup")
-            logging.warn("CMD: request system software add {0}".format(PACKAGE))
-            self.input_parse("Once the JSU is installed, enter [Y] to continue...")
+            if not self.manual_jsu(PACKAGE, backup=True):
+                return
+        elif self.config.get('STREAM_INSTALL'):
+            # Add without rebooting so the install can be followed as it runs
+            ok = self.stream_package_add(PACKAGE, backup_RE.lower())
+            if ok:
+                self.reboot(other_routing_engine=True)
         else:
             rsp = self.dev.rpc.request_package_add(reboot=True, no_validate=True,
                                                    package_name=PACKAGE, re0=RE0, re1=RE1,
                                                    force=self.force)
-        # Check to see if the package add succeeded:
-        logging.warn('-----------------START PKG ADD OUTPUT-----------------')
-        ok = True
-        for o in rsp.getparent().findall('output'):
-            logging.warn(o.text)
-        for result in rsp.getparent().findall('package-result'):
-            if result.text != '0':
-                logging.warn('Pkgadd result ' + result.text)
-                ok = False
-        logging.warn('------------------END PKG ADD OUTPUT------------------')
+            # Check to see if the package add succeeded:
+            logging.warn('-----------------START PKG ADD OUTPUT-----------------')
+            for o in rsp.getparent().findall('output'):
+                logging.warn(o.text)
+            for result in rsp.getparent().findall('package-result'):
+                if result.text != '0':
+                    logging.warn('Pkgadd result ' + result.text)
+                    ok = False
+            logging.warn('------------------END PKG ADD OUTPUT------------------')
         if not ok:
             self.dev.timeout = 60
             logging.warn('Encountered issues with software add...  Exiting')
-            if not self.yes_all:
+            if self.auto_rollback() or self.yes_all:
+                self.restore_traffic()
+            else:
                 cont = self.input_parse('Rollback configuration changes? (y/n): ')
                 if cont == 'y':
                     self.restore_traffic()
-            else:
-                self.restore_traffic()
             logging.warn("Script complete, please check the package add errors manually")
             self.end_script()
 
@@ -552,6 +1597,9 @@ class RunUpgrade(object):
 
         logging.warn("Package " + PACKAGE + " took {0}".format(
                      str(datetime.now() - startTime).split('.')[0]))
+        if backup_RE in self.pre_upgrade and 'jselective' not in PACKAGE:
+            self.pre_upgrade[backup_RE]['installs'] += 1
+        self.health_check(['re_status'])
 
         # Grab core dump and SW version info
         self.dev.facts_refresh()
@@ -561,7 +1609,14 @@ class RunUpgrade(object):
         # Check for core dumps:
         logging.warn("Checking for core dumps...")
         if 'directory' in core_dump['multi-routing-engine-results']['multi-routing-engine-item']['directory-list'].keys():
+            self.core_dumps = True
             logging.warn('Found Core Dumps!  Please investigate.')
+            if self.auto_rollback():
+                self.restore_traffic()
+                self.end_script()
+            if self.yes_all:
+                logging.warn('Stopping the upgrade, please check the device manually.')
+                self.end_script()
             cont = self.input_parse("Continue with upgrade? (y/n): ")
             if cont == 'n':
                 cont = self.input_parse("Revert config changes? (y/n): ")
@@ -592,6 +1647,439 @@ class RunUpgrade(object):
                 logging.warn('CMD  : ' + msg)
 
 
+    def issu_check(self):
+        """ Pre-checks for an in-service software upgrade (ISSU), returns True if it can be used """
+        logging.warn('Checking ISSU compatibility...')
+        self.dev.timeout = 600
+        reasons = []
+        if not self.dev.facts['2RE']:
+            reasons.append('Redundant RE not found')
+        elif self.dev.facts['version_RE0'] != self.dev.facts['version_RE1']:
+            reasons.append('RE versions do not match')
+        if self.two_stage:
+            reasons.append('Multi-stage upgrade required')
+        if [s for s in self.plan if s['jsu']]:
+            reasons.append('JSU requires the standard upgrade')
+        if not reasons:
+            gres = self.dev.rpc.get_config(
+                filter_xml='<chassis><redundancy><graceful-switchover/></redundancy></chassis>')
+            if not len(gres):
+                reasons.append('Graceful-switchover (GRES) is not configured')
+            nsr = self.nonstop_routing()
+            if nsr != 'Enabled':
+                reasons.append('Nonstop-Routing is {0}'.format(nsr))
+            pending = self.task_replication()
+            if pending:
+                reasons.append('Task replication not complete: ' + ', '.join(pending))
+        if not reasons:
+            # Let the device validate the package against the running config / hardware
+            try:
+                rsp = self.dev.rpc.check_in_service_upgrade(package_name=self.final_package())
+                if rsp.getparent().find('.//success') is None:
+                    for o in rsp.getparent().findall('output'):
+                        logging.warn(o.text)
+                    reasons.append('Package failed ISSU validation')
+            except RpcError as e:
+                reasons.append('ISSU validation error: {0}'.format(e))
+        if reasons:
+            for reason in reasons:
+                logging.warn('ISSU not possible: ' + reason)
+            return False
+        logging.warn('ISSU pre-checks passed...')
+        return True
+
+
+    def final_package(self):
+        """ Path of the final image on the device """
+        if self.arch == '32-bit':
+            return self.config['CODE_DEST'] + self.config['CODE_IMAGE32']
+        return self.config['CODE_DEST'] + self.config['CODE_IMAGE64']
+
+
+    def upgrade_monitor(self, done, startTime, label):
+        """ Log RE state changes from a second session while an ISSU / NSSU runs """
+        mon = None
+        last = ''
+        while not done.wait(60):
+            try:
+                if mon is None:
+                    mon = self.new_device()
+                    mon.open()
+                states = []
+                for eng in mon.rpc.get_route_engine_information().iter('route-engine'):
+                    states.append('RE{0} {1} {2}'.format(_text(eng, 'slot'),
+                                  _text(eng, 'mastership-state'), _text(eng, 'status')))
+                state = ', '.join(states)
+            except Exception:
+                # The session drops when mastership changes, reconnect next time round
+                mon = None
+                state = 'waiting on the device'
+            if state != last:
+                logging.warn('{0} progress ({1}): {2}'.format(
+                             label, str(datetime.now() - startTime).split('.')[0], state))
+                last = state
+        try:
+            mon.close()
+        except Exception:
+            pass
+
+
+    def upgrade_issu(self):
+        """ Upgrade both REs with [request system software in-service-upgrade]
+            Returns False if the ISSU failed before either RE was changed
+        """
+        PACKAGE = self.final_package()
+        logging.warn('ISSU: Upgrading both REs to ' + PACKAGE + ' in service...')
+        if not self.yes_all:
+            cont = self.input_parse("Continue with in-service upgrade? (y/n): ")
+            if cont != 'y':
+                self.end_script()
+        startTime = datetime.now()
+        version = self.dev.facts['version']
+        self.dev.timeout = self.config.get('ISSU_TIMEOUT', 7200)
+        done = threading.Event()
+        monitor = threading.Thread(target=self.upgrade_monitor, args=(done, startTime, 'ISSU'),
+                                   name=threading.current_thread().name)
+        monitor.start()
+        ok = True
+        try:
+            rsp = self.dev.rpc.request_package_in_service_upgrade(package_name=PACKAGE,
+                                                                  force=self.force)
+            logging.warn('-----------------START ISSU OUTPUT-----------------')
+            for o in rsp.getparent().findall('output'):
+                logging.warn(o.text)
+            for result in rsp.getparent().findall('package-result'):
+                if result.text.strip() != '0':
+                    logging.warn('ISSU result ' + result.text)
+                    ok = False
+            logging.warn('------------------END ISSU OUTPUT------------------')
+        except RpcError as e:
+            logging.warn('ISSU error: {0}'.format(e))
+            ok = False
+        except Exception as e:
+            # Expected, the session is dropped when the old master gives up mastership
+            logging.warn('ISSU session closed: {0}'.format(e))
+        done.set()
+        monitor.join()
+
+        # Wait for the device and check the result on both REs
+        self.dev.timeout = 120
+        while self.dev.probe() is False:
+            time.sleep(30)
+        try:
+            self.dev.close()
+        except Exception:
+            pass
+        self.dev.open()
+        self.dev.facts_refresh()
+        logging.warn("ISSU took {0}".format(str(datetime.now() - startTime).split('.')[0]))
+        versions = [self.dev.facts['version_RE0'], self.dev.facts['version_RE1']]
+        if versions == [self.config['CODE_NAME']] * 2:
+            logging.warn('ISSU complete, both REs running ' + self.config['CODE_NAME'])
+            return True
+        if not ok and versions == [version] * 2:
+            logging.warn('ISSU failed, both REs still running ' + version)
+            return False
+        logging.warn('ERROR: ISSU did not complete, RE0: {0} RE1: {1}'.format(*versions))
+        logging.warn('Exiting script, please check device status manually.')
+        self.end_script()
+
+
+    def nssu_check(self):
+        """ Pre-checks for a nonstop software upgrade (NSSU) of a virtual chassis """
+        logging.warn('Checking NSSU compatibility...')
+        reasons = []
+        if 'Backup' not in [m['role'] for m in self.members]:
+            reasons.append('No backup member')
+        if self.two_stage:
+            reasons.append('Multi-stage upgrade required')
+        if [s for s in self.plan if s['jsu']]:
+            reasons.append('JSU requires the standard upgrade')
+        if not reasons:
+            gres = self.dev.rpc.get_config(
+                filter_xml='<chassis><redundancy><graceful-switchover/></redundancy></chassis>')
+            if not len(gres):
+                reasons.append('Graceful-switchover (GRES) is not configured')
+            nsr = self.nonstop_routing()
+            if nsr != 'Enabled':
+                reasons.append('Nonstop-Routing is {0}'.format(nsr))
+        if reasons:
+            for reason in reasons:
+                logging.warn('NSSU not possible: ' + reason)
+            return False
+        logging.warn('NSSU pre-checks passed...')
+        return True
+
+
+    def member_versions(self):
+        """ {member id: junos version} for every virtual chassis member """
+        versions = {}
+        rsp = self.dev.rpc.get_software_information(all_members=True)
+        for item in rsp.iter('multi-routing-engine-item'):
+            version = _text(item, './/junos-version')
+            if not version:
+                # Older releases only list the packages, "JUNOS Base OS boot [12.3R12.4]"
+                found = re.search(r'\[(.*?)\]', _text(item, './/package-information/comment'))
+                version = found.group(1) if found else ''
+            versions[_text(item, 're-name').replace('fpc', '')] = version
+        return versions
+
+
+    def upgrade_virtual_chassis(self):
+        """ Cycle through installing packages on a virtual chassis """
+        logging.warn("------------------------WARNING-----------------------------")
+        if self.nssu:
+            logging.warn("Ready to upgrade with NSSU, members reboot one at a time   ")
+        else:
+            logging.warn("Ready to upgrade, THIS WILL BE SERVICE IMPACTING!!!        ")
+        logging.warn("-----------------------------------------------------------")
+        if not self.yes_all:
+            cont = self.input_parse("Continue with software add / reboot? (y/n): ")
+            if cont != 'y':
+                self.restore_traffic()
+                self.end_script()
+
+        if self.nssu:
+            if self.upgrade_nssu():
+                return
+            # NSSU failed without changing anything, continue with the parallel upgrade
+            logging.warn('Falling back to a parallel install on all members...')
+            self.nssu = False
+            self.remove_traffic()
+        for step in self.plan:
+            self.vc_pkg_add(step['image'], step['image'], step['path'])
+
+
+    def upgrade_nssu(self):
+        """ Upgrade every member with [request system software nonstop-upgrade]
+            Returns False if the NSSU failed before any member was changed
+        """
+        PACKAGE = self.final_package()
+        logging.warn('NSSU: Upgrading all members to ' + PACKAGE + '...')
+        startTime = datetime.now()
+        before = self.member_versions()
+        self.dev.timeout = self.config.get('NSSU_TIMEOUT', 7200)
+        done = threading.Event()
+        monitor = threading.Thread(target=self.upgrade_monitor, args=(done, startTime, 'NSSU'),
+                                   name=threading.current_thread().name)
+        monitor.start()
+        ok = True
+        try:
+            rsp = self.dev.rpc.request_package_nonstop_upgrade(package_name=PACKAGE, reboot=True,
+                                                               force=self.force)
+            logging.warn('-----------------START NSSU OUTPUT-----------------')
+            for o in rsp.getparent().findall('output'):
+                logging.warn(o.text)
+            for result in rsp.getparent().findall('package-result'):
+                if result.text.strip() != '0':
+                    logging.warn('NSSU result ' + result.text)
+                    ok = False
+            logging.warn('------------------END NSSU OUTPUT------------------')
+        except RpcError as e:
+            logging.warn('NSSU error: {0}'.format(e))
+            ok = False
+        except Exception as e:
+            # Expected, the session is dropped when the old master reboots
+            logging.warn('NSSU session closed: {0}'.format(e))
+        done.set()
+        monitor.join()
+
+        self.dev.timeout = 120
+        while self.dev.probe() is False:
+            time.sleep(30)
+        try:
+            self.dev.close()
+        except Exception:
+            pass
+        self.dev.open()
+        self.dev.facts_refresh()
+        logging.warn("NSSU took {0}".format(str(datetime.now() - startTime).split('.')[0]))
+        versions = self.member_versions()
+        if set(versions.values()) == set([self.config['CODE_NAME']]):
+            logging.warn('NSSU complete, all members running ' + self.config['CODE_NAME'])
+            self.health_check()
+            return True
+        if not ok and versions == before:
+            logging.warn('NSSU failed, no members were changed')
+            return False
+        logging.warn('ERROR: NSSU did not complete: ' +
+                     ', '.join('fpc{0} {1}'.format(*m) for m in sorted(versions.items())))
+        logging.warn('Exiting script, please check device status manually.')
+        self.end_script()
+
+
+    def member_pkg_add(self, member, PACKAGE, thread_name):
+        """ Add a package on one virtual chassis member over its own session, without rebooting """
+        threading.current_thread().name = thread_name
+        output, ok = [], True
+        try:
+            dev = self.new_device()
+            dev.open()
+            dev.timeout = 3600
+            rsp = dev.rpc.request_package_add(no_validate=True, package_name=PACKAGE,
+                                              member=member, force=self.force)
+            output = [o.text for o in rsp.getparent().findall('output')]
+            for result in rsp.getparent().findall('package-result'):
+                if result.text.strip() != '0':
+                    output.append('Pkgadd result ' + result.text)
+                    ok = False
+            dev.close()
+        except Exception as e:
+            output.append(str(e))
+            ok = False
+        return member, ok, output
+
+
+    def vc_pkg_add(self, PKG32, PKG64, R_PATH):
+        """ Add the package on every member at once, then reboot the virtual chassis once """
+        if self.arch == '32-bit':
+            PACKAGE = R_PATH + PKG32
+        else:
+            PACKAGE = R_PATH + PKG64
+        if 'jselective' in PACKAGE:
+            self.manual_jsu(PACKAGE)
+            return
+        startTime = datetime.now()
+        logging.warn('Installing ' + PACKAGE + ' on {0} members...'.format(len(self.members)))
+        ok = True
+        with ThreadPoolExecutor(max_workers=len(self.members)) as pool:
+            futures = [pool.submit(self.member_pkg_add, m['id'], PACKAGE,
+                                   threading.current_thread().name) for m in self.members]
+            for future in as_completed(futures):
+                member, member_ok, output = future.result()
+                logging.warn('-----------------MEMBER {0} PKG ADD OUTPUT-----------------'.format(member))
+                for line in output:
+                    logging.warn(line)
+                if not member_ok:
+                    ok = False
+        if not ok:
+            logging.warn('Encountered issues with software add...  Exiting')
+            if not self.yes_all:
+                cont = self.input_parse("Restore configuration before exiting? (y/n): ")
+                if cont == 'y':
+                    self.restore_traffic()
+            else:
+                logging.warn('Restoring configuration before exiting...')
+                self.restore_traffic()
+            self.end_script()
+
+        logging.warn('Rebooting all members, please wait...')
+        self.dev.timeout = 120
+        try:
+            self.dev.rpc.request_reboot()
+        except Exception:
+            pass
+        # Wait 2 minutes for the reboot, then start checking every 30s
+        time.sleep(120)
+        while self.dev.probe() is False:
+            time.sleep(30)
+        logging.warn("Package " + PACKAGE + " took {0}".format(
+                     str(datetime.now() - startTime).split('.')[0]))
+        self.dev.facts_refresh()
+        self.dev.open()
+        self.dev.facts_refresh()
+        for member, version in sorted(self.member_versions().items()):
+            logging.warn('Member {0} SW Version: {1}'.format(member, version))
+        self.health_check()
+
+
+    def install_progress(self, phase, msg):
+        """ Report an install progress event """
+        logging.warn('[{0}] {1}'.format(phase, msg))
+        for callback in self.progress_callbacks:
+            callback({'host': self.host, 'phase': phase, 'msg': msg, 'time': time.time()})
+
+
+    def install_phase(self, line, phase):
+        """ Work out the install phase from a line of package add output """
+        for pattern, new_phase in INSTALL_PHASES:
+            if re.search(pattern, line):
+                return new_phase
+        return phase
+
+
+    def stream_package_add(self, PACKAGE, target=''):
+        """ Add a package over SSH without rebooting, reporting the install output as it arrives.
+            The install is aborted if it prints nothing for INSTALL_STALL_TIMEOUT seconds
+        """
+        stall = self.config.get('INSTALL_STALL_TIMEOUT', 600)
+        deadline = time.time() + self.config.get('INSTALL_TIMEOUT', 3600)
+        cmd = 'request system software add {0} no-validate'.format(PACKAGE)
+        if self.force:
+            cmd += ' force'
+        if target:
+            cmd += ' ' + target
+        try:
+            net_connect = ConnectHandler(**self.ssh_params())
+            prompt = net_connect.find_prompt().strip()
+            net_connect.write_channel(cmd + '\n')
+        except Exception as e:
+            self.install_progress('failed', str(e))
+            return False
+        self.install_progress('starting', cmd)
+        ok, phase, buf = True, 'starting', ''
+        last_output = time.time()
+        try:
+            while True:
+                if time.time() > deadline:
+                    self.install_progress('stalled', 'Install still running after {0}s, aborting...'.format(
+                                          self.config.get('INSTALL_TIMEOUT', 3600)))
+                    net_connect.write_channel('\x03')
+                    ok = False
+                    break
+                data = net_connect.read_channel()
+                if data:
+                    last_output = time.time()
+                    lines = (buf + data).replace('\r', '').split('\n')
+                    buf = lines.pop()
+                    for line in lines:
+                        line = line.strip()
+                        if not line or line.endswith(cmd):
+                            continue
+                        phase = self.install_phase(line, phase)
+                        if phase == 'failed':
+                            ok = False
+                        self.install_progress(phase, line)
+                    # Back at the CLI prompt, the install is finished
+                    if buf.strip() == prompt:
+                        break
+                elif time.time() - last_output > stall:
+                    self.install_progress('stalled', 'No install output for {0}s, aborting...'.format(
+                                          int(time.time() - last_output)))
+                    net_connect.write_channel('\x03')
+                    ok = False
+                    break
+                else:
+                    time.sleep(1)
+        finally:
+            try:
+                net_connect.disconnect()
+            except Exception:
+                pass
+        if ok:
+            self.install_progress('installed', PACKAGE)
+        return ok
+
+
+    def reboot(self, **kwargs):
+        """ Reboot the device (or the other RE), the session may drop before the reply.
+            Returns False if the device rejected the request (e.g. an option this platform
+            does not have) and is not rebooting
+        """
+        logging.warn('Requesting reboot...')
+        self.dev.timeout = 120
+        try:
+            self.dev.rpc.request_reboot(**kwargs)
+        except RpcTimeoutError as e:
+            logging.warn(str(e))
+        except RpcError as e:
+            logging.warn('Reboot rejected: {0}'.format(e))
+            return False
+        except Exception as e:
+            logging.warn(str(e))
+        return True
+
+
     def upgrade_single_re(self):
         """ Cycle through installing packcages for single RE systems """
         logging.warn("------------------------WARNING-----------------------------")
@@ -603,56 +2091,54 @@ class RunUpgrade(object):
                 self.restore_traffic()
                 self.end_script()
 
-        # First Stage Upgrade
-        if self.two_stage:
-            self.single_re_pkg_add(self.config['CODE_2STAGE32'], self.config['CODE_2STAGE64'], self.config['CODE_PRESERVE'])
-        # Second Stage Upgrade
-        self.single_re_pkg_add(self.config['CODE_IMAGE32'], self.config['CODE_IMAGE64'], self.config['CODE_DEST'])
-        # JSU Upgrade
-        if self.config['CODE_JSU32'] or self.config['CODE_JSU64']:
-            if self.two_stage:
-                self.single_re_pkg_add(self.config['CODE_JSU32'], self.config['CODE_JSU64'], self.config['CODE_PRESERVE'])
-            else:
-                self.single_re_pkg_add(self.config['CODE_JSU32'], self.config['CODE_JSU64'], self.config['CODE_DEST'])
+        for step in self.plan:
+            self.single_re_pkg_add(step['image'], step['image'], step['path'])
 
 
     def single_re_pkg_add(self, PKG32, PKG64, R_PATH):
         """ Perform software add and reboot the RE / Device """
         self.dev.timeout = 3600
         if self.arch == '32-bit':
-            PACKAGE = self.config['CODE_DEST'] + PKG32
+            PACKAGE = R_PATH + PKG32
         else:
-            PACKAGE = self.config['CODE_DEST'] + PKG64
+            PACKAGE = R_PATH + PKG64
         # Had issues w/utils.sw install, so im using the rpc call instead
         startTime = datetime.now()
         logging.warn('Upgrading device... Please Wait...')
         # Change flags for JSU vs JINSTALL Package:
         if 'jselective' in PACKAGE:
-            # JSU installs are failing with RPC call
-            logging.warn("Unable to instsall the JSU remotely, please do it manually...")
-            logging.warn("CMD: request system software add {0}".format(PACKAGE))
-            self.input_parse("Once the JSU is installed, enter [Y] to continue...")
+            if not self.manual_jsu(PACKAGE):
+                return
+            ok = True
+        elif self.config.get('STREAM_INSTALL'):
+            # Add without rebooting so the install can be followed as it runs
+            ok = self.stream_package_add(PACKAGE)
+            if ok:
+                self.reboot()
         else:
             rsp = self.dev.rpc.request_package_add(reboot=True,
                                                    no_validate=True,
                                                    package_name=PACKAGE,
                                                    force=self.force)
 
-        # Check to see if the package add succeeded:
-        logging.warn('-----------------START PKG ADD OUTPUT-----------------')
-        ok = True
-        got = rsp.getparent()
-        for o in got.findall('output'):
-            logging.warn(o.text)
-        package_result = got.findall('package-result')
-        for result in package_result:
-            if result.text != '0':
-                logging.warn('Pkgadd result ' + result.text)
-                ok = False
+            # Check to see if the package add succeeded:
+            logging.warn('-----------------START PKG ADD OUTPUT-----------------')
+            ok = True
+            got = rsp.getparent()
+            for o in got.findall('output'):
+                logging.warn(o.text)
+            package_result = got.findall('package-result')
+            for result in package_result:
+                if result.text != '0':
+                    logging.warn('Pkgadd result ' + result.text)
+                    ok = False
+            logging.warn('------------------END PKG ADD OUTPUT------------------')
         self.dev.timeout = 120
-        logging.warn('------------------END PKG ADD OUTPUT------------------')
         if not ok:
             logging.warn('Encountered issues with software add...  Exiting')
+            if self.auto_rollback():
+                self.restore_traffic()
+                self.end_script()
             if not self.yes_all:
                 cont = self.input_parse("Restore configuration before exiting? (y/n): ")
                 if cont == 'y':
@@ -674,30 +2160,313 @@ class RunUpgrade(object):
         self.dev.facts_refresh()
         self.dev.open()
         self.dev.facts_refresh()
+        if 'RE0' in self.pre_upgrade and 'jselective' not in PACKAGE:
+            self.pre_upgrade['RE0']['installs'] += 1
 
-        # Check for core dumps:
-        logging.warn("Checking for core dumps...")
-        core_dump = xmltodict.parse(etree.tostring(self.dev.rpc.get_system_core_dumps()))
-        for item in core_dump['multi-routing-engine-results']['multi-routing-engine-item']['directory-list']['output']:
-            if 'No such file' not in item:
-                logging.warn('Found Core Dumps!  Please investigate.')
-                logging.warn(item)
-                if not self.yes_all:
-                    cont = self.input_parse("Continue with upgrade? (y/n): ")
-                    if cont.lower() != 'y':
-                        self.end_script()
         # Check SW Version:
         logging.warn('SW Version: ' + self.dev.facts['version'] + '')
+        # Core dumps, FPCs, alarms, interfaces, adjacencies:
+        self.health_check()
+
+
+    def collect_baseline(self):
+        """ Record pre-upgrade state for the post-reboot health checks to compare against """
+        logging.warn('Collecting pre-upgrade baseline...')
+        for name in self.config.get('HEALTH_CHECKS', DEFAULT_HEALTH_CHECKS):
+            if HEALTH_CHECKS[name]['baseline']:
+                try:
+                    self.baseline[name] = HEALTH_CHECKS[name]['baseline'](self)
+                except Exception as e:
+                    logging.warn('Unable to collect {0} baseline: {1}'.format(name, e))
+
+
+    def run_check(self, name, deadline, interval, stop):
+        """ Retry a single health check until it passes, fails or the deadline expires """
+        msg = ''
+        while not stop.is_set():
+            try:
+                ok, msg = HEALTH_CHECKS[name]['func'](self)
+            except Exception as e:
+                # Usually the device is still coming up, keep trying
+                ok, msg = None, str(e)
+            if ok is not None:
+                return ok, msg
+            if time.time() + interval > deadline:
+                return False, 'Timed out - ' + msg
+            stop.wait(interval)
+        return None, 'Cancelled'
+
+
+    def run_health_checks(self, checks=None):
+        """ Run the health checks in parallel, stop on the first blocking failure and stop
+            waiting once every blocking check has passed.  Returns the failed blocking checks
+        """
+        checks = checks or self.config.get('HEALTH_CHECKS', DEFAULT_HEALTH_CHECKS)
+        if not checks:
+            return []
+        blocking = self.config.get('HEALTH_CHECK_BLOCKING') or \
+            [c for c in checks if HEALTH_CHECKS[c]['blocking']]
+        deadline = time.time() + self.config.get('HEALTH_CHECK_TIMEOUT', 900)
+        interval = self.config.get('HEALTH_CHECK_INTERVAL', 30)
+        self.dev.timeout = 120
+        logging.warn('Running health checks: ' + ', '.join(checks) + '...')
+        stop = threading.Event()
+        failed = []
+        pending = set(checks)
+        waiting = set(c for c in checks if c in blocking)
+        pool = ThreadPoolExecutor(max_workers=len(checks))
+        try:
+            futures = {pool.submit(self.run_check, c, deadline, interval, stop): c for c in checks}
+            for future in as_completed(futures):
+                name = futures[future]
+                pending.discard(name)
+                ok, msg = future.result()
+                if ok:
+                    logging.warn('  [PASS] {0}: {1}'.format(name, msg))
+                    if name in waiting:
+                        waiting.discard(name)
+                        if not waiting and pending:
+                            # Safe to continue, don't hold the upgrade for the rest
+                            for name in sorted(pending):
+                                logging.warn('  [WARN] {0}: not passed yet, not waiting for it'.format(name))
+                            break
+                elif name in blocking:
+                    logging.warn('  [FAIL] {0}: {1}'.format(name, msg))
+                    failed.append(name)
+                    # Don't wait on the rest, this device needs attention
+                    break
+                else:
+                    logging.warn('  [WARN] {0}: {1}'.format(name, msg))
+        finally:
+            stop.set()
+            pool.shutdown(wait=False)
+        return failed
+
+
+    def health_check(self, checks=None):
+        """ Run the post-reboot health checks, roll back or stop the upgrade if one fails """
+        failed = self.run_health_checks(checks)
+        if failed:
+            self.health_ok = False
+            if 'core_dumps' in failed:
+                self.core_dumps = True
+            logging.warn('Health check failed: ' + ', '.join(failed) + '.  Please investigate.')
+            if self.auto_rollback():
+                self.restore_traffic()
+                self.end_script()
+            if self.yes_all:
+                self.end_script()
+            cont = self.input_parse("Continue with upgrade? (y/n): ")
+            if cont == 'n':
+                cont = self.input_parse("Revert config changes? (y/n): ")
+                if cont == 'y':
+                    self.restore_traffic()
+                self.end_script()
+        return not failed
+
+
+    def re_version(self, re_name):
+        """ Running version of an RE from the (refreshed) facts """
+        return self.dev.facts.get('version_' + re_name) or self.dev.facts['version']
+
+
+    def previous_image(self, version):
+        """ Name of a local image of version (ROLLBACK_IMAGE32/64, or one for this platform
+            found in the image store / CODE_FOLDER) to re-install if there is no quicker way back
+        """
+        name = self.config.get('ROLLBACK_IMAGE64' if self.arch == '64-bit' else 'ROLLBACK_IMAGE32')
+        if name:
+            return name
+        store = self.get_image_store()
+        names = store.names() if store else []
+        if os.path.isdir(self.config['CODE_FOLDER']):
+            names += sorted(os.listdir(self.config['CODE_FOLDER']))
+        # Full version only, 16.1R6 must not match 16.1R6-S1.1
+        pattern = r'[-_]' + re.escape(version) + r'(-(?!S\d)|_|\.tgz$)'
+        for name in names:
+            if 'jselective' in name or not re.search(pattern, name):
+                continue
+            if self.same_platform(name, version):
+                return name
+        return ''
+
+
+    def record_rollback_state(self):
+        """ Record the pre-upgrade version, snapshot and previous image of each RE for the rollback """
+        res = ['RE0', 'RE1'] if self.dev.facts['2RE'] else ['RE0']
+        store = self.get_image_store()
+        for re_name in res:
+            version = self.re_version(re_name)
+            image = self.previous_image(version)
+            if image and store:
+                self.images[image] = self.store_image(store, image)
+            self.pre_upgrade[re_name] = {'version': version, 'snapshot': self.snapshots.get(re_name, False),
+                                         'image': image, 'installs': 0}
+            logging.warn('{0} pre-upgrade version {1}, snapshot: {2}, previous image: {3}'.format(
+                         re_name, version, 'yes' if self.snapshots.get(re_name) else 'no', image or 'not found'))
+
+
+    def rollback_methods(self, re_name):
+        """ Recovery paths available for an RE, in ROLLBACK_METHODS order (quickest first) """
+        state = self.pre_upgrade[re_name]
+        available = {
+            # Only one package set back, after a two-stage install it would stop at the 2-stage version
+            'software_rollback': state['installs'] == 1,
+            # The pre-upgrade snapshot is on the alternate media
+            'alternate_media': state['snapshot'] and bool(self.config.get('ROLLBACK_ALTERNATE_BOOT',
+                                                                           ROLLBACK_ALTERNATE_BOOT)),
+            'reinstall': bool(state['image']) and os.path.isfile(self.local_image(state['image']))}
+        return [m for m in self.config.get('ROLLBACK_METHODS', ROLLBACK_METHODS) if available.get(m)]
+
+
+    def rollback_re(self, re_name, backup):
+        """ Return one RE to its pre-upgrade version, trying each recovery path until one works """
+        state = self.pre_upgrade[re_name]
+        target = {re_name.lower(): True} if backup else {}
+        reboot = {'other_routing_engine': True} if backup else {}
+        methods = self.rollback_methods(re_name)
+        if not methods:
+            self.install_progress('rollback', 'No rollback path available for {0}'.format(re_name))
+        for method in methods:
+            self.install_progress('rollback', 'Rolling back {0} from {1} to {2} ({3})...'.format(
+                                  re_name, self.re_version(re_name), state['version'], method.replace('_', ' ')))
+            startTime = datetime.now()
+            self.dev.timeout = 3600
+            try:
+                if method == 'software_rollback':
+                    rsp = self.dev.rpc.request_package_rollback(**target)
+                    if 'error' in etree.tostring(rsp).decode().lower():
+                        self.install_progress('rollback', 'software rollback failed: ' + ' '.join(rsp.itertext()).strip())
+                        continue
+                    if not self.reboot(**reboot):
+                        self.install_progress('rollback', 'software rollback failed: reboot rejected')
+                        continue
+                elif method == 'alternate_media':
+                    # slice is EX / SRX only, other platforms reject the reboot and nothing restarts
+                    if not self.reboot(**dict(reboot, **self.config.get('ROLLBACK_ALTERNATE_BOOT',
+                                                                         ROLLBACK_ALTERNATE_BOOT))):
+                        self.install_progress('rollback', 'alternate media failed: reboot rejected')
+                        continue
+                else:
+                    PACKAGE = self.config['CODE_DEST'] + state['image']
+                    img = json.dumps(xmltodict.parse(etree.tostring(self.dev.rpc.file_list(path=PACKAGE))))
+                    if 'No such file' in img:
+                        self.copy_image(self.local_image(state['image']), PACKAGE)
+                    if backup:
+                        master = self.dev.facts['master'].lower() + ':'
+                        self.copy_to_other_re(master + PACKAGE, re_name.lower() + ':' + PACKAGE)
+                    rsp = self.dev.rpc.request_package_add(reboot=True, no_validate=True, package_name=PACKAGE,
+                                                           force=self.force, **target)
+                    if [r for r in rsp.getparent().findall('package-result') if r.text != '0']:
+                        for o in rsp.getparent().findall('output'):
+                            logging.warn(o.text)
+                        self.install_progress('rollback', 'reinstall failed')
+                        continue
+            except RpcError as e:
+                self.install_progress('rollback', '{0} failed: {1}'.format(method, e))
+                continue
+            self.wait_for_re(re_name, backup)
+            version = self.re_version(re_name)
+            logging.warn("Rollback of {0} took {1}".format(re_name, str(datetime.now() - startTime).split('.')[0]))
+            if version == state['version']:
+                self.install_progress('rollback', '{0} is back on {1}'.format(re_name, version))
+                return True
+            self.install_progress('rollback', '{0} is on {1} after {2}'.format(re_name, version, method))
+        return False
+
+
+    def wait_for_re(self, re_name, backup):
+        """ Wait for a rebooted RE to come back, reconnecting if it was the only one """
+        logging.warn('Rebooting, please wait...')
+        time.sleep(120)
+        if backup:
+            re_state = 'Present'
+            while re_state == 'Present':
+                time.sleep(30)
+                re_state = xmltodict.parse(etree.tostring(
+                        self.dev.rpc.get_route_engine_information()))['route-engine-information']\
+                        ['route-engine'][int(re_name[-1])]['mastership-state']
+        else:
+            while self.dev.probe() is False:
+                time.sleep(30)
+            # Once dev is reachable, re-open connection (refresh facts first to kill conn)
+            self.dev.facts_refresh()
+            self.dev.open()
+        self.dev.facts_refresh()
+
+
+    def rollback(self):
+        """ Roll every upgraded RE back to its pre-upgrade version, the backup RE first so the
+            master is only rebooted once the other RE can take over.  The result is verified
+            with the health checks, returns True if the device is back and healthy
+        """
+        if not self.pre_upgrade:
+            logging.warn('No pre-upgrade state recorded, please roll back manually')
+            return False
+        self.rolling_back = True
+        self.install_progress('rollback', 'Starting automated rollback...')
+        self.dev.timeout = 120
+        self.dev.facts_refresh()
+        # Cores left by the failed version are expected, only new ones fail the verification
+        if 'core_dumps' in self.baseline:
+            self.baseline['core_dumps'] = _core_files(self)
+        ok = True
+        for re_name in sorted(self.pre_upgrade, key=lambda r: r == self.dev.facts['master']):
+            if self.re_version(re_name) == self.pre_upgrade[re_name]['version']:
+                logging.warn('{0} is still on {1}, nothing to roll back'.format(re_name, self.re_version(re_name)))
+                continue
+            backup = len(self.pre_upgrade) > 1
+            if backup and re_name == self.dev.facts['master']:
+                if not ok:
+                    logging.warn('Not rolling back the master RE, the backup RE could not be rolled back')
+                    break
+                # Move mastership to the RE that is already back on the old version
+                self.switchover_RE()
+                self.dev.facts_refresh()
+            ok = self.rollback_re(re_name, backup) and ok
+        if ok:
+            logging.warn('Verifying the rollback...')
+            ok = not self.run_health_checks()
+        self.rolled_back = ok
+        self.install_progress('rollback', 'Rollback {0}'.format('complete' if ok else 'FAILED, please recover manually'))
+        return ok
+
+
+    def auto_rollback(self):
+        """ Roll back after a failed upgrade if AUTO_ROLLBACK is set (or when asked interactively),
+            returns True if the device was rolled back
+        """
+        if self.rolling_back or not self.pre_upgrade:
+            return False
+        if not self.config.get('AUTO_ROLLBACK'):
+            if self.yes_all or self.input_parse('Roll back to the pre-upgrade version? (y/n): ') != 'y':
+                return False
+        return self.rollback()
+
+
+    def nonstop_routing(self):
+        """ Returns the nonstop-routing state (Enabled / Disabled) """
+        nsr = ''
+        x = self.dev.rpc.get_nonstop_routing_information()
+        for item in x.getparent().iter():
+            if item.findtext('nonstop-routing-enabled'):
+                nsr = item.findtext('nonstop-routing-enabled')
+        return nsr
+
+
+    def task_replication(self):
+        """ Returns {protocol: state} for every protocol not done replicating to the backup RE """
+        rsp = self.dev.rpc.get_routing_task_replication_state()
+        names = [_text(n, '.') for n in rsp.iter('task-protocol-replication-name')]
+        states = [_text(n, '.') for n in rsp.iter('task-protocol-replication-state')]
+        return dict((n, st) for n, st in zip(names, states) if st != 'Complete')
 
 
     def switchover_RE(self):
         """ Issue RE switchover """
         if self.dev.facts['2RE']:
             # Add a check for GRES / NSR
-            x = self.dev.rpc.get_nonstop_routing_information()
-            for item in x.getparent().iter():
-                if item.findtext('nonstop-routing-enabled'):
-                    nsr = item.findtext('nonstop-routing-enabled')
+            nsr = self.nonstop_routing()
             if nsr != 'Enabled':
                 logging.warn("----------------------WARNING----------------------------")
                 logging.warn('Nonstop-Routing is {0}, switchover will be impacting!'.format(nsr))
@@ -724,9 +2493,12 @@ class RunUpgrade(object):
                     time.sleep(5)
                 if 'Not ready' in str(r):
                     logging.warn(str(r))
+                    if self.yes_all:
+                        logging.warn('ERROR: Switchover failed, please check the device manually.')
+                        self.end_script()
                     cont = self.input_parse('Please switchover manually and enter "y" to continue: ')
                     if cont == 'n':
-                        self.end_script
+                        self.end_script()
             try:
                 self.dev.close()
             except:
@@ -780,6 +2552,23 @@ class RunUpgrade(object):
                         self.dev.open()
                         
 
+    def manual_jsu(self, PACKAGE, backup=False):
+        """ JSU installs are failing with RPC call, have them installed by hand.
+            Returns False if the JSU was skipped because nobody is there to answer (-y)
+        """
+        if self.yes_all:
+            logging.warn("WARNING: Skipping JSU {0}, it has to be installed manually, "
+                         "the upgrade will be reported as failed".format(PACKAGE))
+            self.jsu_skipped = True
+            return False
+        logging.warn("Unable to instsall the JSU remotely, please do it manually...")
+        if backup:
+            logging.warn("CMD: request routing-engine login backup")
+        logging.warn("CMD: request system software add {0}".format(PACKAGE))
+        self.input_parse("Once the JSU is installed, enter [Y] to continue...")
+        return True
+
+
     def input_parse(self, msg):
         """ Prompt for input """
         q = ''
@@ -792,13 +2581,30 @@ class RunUpgrade(object):
         """ Verify version, restore config, and wait for replication on dualRE """
         # Check SW Version:
         self.dev.facts_refresh()
-        if self.dev.facts['2RE']:
+        if self.members:
+            versions = self.member_versions()
+            if len(set(versions.values())) == 1:
+                logging.warn('Version matches on all virtual chassis members.')
+                self.version_match = True
+            else:
+                logging.warn('ERROR: Versions do not match on all members: ' +
+                             ', '.join('fpc{0} {1}'.format(*m) for m in sorted(versions.items())))
+                logging.warn('Exiting script, please check device status manually.')
+                self.end_script()
+        elif self.dev.facts['2RE']:
             if self.dev.facts['version_RE0'] == self.dev.facts['version_RE1']:
                 logging.warn('Version matches on both routing engines.')
+                self.version_match = True
             else:
                 logging.warn('ERROR: Versions do not match on both routing engines')
                 logging.warn('Exiting script, please check device status manually.')
                 self.end_script()
+        else:
+            self.version_match = True
+
+        if self.issu or self.nssu:
+            logging.warn('In-service upgrade, redundancy config was left in place...')
+            return
 
         logging.warn('Restoring configruation...')
         config_cmds = self.config['POST_UPGRADE_CMDS']
@@ -856,16 +2662,12 @@ class RunUpgrade(object):
             task_sync = False
             waiting_on = ''
             while task_sync is False:
-                rep = xmltodict.parse(etree.tostring(
-                                      self.dev.rpc.get_routing_task_replication_state()))
-                task_sync = True
-                for i, item in enumerate(rep['task-replication-state']['task-protocol-replication-state']):
-                    if item != 'Complete':
-                        task_sync = False
-                        proto = rep['task-replication-state']['task-protocol-replication-name'][i]
-                        if waiting_on != proto:
-                            waiting_on = proto
-                            logging.warn(proto + ': ' + item + '...')
+                pending = self.task_replication()
+                task_sync = not pending
+                for proto, item in pending.items():
+                    if waiting_on != proto:
+                        waiting_on = proto
+                        logging.warn(proto + ': ' + item + '...')
                 if task_sync is False:
                     time.sleep(60)
             # Check which RE is active and switchover if needed
@@ -873,6 +2675,14 @@ class RunUpgrade(object):
                 self.switchover_RE()
 
 
+    def succeeded(self):
+        """ Did the upgrade finish healthy and on the target version? """
+        if self.no_install:
+            return self.completed
+        return self.completed and self.health_ok and self.version_match and \
+            not self.core_dumps and not self.jsu_skipped and self.dev.facts['version'] == self.config['CODE_NAME']
+
+
     def end_script(self):
         """ Close the connection to the device and exit the script """
         try:
@@ -880,57 +2690,940 @@ class RunUpgrade(object):
             self.dev.close()
         except:
             logging.warn("Did not disconnect cleanly.")
+        for handler in self.log_handlers:
+            logging.getLogger().removeHandler(handler)
+            handler.close()
+        self.release_images()
         exit()
 
 
-execute = RunUpgrade()
-
-# 1. Get CLI Input / Print Usage Info
-execute.get_arguments()
-# 2. Setup Logging / Ensure Image is on local server
-execute.initial_setup()
-# 3. Open NETCONF Connection To Device
-execute.open_connection()
-# 4. Grab info on RE's
-execute.collect_re_info()
-# 5. Check For SW Image(s) on Device - Copy if needed
-execute.image_check()
-
-# Quit here if the --noinstall option is present
-if execute.no_install:
-    logging.warn("Run without the -n / --noupgrade option to install")
-    execute.end_script()
-
-# 6. Request system snapshot
-execute.system_snapshot()
-# 7. Remove Redundancy / NSR, Pre-Upgrade config changes
-execute.remove_traffic()
-
-# IF DEVICE IS SINGLE RE
-if not execute.dev.facts['2RE']:
-    # 8. Upgrade only RE
-    execute.upgrade_single_re()
-# IF DEVICE IS DUAL RE
-else:
-    # 8. Start upgrade on backup RE
-    execute.upgrade_backup_re()
-    # 9. Perform an RE Switchover
-    execute.switchover_RE()
-    # 10. Perform upgrade on the other RE
-    execute.upgrade_backup_re()
-
-# 11. Re-check network services mode on MX and reboot if needed
-execute.mx_network_services()
-# 12. Restore Routing-Engine redundancy
-execute.restore_traffic()
-# 13. Switch back to RE0
-execute.switch_to_master()
-# 14. Request system snapshot
-execute.system_snapshot()
-# 15. Display results
-logging.warn("------------------------")
-logging.warn("|       RESULTS        |")
-logging.warn("------------------------")
-execute.collect_re_info()
-
-execute.end_script()
+    def run(self):
+        """ Upgrade the device, once the arguments and config are loaded """
+        # 3. Open NETCONF Connection To Device
+        self.open_connection()
+        # 4. Grab info on RE's / Virtual Chassis members
+        self.collect_re_info()
+        self.members = self.vc_members()
+        # 5. Check For SW Image(s) on Device - Copy if needed
+        self.image_check()
+
+        # Quit here if the --noinstall option is present
+        if self.no_install:
+            logging.warn("Run without the -n / --noupgrade option to install")
+            self.completed = True
+            self.end_script()
+
+        # 6. Record pre-upgrade state for health checks, request system snapshot
+        self.collect_baseline()
+        self.system_snapshot()
+        # Versions / snapshots to roll back to if the upgrade fails (RE based devices only)
+        if not self.members:
+            self.record_rollback_state()
+        # 7. Remove Redundancy / NSR, Pre-Upgrade config changes
+        #    (ISSU needs them in place, fall back to the normal upgrade if it can't be used)
+        if self.issu and not self.issu_check():
+            self.issu = False
+        if self.members and self.config.get('VC_NSSU', True) and self.nssu_check():
+            self.nssu = True
+        if not self.issu and not self.nssu:
+            self.remove_traffic()
+
+        # IF DEVICE IS A VIRTUAL CHASSIS
+        if self.members:
+            # 8. Upgrade every member, NSSU or one reboot
+            self.upgrade_virtual_chassis()
+        # IF DEVICE IS SINGLE RE
+        elif not self.dev.facts['2RE']:
+            # 8. Upgrade only RE
+            self.upgrade_single_re()
+        # IF DEVICE IS DUAL RE AND SUPPORTS ISSU
+        elif self.issu and self.upgrade_issu():
+            # 8-10. Both REs upgraded in service
+            self.health_check()
+        # IF DEVICE IS DUAL RE
+        else:
+            if self.issu:
+                # ISSU failed without changing anything, continue with the normal upgrade
+                logging.warn('Falling back to the standard dual-RE upgrade...')
+                self.issu = False
+                self.remove_traffic()
+            # 8. Start upgrade on backup RE
+            self.upgrade_backup_re()
+            # 9. Perform an RE Switchover
+            self.switchover_RE()
+            # 10. Perform upgrade on the other RE
+            self.upgrade_backup_re()
+            # Chassis-wide health checks once both REs are upgraded
+            self.health_check()
+
+        # 11. Re-check network services mode on MX and reboot if needed
+        self.mx_network_services()
+        # 12. Restore Routing-Engine redundancy
+        self.restore_traffic()
+        # 13. Switch back to RE0
+        self.switch_to_master()
+        # 14. Request system snapshot
+        self.system_snapshot()
+        # 15. Display results
+        logging.warn("------------------------")
+        logging.warn("|       RESULTS        |")
+        logging.warn("------------------------")
+        self.collect_re_info()
+        self.completed = True
+
+        self.end_script()
+
+
+def load_device_list(path):
+    """ Read a device list, one device per line optionally followed by its region / site
+        Returns [(host, region)], blank lines and # comments are skipped
+    """
+    devices = []
+    with open(path) as f:
+        for line in f:
+            fields = line.split('#')[0].split()
+            if fields and fields[0] not in [d[0] for d in devices]:
+                devices.append((fields[0], fields[1] if len(fields) > 1 else ''))
+    return devices
+
+
+def upgrade_device(host, options, auth=None, config=None, progress=None):
+    """ Upgrade one device without prompting, in the current thread which is renamed after
+        the host for logging.  options are RunUpgrade attributes (configfile, force, issu, ...)
+        Returns the RunUpgrade so the caller can check succeeded()
+    """
+    threading.current_thread().name = host
+    up = RunUpgrade(auth)
+    up.host = host
+    for key, value in options.items():
+        setattr(up, key, value)
+    up.yes_all = True
+    if config:
+        up.config = config
+    if progress:
+        up.progress_callbacks.append(progress)
+    try:
+        up.initial_setup()
+        up.run()
+    except SystemExit:
+        # end_script() / exit() are how RunUpgrade finishes, good or bad
+        pass
+    except Exception as e:
+        logging.warn('ERROR: {0}'.format(e))
+        try:
+            up.end_script()
+        except SystemExit:
+            pass
+    # exit() before the device was connected skips end_script
+    up.release_images()
+    return up
+
+
+def max_failures(config, attempted):
+    """ ROLLOUT_MAX_FAILURES as a device count, it may be a % of devices attempted """
+    limit = str(config.get('ROLLOUT_MAX_FAILURES', 0)).strip()
+    if limit.endswith('%'):
+        return attempted * int(limit[:-1]) // 100
+    return int(limit)
+
+
+class RolloutController(object):
+    """ Upgrade a list of devices in waves (canary first), promoting to the next wave
+        as soon as the current one succeeds and halting once too many devices fail
+    """
+    def __init__(self, template):
+        # template is the RunUpgrade holding the CLI arguments
+        self.template = template
+        self.hosts = []
+        self.regions = {}
+        self.config = {}
+        self.results = {}
+        self.failures = 0
+        self.halted = False
+
+    def setup(self):
+        """ Setup logging, load the device list and rollout settings """
+        logging.basicConfig(filename='rollout.log', level=logging.WARN,
+                            format='%(asctime)s:%(threadName)s: %(message)s')
+        console = logging.StreamHandler()
+        console.setFormatter(logging.Formatter('%(threadName)s: %(message)s'))
+        logging.getLogger().addHandler(console)
+        logging.warn('Rollout logged in rollout.log, each device in <device>_upgrade.log')
+        try:
+            with open(self.template.configfile) as f:
+                self.config = yaml.safe_load(f)
+            devices = load_device_list(self.template.device_list)
+            self.hosts = [host for host, region in devices]
+            self.regions = dict(devices)
+        except Exception as e:
+            logging.warn('ERROR: {0}'.format(e))
+            exit(1)
+
+    def plan_waves(self):
+        """ Split the devices into waves from ROLLOUT_WAVES
+            Each entry is the total number of devices (or % of the fleet) done by the
+            end of that wave, 'rest' takes everything that is left
+        """
+        waves = []
+        done = 0
+        total = len(self.hosts)
+        for size in self.config.get('ROLLOUT_WAVES') or ['rest']:
+            size = str(size).strip()
+            if size == 'rest':
+                target = total
+            elif size.endswith('%'):
+                target = -(-total * int(size[:-1]) // 100)
+            else:
+                target = int(size)
+            target = min(max(target, done + 1), total)
+            if target > done:
+                waves.append(self.hosts[done:target])
+                done = target
+        if done < total:
+            waves.append(self.hosts[done:])
+        return waves
+
+    def max_failures(self, attempted):
+        """ ROLLOUT_MAX_FAILURES as a device count, it may be a % of devices attempted """
+        return max_failures(self.config, attempted)
+
+    def upgrade_device(self, host):
+        """ Run the full upgrade on one device, returns True if it met the success criteria.
+            Every device of a wave has the same transfer priority and shares the bandwidth
+        """
+        up = upgrade_device(host, {'configfile': self.template.configfile,
+                                   'force': self.template.force,
+                                   'issu': self.template.issu,
+                                   'no_install': self.template.no_install,
+                                   'port': self.template.port,
+                                   'site': self.regions.get(host, ''),
+                                   'priority': 0})
+        try:
+            return up.succeeded()
+        except Exception:
+            return False
+
+    def run_wave(self, wave):
+        """ Upgrade one wave, ROLLOUT_PARALLEL devices at a time, stop starting new devices
+            as soon as the failure threshold is crossed
+        """
+        pending = list(wave)
+        running = {}
+        parallel = self.config.get('ROLLOUT_PARALLEL', 10)
+        with ThreadPoolExecutor(max_workers=parallel) as pool:
+            while pending or running:
+                while pending and not self.halted and len(running) < parallel:
+                    host = pending.pop(0)
+                    running[pool.submit(self.upgrade_device, host)] = host
+                if not running:
+                    break
+                future = next(as_completed(running))
+                host = running.pop(future)
+                self.results[host] = future.result()
+                if self.results[host]:
+                    logging.warn('{0}: upgrade succeeded'.format(host))
+                else:
+                    self.failures += 1
+                    logging.warn('{0}: upgrade FAILED'.format(host))
+                    if self.failures > self.max_failures(len(self.results)):
+                        logging.warn('Failure threshold reached, halting rollout...')
+                        self.halted = True
+        for host in pending:
+            self.results[host] = None
+
+    def run(self):
+        """ Run every wave in order """
+        self.setup()
+        waves = self.plan_waves()
+        logging.warn('Rolling out to {0} devices in {1} waves: {2}'.format(
+                     len(self.hosts), len(waves), ', '.join(str(len(w)) for w in waves)))
+        if not self.template.yes_all:
+            logging.warn("------------------------WARNING-----------------------------")
+            logging.warn("Devices will be upgraded without prompting, THIS WILL BE SERVICE IMPACTING!!!")
+            logging.warn("-----------------------------------------------------------")
+            if self.template.input_parse('Start the rollout? (y/n): ') != 'y':
+                exit()
+        for i, wave in enumerate(waves):
+            if self.halted:
+                for host in wave:
+                    self.results[host] = None
+                continue
+            logging.warn('Starting wave {0} of {1} ({2} devices)...'.format(i + 1, len(waves), len(wave)))
+            startTime = datetime.now()
+            self.run_wave(wave)
+            logging.warn('Wave {0} took {1}'.format(i + 1, str(datetime.now() - startTime).split('.')[0]))
+
+        logging.warn("------------------------")
+        logging.warn("|   ROLLOUT RESULTS    |")
+        logging.warn("------------------------")
+        for host in self.hosts:
+            state = {True: 'OK', False: 'FAILED', None: 'SKIPPED'}[self.results.get(host)]
+            logging.warn('{0:<24} {1}'.format(host, state))
+        if self.halted:
+            exit(1)
+
+
+class JobLogHandler(logging.Handler):
+    """ Keep the log lines of one upgrade job for the REST API """
+    def __init__(self, job):
+        logging.Handler.__init__(self)
+        self.job = job
+
+    def emit(self, record):
+        self.job['log'].append(self.format(record))
+
+
+class UpgradeService(object):
+    """ Long-running upgrade service, jobs are submitted over a local REST API, queued by
+        priority (lowest first) and run on a pool of worker threads.  Credentials, config
+        files and the image store are loaded once and shared by every job.
+
+        POST   /jobs              {"device": "...", "priority": 10, "config": "...",
+                                   "no_install": false, "force": false, "issu": false, "port": 830}
+        GET    /jobs              all jobs
+        GET    /jobs/<id>         one job, with its progress events
+        GET    /jobs/<id>/log     job log as text, ?offset=<line> to skip lines, ?follow=1 to stream
+        GET    /transfers         image transfers in progress, actual and allowed throughput
+        DELETE /jobs/<id>         cancel a queued job
+    """
+    # Job options taken from the request body, and their types
+    OPTIONS = {'no_install': bool, 'force': bool, 'issu': bool, 'port': int, 'site': str}
+
+    def __init__(self, template):
+        # template is the RunUpgrade holding the CLI arguments
+        self.template = template
+        self.auth = None
+        self.config = {}
+        self.configs = {}
+        self.jobs = {}
+        self.queue = queue.PriorityQueue()
+        self.lock = threading.Lock()
+        self.seq = 0
+
+    def setup(self):
+        """ Setup logging and load the service settings, credentials are fetched once here """
+        logging.basicConfig(filename='upgrade_service.log', level=logging.WARN,
+                            format='%(asctime)s:%(threadName)s: %(message)s')
+        console = logging.StreamHandler()
+        console.setFormatter(logging.Formatter('%(threadName)s: %(message)s'))
+        logging.getLogger().addHandler(console)
+        self.config = self.load_config(self.template.configfile)
+        self.auth = self.template.auth
+
+    def load_config(self, path):
+        """ Config file contents, cached until the file changes.  Each caller gets its own copy
+            because the upgrade appends to the command lists
+        """
+        try:
+            mtime = os.path.getmtime(path)
+            with self.lock:
+                if path not in self.configs or self.configs[path][0] != mtime:
+                    with open(path) as f:
+                        self.configs[path] = (mtime, yaml.safe_load(f))
+                return copy.deepcopy(self.configs[path][1])
+        except Exception as e:
+            raise ValueError('Issues opening config file "{0}": {1}'.format(path, e))
+
+    def submit(self, request):
+        """ Queue a new job, returns the job (the job priority is also its transfer priority) """
+        if not isinstance(request, dict):
+            raise ValueError('Expected a JSON object')
+        device = request.get('device')
+        if not device or not isinstance(device, str):
+            raise ValueError('"device" is required')
+        configfile = request.get('config') or self.template.configfile
+        self.load_config(configfile)
+        options = {'configfile': configfile}
+        for key, kind in self.OPTIONS.items():
+            value = request.get(key)
+            if value is None:
+                continue
+            if kind is int:
+                try:
+                    if isinstance(value, bool):
+                        raise TypeError(value)
+                    value = int(value)
+                except (TypeError, ValueError):
+                    raise ValueError('"{0}" must be a number'.format(key))
+            elif not isinstance(value, kind):
+                raise ValueError('"{0}" must be {1}'.format(key, 'true or false' if kind is bool else 'a string'))
+            options[key] = value
+        with self.lock:
+            for job in self.jobs.values():
+                if job['device'] == device and job['state'] in ['queued', 'running']:
+                    raise ValueError('{0} already has job {1} {2}'.format(device, job['id'], job['state']))
+            try:
+                priority = int(request.get('priority', 10))
+            except (TypeError, ValueError):
+                raise ValueError('"priority" must be a number')
+            self.seq += 1
+            options['priority'] = priority
+            job = {'id': str(self.seq), 'device': device, 'priority': priority,
+                   'options': options, 'state': 'queued', 'succeeded': None, 'error': None,
+                   'submitted': time.time(), 'started': None, 'finished': None,
+                   'events': [], 'log': []}
+            self.jobs[job['id']] = job
+            self.queue.put((job['priority'], self.seq, job['id']))
+        logging.warn('Job {0} queued for {1} (priority {2})'.format(job['id'], device, job['priority']))
+        return job
+
+    def cancel(self, job_id):
+        """ Cancel a queued job, running jobs can't be stopped safely """
+        with self.lock:
+            job = self.jobs[job_id]
+            if job['state'] != 'queued':
+                raise ValueError('Job {0} is {1}'.format(job_id, job['state']))
+            job['state'] = 'cancelled'
+            job['finished'] = time.time()
+        return job
+
+    def worker(self):
+        """ Take jobs off the queue and run them """
+        name = threading.current_thread().name
+        while True:
+            priority, seq, job_id = self.queue.get()
+            job = self.jobs[job_id]
+            with self.lock:
+                if job['state'] != 'queued':
+                    continue
+                job['state'] = 'running'
+                job['started'] = time.time()
+            handler = JobLogHandler(job)
+            handler.setFormatter(logging.Formatter('%(asctime)s: %(message)s'))
+            handler.addFilter(ThreadFilter(job['device']))
+            logging.getLogger().addHandler(handler)
+            try:
+                options = dict(job['options'])
+                config = self.load_config(options['configfile'])
+                up = upgrade_device(job['device'], options, self.auth, config, job['events'].append)
+                try:
+                    job['succeeded'] = up.succeeded()
+                except Exception:
+                    job['succeeded'] = False
+            except Exception as e:
+                # Keep this worker alive for the next job
+                job['succeeded'] = False
+                job['error'] = str(e)
+                logging.warn('ERROR: {0}'.format(e))
+            finally:
+                logging.getLogger().removeHandler(handler)
+                threading.current_thread().name = name
+            job['state'] = 'succeeded' if job['succeeded'] else 'failed'
+            job['finished'] = time.time()
+            logging.warn('Job {0} for {1} {2}'.format(job_id, job['device'], job['state']))
+
+    def summary(self, job, events=False):
+        """ Job as returned by the API """
+        keys = ['id', 'device', 'priority', 'options', 'state', 'succeeded', 'error',
+                'submitted', 'started', 'finished']
+        out = dict((k, job[k]) for k in keys)
+        out['log_lines'] = len(job['log'])
+        if events:
+            out['events'] = job['events']
+        return out
+
+    def run(self):
+        """ Start the workers and serve the REST API until interrupted """
+        self.setup()
+        for i in range(self.config.get('DAEMON_WORKERS', 4)):
+            threading.Thread(target=self.worker, name='worker-{0}'.format(i), daemon=True).start()
+        listen = (self.config.get('DAEMON_LISTEN', '127.0.0.1'), self.config.get('DAEMON_PORT', 8700))
+        server = ThreadingHTTPServer(listen, UpgradeRequestHandler)
+        server.daemon_threads = True
+        server.service = self
+        logging.warn('Upgrade service listening on http://{0}:{1}/jobs'.format(*listen))
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            logging.warn('Shutting down...')
+        server.server_close()
+
+
+class JSONRequestHandler(BaseHTTPRequestHandler):
+    """ Base for the REST APIs, requests are logged by the services themselves """
+    def log_message(self, fmt, *args):
+        pass
+
+    def send_json(self, code, body):
+        data = json.dumps(body, indent=2).encode()
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def read_json(self):
+        """ Request body, raises ValueError if it isn't a JSON object """
+        length = int(self.headers.get('Content-Length', 0))
+        body = json.loads(self.rfile.read(length) or b'{}')
+        if not isinstance(body, dict):
+            raise ValueError('Expected a JSON object')
+        return body
+
+
+class UpgradeRequestHandler(JSONRequestHandler):
+    """ REST API for UpgradeService """
+
+    def route(self):
+        """ Returns (job id or None, trailing path), raises KeyError for unknown paths / jobs """
+        parts = urlparse(self.path).path.strip('/').split('/')
+        if parts[0] != 'jobs' or len(parts) > 3:
+            raise KeyError(self.path)
+        if len(parts) == 1:
+            return None, ''
+        if parts[1] not in self.server.service.jobs:
+            raise KeyError(parts[1])
+        return parts[1], '/'.join(parts[2:])
+
+    def do_GET(self):
+        service = self.server.service
+        if urlparse(self.path).path.rstrip('/') == '/transfers':
+            return self.send_json(200, transfer_scheduler(service.config).status())
+        try:
+            job_id, sub = self.route()
+        except KeyError as e:
+            return self.send_json(404, {'error': 'Not found: {0}'.format(e)})
+        if job_id is None:
+            return self.send_json(200, [service.summary(j) for j in service.jobs.values()])
+        job = service.jobs[job_id]
+        if not sub:
+            return self.send_json(200, service.summary(job, events=True))
+        if sub != 'log':
+            return self.send_json(404, {'error': 'Not found: ' + sub})
+        query = parse_qs(urlparse(self.path).query)
+        try:
+            offset = int(query.get('offset', ['0'])[0])
+            if offset < 0:
+                raise ValueError(offset)
+        except ValueError:
+            return self.send_json(400, {'error': '"offset" must be a line number'})
+        follow = query.get('follow', ['0'])[0] == '1'
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain')
+        self.end_headers()
+        # Stream new lines until the job is done when following
+        try:
+            while True:
+                lines = job['log'][offset:]
+                for line in lines:
+                    self.wfile.write((line + '\n').encode())
+                offset += len(lines)
+                self.wfile.flush()
+                if not follow or job['state'] not in ['queued', 'running']:
+                    break
+                time.sleep(1)
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+    def do_POST(self):
+        try:
+            job_id, sub = self.route()
+            if job_id is not None:
+                raise KeyError(self.path)
+        except KeyError as e:
+            return self.send_json(404, {'error': 'Not found: {0}'.format(e)})
+        try:
+            job = self.server.service.submit(self.read_json())
+        except ValueError as e:
+            return self.send_json(400, {'error': str(e)})
+        self.send_json(201, self.server.service.summary(job))
+
+    def do_DELETE(self):
+        try:
+            job_id, sub = self.route()
+            job = self.server.service.cancel(job_id)
+        except KeyError as e:
+            return self.send_json(404, {'error': 'Not found: {0}'.format(e)})
+        except ValueError as e:
+            return self.send_json(409, {'error': str(e)})
+        self.send_json(200, self.server.service.summary(job))
+
+
+class Coordinator(object):
+    """ Hand a list of devices out to workers running close to them, by region / site.
+        Workers pull assignments over HTTP, send heartbeats with their progress and report
+        each result.  A device whose worker stops sending heartbeats is marked lost, not retried.
+        A worker without a region takes any device.  Devices of a region no worker has asked
+        for in COORDINATOR_LEASE seconds are skipped.
+
+        POST /assign     {"worker": "...", "region": "..."}   next device, {"wait": true} or {"done": true}
+        POST /heartbeat  {"worker": "...", "devices": {host: [progress events]}}
+        POST /report     {"worker": "...", "device": "...", "succeeded": true, "telemetry": {...}}
+        GET  /status     every device and worker
+    """
+    def __init__(self, template):
+        # template is the RunUpgrade holding the CLI arguments
+        self.template = template
+        self.config = {}
+        self.devices = {}
+        self.order = []
+        self.workers = {}
+        self.failures = 0
+        self.halted = False
+        self.lock = threading.Lock()
+        self.finished = threading.Event()
+        self.started = time.time()
+        # Regions already warned about having no worker
+        self.unserved = set()
+
+    def setup(self):
+        """ Setup logging, load the device list and coordinator settings """
+        logging.basicConfig(filename='coordinator.log', level=logging.WARN,
+                            format='%(asctime)s:%(threadName)s: %(message)s')
+        logging.getLogger().addHandler(logging.StreamHandler())
+        try:
+            with open(self.template.configfile) as f:
+                self.config = yaml.safe_load(f)
+            for host, region in load_device_list(self.template.device_list):
+                self.devices[host] = {'device': host, 'region': region, 'state': 'pending',
+                                      'worker': '', 'assigned': None, 'last_seen': None,
+                                      'events': [], 'telemetry': {}}
+                self.order.append(host)
+            max_failures(self.config, 0)
+        except Exception as e:
+            logging.warn('ERROR: {0}'.format(e))
+            exit(1)
+        # Anyone who can reach the coordinator could report results or pull assignments
+        listen = self.config.get('COORDINATOR_LISTEN', '0.0.0.0')
+        try:
+            loopback = listen == 'localhost' or ipaddress.ip_address(listen).is_loopback
+        except ValueError:
+            loopback = False
+        if not loopback and not self.config.get('COORDINATOR_TOKEN'):
+            logging.warn('ERROR: Set COORDINATOR_TOKEN to listen on {0}'.format(listen))
+            exit(1)
+
+    def options(self):
+        """ Upgrade options sent to the workers with each device """
+        return {'force': self.template.force, 'issu': self.template.issu,
+                'no_install': self.template.no_install}
+
+    def check_leases(self):
+        """ Mark devices lost when their worker has gone quiet (call with the lock held) """
+        lease = self.config.get('COORDINATOR_LEASE', 600)
+        for dev in self.devices.values():
+            if dev['state'] == 'assigned' and time.time() - dev['last_seen'] > lease:
+                logging.warn('{0}: no heartbeat from {1} for {2}s, marking lost'.format(
+                             dev['device'], dev['worker'], lease))
+                self.finish(dev, 'lost')
+        self.check_unserved()
+
+    def check_unserved(self):
+        """ Warn about pending devices no worker takes, skip them once no worker for their region
+            has asked for COORDINATOR_LEASE seconds (call with the lock held)
+        """
+        if self.halted:
+            return
+        lease = self.config.get('COORDINATOR_LEASE', 600)
+        regions = set(d['region'] for d in self.devices.values() if d['state'] == 'pending')
+        for region in sorted(regions):
+            seen = [w['last_seen'] for w in self.workers.values() if self.serves(w['region'], region)]
+            idle = time.time() - max(seen + [self.started])
+            if idle > lease:
+                for dev in self.devices.values():
+                    if dev['state'] == 'pending' and dev['region'] == region:
+                        logging.warn('{0}: no worker for {1} in {2}s, skipping'.format(
+                                     dev['device'], region, lease))
+                        self.finish(dev, 'skipped')
+            elif idle > self.config.get('WORKER_POLL', 10) * 3 and region not in self.unserved:
+                logging.warn('WARNING: No worker is taking devices in {0}, they are skipped after {1}s'.format(
+                             region, lease))
+                self.unserved.add(region)
+            elif idle <= self.config.get('WORKER_POLL', 10) * 3:
+                self.unserved.discard(region)
+
+    def serves(self, worker_region, region):
+        """ Can a worker of worker_region take devices of region? """
+        return not worker_region or not region or worker_region == region
+
+    def finish(self, dev, state):
+        """ Record a final device state (call with the lock held) """
+        dev['state'] = state
+        if state not in ['succeeded', 'skipped']:
+            self.failures += 1
+            attempted = len([d for d in self.devices.values() if d['state'] not in ['pending', 'assigned']])
+            if not self.halted and self.failures > max_failures(self.config, attempted):
+                logging.warn('Failure threshold reached, no more devices will be assigned...')
+                self.halted = True
+        if all(d['state'] not in ['pending', 'assigned'] for d in self.devices.values()) or \
+                (self.halted and all(d['state'] != 'assigned' for d in self.devices.values())):
+            self.finished.set()
+
+    def seen(self, worker, region=None):
+        """ Track a worker (call with the lock held) """
+        info = self.workers.setdefault(worker, {'region': region or '', 'succeeded': 0,
+                                                'failed': 0, 'active': []})
+        if region is not None:
+            info['region'] = region
+        info['last_seen'] = time.time()
+        for host in info['active']:
+            self.devices[host]['last_seen'] = time.time()
+        return info
+
+    def assign(self, request):
+        """ Next device for a worker, its own region first then devices with no region.
+            A worker without a region takes any device
+        """
+        worker = request.get('worker', '')
+        region = request.get('region', '')
+        with self.lock:
+            info = self.seen(worker, region)
+            self.check_leases()
+            if not self.halted:
+                for match in ([region, ''] if region else [None]):
+                    for host in self.order:
+                        dev = self.devices[host]
+                        if dev['state'] == 'pending' and match in [None, dev['region']]:
+                            dev.update({'state': 'assigned', 'worker': worker,
+                                        'assigned': time.time(), 'last_seen': time.time()})
+                            info['active'].append(host)
+                            logging.warn('{0}: assigned to {1} ({2})'.format(host, worker, region or 'any region'))
+                            # Every assigned device is in the same window, share the bandwidth
+                            options = dict(self.options(), site=dev['region'], priority=0)
+                            return {'device': host, 'options': options}
+            pending = [d for d in self.devices.values() if d['state'] == 'pending' and
+                       self.serves(region, d['region']) and not self.halted]
+            if pending or not self.finished.is_set():
+                return {'wait': True}
+            return {'done': True}
+
+    def heartbeat(self, request):
+        """ Progress from a worker """
+        with self.lock:
+            self.seen(request.get('worker', ''))
+            for host, events in request.get('devices', {}).items():
+                if host in self.devices:
+                    self.devices[host]['events'].extend(events)
+        return {'ok': True}
+
+    def report(self, request):
+        """ Result of one device from a worker """
+        worker = request.get('worker', '')
+        host = request.get('device', '')
+        with self.lock:
+            info = self.seen(worker)
+            dev = self.devices.get(host)
+            if not dev or dev['state'] != 'assigned' or dev['worker'] != worker:
+                raise ValueError('{0} is not assigned to {1}'.format(host, worker))
+            info['active'].remove(host)
+            dev['telemetry'] = request.get('telemetry', {})
+            if request.get('succeeded'):
+                info['succeeded'] += 1
+                state = 'succeeded'
+            else:
+                info['failed'] += 1
+                state = 'failed'
+            logging.warn('{0}: {1} on {2} ({3})'.format(host, state, worker,
+                         ', '.join('{0}={1}'.format(k, v) for k, v in sorted(dev['telemetry'].items()))))
+            self.finish(dev, state)
+        return {'ok': True}
+
+    def status(self):
+        """ Every device and worker """
+        with self.lock:
+            self.check_leases()
+            return {'halted': self.halted,
+                    'devices': [dict(self.devices[h], events=len(self.devices[h]['events']))
+                                for h in self.order],
+                    'workers': self.workers}
+
+    def run(self):
+        """ Serve the workers until every device is done """
+        self.setup()
+        listen = (self.config.get('COORDINATOR_LISTEN', '0.0.0.0'), self.config.get('COORDINATOR_PORT', 8701))
+        server = ThreadingHTTPServer(listen, CoordinatorRequestHandler)
+        server.daemon_threads = True
+        server.service = self
+        threading.Thread(target=server.serve_forever, name='http', daemon=True).start()
+        logging.warn('Coordinating {0} devices on http://{1}:{2}'.format(len(self.order), *listen))
+        try:
+            while not self.finished.wait(30):
+                with self.lock:
+                    self.check_leases()
+        except KeyboardInterrupt:
+            logging.warn('Interrupted, devices still assigned will finish on their workers...')
+        # Give the workers time to pick up the done message
+        time.sleep(self.config.get('WORKER_POLL', 10) * 2)
+        server.shutdown()
+
+        logging.warn("------------------------")
+        logging.warn("| COORDINATOR RESULTS  |")
+        logging.warn("------------------------")
+        for host in self.order:
+            dev = self.devices[host]
+            logging.warn('{0:<24} {1:<10} {2:<10} {3}'.format(host, dev['region'], dev['state'], dev['worker']))
+        if self.halted or self.failures or [d for d in self.devices.values() if d['state'] == 'skipped']:
+            exit(1)
+
+
+class CoordinatorRequestHandler(JSONRequestHandler):
+    """ HTTP API for Coordinator """
+    def authorized(self):
+        token = self.server.service.config.get('COORDINATOR_TOKEN')
+        if token and self.headers.get('X-Upgrade-Token') != token:
+            self.send_json(403, {'error': 'Bad or missing X-Upgrade-Token'})
+            return False
+        return True
+
+    def do_GET(self):
+        if not self.authorized():
+            return
+        if self.path.rstrip('/') != '/status':
+            return self.send_json(404, {'error': 'Not found: ' + self.path})
+        self.send_json(200, self.server.service.status())
+
+    def do_POST(self):
+        if not self.authorized():
+            return
+        service = self.server.service
+        routes = {'/assign': service.assign, '/heartbeat': service.heartbeat, '/report': service.report}
+        if self.path.rstrip('/') not in routes:
+            return self.send_json(404, {'error': 'Not found: ' + self.path})
+        try:
+            self.send_json(200, routes[self.path.rstrip('/')](self.read_json()))
+        except ValueError as e:
+            self.send_json(400, {'error': str(e)})
+
+
+class UpgradeWorker(object):
+    """ Upgrade the devices a Coordinator assigns to this host's region, WORKER_PARALLEL at a
+        time, sending progress as heartbeats and reporting each result with its telemetry
+    """
+    def __init__(self, template):
+        # template is the RunUpgrade holding the CLI arguments
+        self.template = template
+        self.url = template.worker_url.rstrip('/')
+        self.name = '{0}-{1}'.format(socket.gethostname(), os.getpid())
+        self.config = {}
+        self.events = {}
+        self.lock = threading.Lock()
+        self.done = threading.Event()
+
+    def setup(self):
+        """ Setup logging and load the config, the worker uses its own config file
+            (CODE_FOLDER etc. are local to this host)
+        """
+        logging.basicConfig(filename='worker.log', level=logging.WARN,
+                            format='%(asctime)s:%(threadName)s: %(message)s')
+        console = logging.StreamHandler()
+        console.setFormatter(logging.Formatter('%(threadName)s: %(message)s'))
+        logging.getLogger().addHandler(console)
+        try:
+            with open(self.template.configfile) as f:
+                self.config = yaml.safe_load(f)
+        except Exception as e:
+            logging.warn('ERROR: Issues opening config file "{0}": {1}'.format(self.template.configfile, e))
+            exit(1)
+
+    def call(self, path, body):
+        """ POST to the coordinator, retried while it is unreachable or failing (5xx).
+            A rejected request (4xx) is logged and dropped, returns None
+        """
+        data = json.dumps(body).encode()
+        headers = {'Content-Type': 'application/json'}
+        if self.config.get('COORDINATOR_TOKEN'):
+            headers['X-Upgrade-Token'] = self.config['COORDINATOR_TOKEN']
+        for attempt in range(10):
+            try:
+                with urlopen(Request(self.url + path, data=data, headers=headers), timeout=60) as rsp:
+                    return json.loads(rsp.read())
+            except HTTPError as e:
+                if e.code < 500:
+                    logging.warn('Coordinator rejected {0}: {1} {2}'.format(path, e, e.read().decode(errors='replace')))
+                    return None
+                logging.warn('Coordinator {0}{1}: {2}'.format(self.url, path, e))
+                time.sleep(min(5 * (attempt + 1), 30))
+            except (IOError, ValueError) as e:
+                logging.warn('Coordinator {0}{1}: {2}'.format(self.url, path, e))
+                time.sleep(min(5 * (attempt + 1), 30))
+        raise IOError('Coordinator unreachable: ' + self.url)
+
+    def progress(self, event):
+        """ Queue a progress event for the next heartbeat """
+        with self.lock:
+            self.events.setdefault(event['host'], []).append(event)
+
+    def heartbeat(self):
+        """ Send progress every WORKER_HEARTBEAT seconds, this also keeps the leases alive """
+        while not self.done.wait(self.config.get('WORKER_HEARTBEAT', 30)):
+            with self.lock:
+                events, self.events = self.events, {}
+            try:
+                self.call('/heartbeat', {'worker': self.name, 'devices': events})
+            except IOError:
+                pass
+
+    def slot(self):
+        """ Keep asking for devices until the coordinator is done """
+        name = threading.current_thread().name
+        while True:
+            task = self.call('/assign', {'worker': self.name, 'region': self.template.region})
+            if task is None:
+                logging.warn('ERROR: Assignment refused, stopping this slot')
+                return
+            if task.get('done'):
+                return
+            if task.get('wait'):
+                time.sleep(self.config.get('WORKER_POLL', 10))
+                continue
+            host = task['device']
+            options = dict(task.get('options', {}), configfile=self.template.configfile,
+                           port=self.template.port)
+            options['site'] = options.get('site') or self.template.region
+            startTime = datetime.now()
+            up = upgrade_device(host, options, self.template.auth, copy.deepcopy(self.config), self.progress)
+            threading.current_thread().name = name
+            try:
+                succeeded = up.succeeded()
+            except Exception:
+                succeeded = False
+            telemetry = {'duration': str(datetime.now() - startTime).split('.')[0],
+                         'version': getattr(up, 'dev', None) and up.dev.facts['version'] or '',
+                         'health_ok': up.health_ok, 'core_dumps': up.core_dumps,
+                         'version_match': up.version_match, 'rolled_back': up.rolled_back}
+            with self.lock:
+                events = self.events.pop(host, [])
+            if events:
+                telemetry['last_phase'] = events[-1]['phase']
+            self.call('/report', {'worker': self.name, 'device': host,
+                                  'succeeded': succeeded, 'telemetry': telemetry})
+
+    def run(self):
+        """ Run WORKER_PARALLEL assignment slots until the coordinator is done """
+        self.setup()
+        logging.warn('Worker {0} ({1}) taking devices from {2}'.format(
+                     self.name, self.template.region or 'any region', self.url))
+        threading.Thread(target=self.heartbeat, name='heartbeat', daemon=True).start()
+        slots = self.config.get('WORKER_PARALLEL', 4)
+        with ThreadPoolExecutor(max_workers=slots) as pool:
+            futures = [pool.submit(self.slot) for i in range(slots)]
+            for future in as_completed(futures):
+                try:
+                    future.result()
+                except IOError as e:
+                    logging.warn('ERROR: {0}'.format(e))
+        self.done.set()
+        logging.warn('Coordinator is done, exiting...')
+
+
+if __name__ == '__main__':
+    execute = RunUpgrade()
+    # 1. Get CLI Input / Print Usage Info
+    execute.get_arguments()
+    if execute.daemon:
+        # Take upgrade jobs over the REST API
+        UpgradeService(execute).run()
+    elif execute.worker_url:
+        # Upgrade the devices a coordinator hands out
+        UpgradeWorker(execute).run()
+    elif execute.coordinator:
+        # Hand a list of devices out to workers by region
+        Coordinator(execute).run()
+    elif execute.device_list:
+        # Upgrade a list of devices in waves
+        RolloutController(execute).run()
+    else:
+        # 2. Setup Logging / Ensure Image is on local server
+        execute.initial_setup()
+        # 3-15. Upgrade the device
+        execute.run()
@@ -0,0 +1,4 @@
+import os, sys
+
+# junos_upgrade.py is a script, not a package
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
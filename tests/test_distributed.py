@@ -0,0 +1,233 @@
+"""
+    Tests for the coordinator and its workers, run as threads on loopback with stand-in
+    device upgrades
+"""
+
+import json, logging, socket, threading, time
+from urllib.error import HTTPError
+from urllib.request import Request, urlopen
+import pytest
+import yaml
+
+import junos_upgrade as ju
+
+
+class StandInUpgrade(object):
+    """ Stand-in for upgrade_device, devices named fail-* fail """
+    def __init__(self, seconds=0.1):
+        self.seconds = seconds
+        self.upgraded = []
+
+    def __call__(self, host, options, auth=None, config=None, progress=None):
+        threading.current_thread().name = host
+        self.upgraded.append((host, options))
+        progress({'host': host, 'phase': 'installing', 'msg': 'Installing package', 'time': time.time()})
+        time.sleep(self.seconds)
+        progress({'host': host, 'phase': 'installed', 'msg': 'Installed', 'time': time.time()})
+        up = ju.RunUpgrade(auth)
+        up.completed = not host.startswith('fail-')
+        up.no_install = True
+        return up
+
+
+def free_port():
+    s = socket.socket()
+    s.bind(('127.0.0.1', 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+
+class Cluster(object):
+    """ A coordinator and its workers, each in a thread """
+    def __init__(self, tmp_path, devices, **config):
+        self.tmp_path = tmp_path
+        self.config = dict({'COORDINATOR_LISTEN': '127.0.0.1', 'COORDINATOR_PORT': free_port(),
+                            'COORDINATOR_LEASE': 5, 'WORKER_POLL': 0.05, 'WORKER_HEARTBEAT': 0.05,
+                            'WORKER_PARALLEL': 2, 'ROLLOUT_MAX_FAILURES': 10}, **config)
+        self.configfile = self.write('config.yml', yaml.safe_dump(self.config))
+        self.device_list = self.write('devices.txt', ''.join(' '.join(d) + '\n' for d in devices))
+        self.url = 'http://127.0.0.1:{0}'.format(self.config['COORDINATOR_PORT'])
+        self.coordinator = ju.Coordinator(self.template(device_list=self.device_list, coordinator=True))
+        self.exit_code = None
+        self.threads = []
+
+    def write(self, name, text):
+        path = str(self.tmp_path / name)
+        with open(path, 'w') as f:
+            f.write(text)
+        return path
+
+    def template(self, **args):
+        template = ju.RunUpgrade(auth={'username': 'u', 'password': 'p'})
+        template.configfile = self.configfile
+        template.yes_all = True
+        for key, value in args.items():
+            setattr(template, key, value)
+        return template
+
+    def start(self):
+        def run():
+            try:
+                self.coordinator.run()
+                self.exit_code = 0
+            except SystemExit as e:
+                self.exit_code = e.code
+        self.start_thread(run)
+        self.wait_for(lambda: self.coordinator.devices and self.call('/status'))
+
+    def worker(self, name, region='', **config):
+        if config:
+            self.configfile = self.write(name + '.yml', yaml.safe_dump(dict(self.config, **config)))
+        worker = ju.UpgradeWorker(self.template(worker_url=self.url, region=region))
+        worker.name = name
+        self.start_thread(worker.run)
+        return worker
+
+    def start_thread(self, target):
+        thread = threading.Thread(target=target, daemon=True)
+        thread.start()
+        self.threads.append(thread)
+
+    def call(self, path, body=None, token=None):
+        headers = {'X-Upgrade-Token': token} if token else {}
+        data = json.dumps(body).encode() if body is not None else None
+        try:
+            with urlopen(Request(self.url + path, data=data, headers=headers), timeout=10) as rsp:
+                return json.loads(rsp.read())
+        except HTTPError as e:
+            return e.code
+        except IOError:
+            return None
+
+    def wait_for(self, condition, timeout=20):
+        end = time.time() + timeout
+        while not condition():
+            assert time.time() < end, 'timed out'
+            time.sleep(0.02)
+
+    def join(self, timeout=20):
+        for thread in self.threads:
+            thread.join(timeout)
+            assert not thread.is_alive()
+
+    def states(self):
+        return dict((h, d['state']) for h, d in self.coordinator.devices.items())
+
+
+@pytest.fixture
+def cluster(tmp_path, monkeypatch):
+    upgrade = StandInUpgrade()
+    monkeypatch.setattr(ju, 'upgrade_device', upgrade)
+    handlers = list(logging.getLogger().handlers)
+    clusters = []
+
+    def make(devices, **config):
+        c = Cluster(tmp_path, devices, **config)
+        c.upgrade = upgrade
+        clusters.append(c)
+        return c
+    yield make
+    for handler in logging.getLogger().handlers[len(handlers):]:
+        logging.getLogger().removeHandler(handler)
+
+
+DEVICES = [('east-1', 'us-east'), ('east-2', 'us-east'), ('west-1', 'us-west'), ('any-1',)]
+
+
+def test_assign_by_region(cluster):
+    c = cluster(DEVICES)
+    c.start()
+    c.worker('w-east', 'us-east')
+    c.worker('w-west', 'us-west')
+    c.join()
+    assert c.exit_code == 0
+    assert set(c.states().values()) == set(['succeeded'])
+    workers = dict((h, d['worker']) for h, d in c.coordinator.devices.items())
+    assert workers['east-1'] == workers['east-2'] == 'w-east'
+    assert workers['west-1'] == 'w-west'
+    # The region is the transfer site
+    sites = dict((h, o['site']) for h, o in c.upgrade.upgraded)
+    assert sites['east-1'] == sites['east-2'] == 'us-east'
+    assert sites['west-1'] == 'us-west'
+
+
+def test_worker_without_region_takes_any_device(cluster):
+    c = cluster(DEVICES)
+    c.start()
+    c.worker('w-any')
+    c.join()
+    assert c.exit_code == 0
+    assert set(d['worker'] for d in c.coordinator.devices.values()) == set(['w-any'])
+
+
+def test_heartbeat_and_report(cluster):
+    c = cluster([('east-1', 'us-east')])
+    c.upgrade.seconds = 0.5
+    c.start()
+    c.worker('w-east', 'us-east')
+    # Progress arrives in heartbeats while the device is upgrading
+    c.wait_for(lambda: c.coordinator.devices['east-1']['events'])
+    assert c.coordinator.devices['east-1']['state'] == 'assigned'
+    c.join()
+    dev = c.coordinator.devices['east-1']
+    assert dev['events'][0]['phase'] == 'installing'
+    assert dev['telemetry']['last_phase'] == 'installed'
+    assert dev['telemetry']['health_ok'] is True
+    assert c.coordinator.workers['w-east']['succeeded'] == 1
+
+
+def test_lease_expiry(cluster):
+    c = cluster([('east-1', 'us-east'), ('east-2', 'us-east')], COORDINATOR_LEASE=0.3)
+    c.upgrade.seconds = 1
+    c.start()
+    # A worker that takes a device and is never heard from again
+    assert c.call('/assign', {'worker': 'gone', 'region': 'us-east'})['device'] == 'east-1'
+    # Heartbeats keep the device of a live worker past the lease
+    c.worker('w-east', 'us-east')
+    c.wait_for(lambda: c.call('/status') and c.states()['east-1'] == 'lost')
+    assert c.states()['east-2'] == 'assigned'
+    assert c.call('/report', {'worker': 'gone', 'device': 'east-1', 'succeeded': True}) == 400
+    c.join()
+    assert c.states() == {'east-1': 'lost', 'east-2': 'succeeded'}
+    assert c.exit_code == 1
+
+
+def test_region_without_worker_is_skipped(cluster):
+    c = cluster(DEVICES, COORDINATOR_LEASE=1)
+    c.start()
+    c.worker('w-east', 'us-east')
+    c.join()
+    assert c.states() == {'east-1': 'succeeded', 'east-2': 'succeeded', 'west-1': 'skipped',
+                          'any-1': 'succeeded'}
+    assert c.coordinator.failures == 0 and c.exit_code == 1
+    assert 'us-west' in c.coordinator.unserved
+
+
+def test_token(cluster):
+    c = cluster(DEVICES, COORDINATOR_TOKEN='s3cret')
+    c.start()
+    assert c.call('/status') == 403
+    assert c.call('/assign', {'worker': 'w', 'region': 'us-east'}, token='wrong') == 403
+    assert c.call('/status', token='s3cret')['halted'] is False
+    # A worker with the wrong token gives up instead of retrying
+    worker = c.worker('w-bad', 'us-east', COORDINATOR_TOKEN='wrong')
+    c.wait_for(lambda: worker.done.is_set())
+    assert set(c.states().values()) == set(['pending'])
+
+
+def test_token_required_off_loopback(cluster):
+    c = cluster(DEVICES, COORDINATOR_LISTEN='0.0.0.0')
+    with pytest.raises(SystemExit):
+        c.coordinator.setup()
+
+
+def test_failure_threshold(cluster):
+    devices = [('fail-1', 'us-east'), ('fail-2', 'us-east'), ('east-3', 'us-east'), ('east-4', 'us-east')]
+    c = cluster(devices, ROLLOUT_MAX_FAILURES='25%', WORKER_PARALLEL=1)
+    c.start()
+    c.worker('w-east', 'us-east')
+    c.join()
+    assert c.coordinator.halted and c.exit_code == 1
+    # 1 failure of 1 attempted is over 25%, nothing else is assigned
+    assert c.states() == {'fail-1': 'failed', 'fail-2': 'pending', 'east-3': 'pending', 'east-4': 'pending'}
@@ -0,0 +1,85 @@
+"""
+    Tests for the parallel post-reboot health checks, against stand-in checks
+"""
+
+import time
+import pytest
+
+import junos_upgrade as ju
+
+
+class StandInDevice(object):
+    timeout = 30
+
+
+def results(*values):
+    """ A check returning each of values in turn, then the last one forever """
+    calls = []
+
+    def check(up):
+        calls.append(time.time())
+        return values[min(len(calls), len(values)) - 1]
+    check.calls = calls
+    return check
+
+
+@pytest.fixture
+def upgrade(monkeypatch):
+    def make(checks, blocking, timeout=30, interval=0.05):
+        for name, func in checks.items():
+            monkeypatch.setitem(ju.HEALTH_CHECKS, name, {'func': func, 'blocking': name in blocking,
+                                                         'baseline': None})
+        up = ju.RunUpgrade(auth={'username': 'u', 'password': 'p'})
+        up.dev = StandInDevice()
+        up.config = {'HEALTH_CHECKS': list(checks), 'HEALTH_CHECK_BLOCKING': blocking,
+                     'HEALTH_CHECK_TIMEOUT': timeout, 'HEALTH_CHECK_INTERVAL': interval}
+        return up
+    return make
+
+
+def test_all_pass(upgrade):
+    up = upgrade({'a': results((True, 'ok')), 'b': results((None, 'wait'), (True, 'ok'))}, ['a', 'b'])
+    assert up.run_health_checks() == []
+
+
+def test_blocking_failure_stops_early(upgrade):
+    slow = results((None, 'coming up'))
+    up = upgrade({'bad': results((None, 'wait'), (False, 'FPC 0 offline')), 'slow': slow}, ['bad', 'slow'])
+    start = time.time()
+    assert up.run_health_checks() == ['bad']
+    assert time.time() - start < 5
+    # The other checks are stopped
+    calls = len(slow.calls)
+    time.sleep(0.2)
+    assert len(slow.calls) <= calls + 1
+
+
+def test_retry_until_deadline(upgrade):
+    check = results((None, 'RE1 not present'))
+    up = upgrade({'re': check}, ['re'], timeout=0.5, interval=0.1)
+    assert up.run_health_checks() == ['re']
+    assert 3 <= len(check.calls) <= 6
+
+
+def test_exceptions_are_retried(upgrade):
+    def flaky(up, calls=[]):
+        calls.append(1)
+        if len(calls) < 3:
+            raise IOError('connection reset')
+        return True, 'ok'
+    up = upgrade({'flaky': flaky}, ['flaky'])
+    assert up.run_health_checks() == []
+
+
+def test_non_blocking_not_waited_for(upgrade):
+    up = upgrade({'re': results((None, 'wait'), (True, 'ok')),
+                  'interfaces': results((None, 'ge-0/0/1 down'))}, ['re'])
+    start = time.time()
+    assert up.run_health_checks() == []
+    assert time.time() - start < 5
+
+
+def test_non_blocking_failure_only_warns(upgrade):
+    up = upgrade({'re': results((None, 'wait'), (None, 'wait'), (True, 'ok')),
+                  'alarms': results((False, 'new major alarm'))}, ['re'])
+    assert up.run_health_checks() == []
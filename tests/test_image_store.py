@@ -0,0 +1,89 @@
+"""
+    Tests for the content-addressed image store
+"""
+
+import os, time, hashlib
+import pytest
+
+import junos_upgrade as ju
+
+
+def write(path, data):
+    with open(path, 'wb') as f:
+        f.write(data)
+    return path
+
+
+def test_store_dedup_and_resolve(tmp_path):
+    store = ju.ImageStore(str(tmp_path / 'store'))
+    sha = store.add(write(str(tmp_path / 'a.tgz'), b'image'), 'a.tgz')
+    assert store.add(write(str(tmp_path / 'b.tgz'), b'image'), 'b.tgz') == sha
+    assert sha == hashlib.sha256(b'image').hexdigest()
+    assert store.names() == ['a.tgz', 'b.tgz']
+    assert open(store.resolve('b.tgz'), 'rb').read() == b'image'
+    assert store.resolve('missing.tgz') is None
+
+
+def test_store_corrupt_object_removed(tmp_path):
+    store = ju.ImageStore(str(tmp_path / 'store'))
+    sha = store.add(write(str(tmp_path / 'a.tgz'), b'image'), 'a.tgz')
+    os.remove(str(tmp_path / 'a.tgz'))
+    write(store.object_path(sha), b'corrupt')
+    # A fresh process has not verified the object yet
+    store = ju.ImageStore(str(tmp_path / 'store'))
+    assert store.resolve('a.tgz') is None
+    assert store.names() == []
+
+
+def fill_store(tmp_path, names, quota):
+    store = ju.ImageStore(str(tmp_path / 'store'), quota)
+    shas = {}
+    for name in names:
+        # Not hard linked to a file outside the store
+        shas[name] = store.add(write(str(tmp_path / name), name.encode() * 100), name)
+        os.remove(str(tmp_path / name))
+        time.sleep(0.01)
+    return store, shas
+
+
+def test_store_evicts_lru(tmp_path):
+    store, shas = fill_store(tmp_path, ['a.tgz', 'b.tgz', 'c.tgz'], 1000)
+    store.resolve('a.tgz')
+    store.evict()
+    assert store.names() == ['a.tgz', 'c.tgz']
+
+
+def test_store_keeps_pinned_and_held(tmp_path):
+    store, shas = fill_store(tmp_path, ['a.tgz', 'b.tgz', 'c.tgz'], 700)
+    store.resolve('b.tgz', hold=True)
+    store.evict(pinned=['a.tgz'])
+    assert store.names() == ['a.tgz', 'b.tgz']
+    store.unhold(shas['b.tgz'])
+    store.evict(pinned=['a.tgz'])
+    assert store.names() == ['a.tgz']
+
+
+def test_store_hard_links_are_free(tmp_path):
+    store = ju.ImageStore(str(tmp_path / 'store'), 1)
+    store.add(write(str(tmp_path / 'a.tgz'), b'image'), 'a.tgz')
+    if os.stat(str(tmp_path / 'a.tgz')).st_nlink == 1:
+        pytest.skip('no hard links on this filesystem')
+    store.evict()
+    assert store.names() == ['a.tgz']
+
+
+def test_device_holds_images_until_released(tmp_path):
+    folder = str(tmp_path / 'code') + '/'
+    os.makedirs(folder)
+    up = ju.RunUpgrade(auth={'username': 'u', 'password': 'p'})
+    up.config = {'CODE_FOLDER': folder}
+    store = ju.ImageStore(str(tmp_path / 'store'), 1)
+    write(folder + 'a.tgz', b'image')
+    path = up.store_image(store, 'a.tgz')
+    os.remove(folder + 'a.tgz')
+    assert up.store_image(store, 'missing.tgz') == ''
+    store.evict()
+    assert store.names() == ['a.tgz'] and os.path.isfile(path)
+    up.release_images()
+    store.evict()
+    assert store.names() == []
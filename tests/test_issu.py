@@ -0,0 +1,130 @@
+"""
+    Tests for the ISSU pre-checks and the fallback to the standard dual-RE upgrade,
+    against a stand-in dual-RE device
+"""
+
+from lxml import etree
+import pytest
+
+import junos_upgrade as ju
+
+
+def reply(xml):
+    """ First element of an rpc-reply, like the RPCs return them """
+    return etree.fromstring('<rpc-reply>{0}</rpc-reply>'.format(xml))[0]
+
+
+class StandInRpc(object):
+    def __init__(self, device):
+        self.device = device
+
+    def get_config(self, filter_xml):
+        gres = '<redundancy><graceful-switchover/></redundancy>' if self.device.gres else ''
+        return etree.fromstring('<configuration><chassis>{0}</chassis></configuration>'.format(gres)) \
+            if gres else etree.fromstring('<configuration/>')
+
+    def get_nonstop_routing_information(self):
+        return reply('<nonstop-routing-information><nonstop-routing-enabled>{0}</nonstop-routing-enabled>'
+                     '</nonstop-routing-information>'.format(self.device.nsr))
+
+    def get_routing_task_replication_state(self):
+        return reply('<task-replication-state>' + ''.join(
+                     '<task-protocol-replication-name>{0}</task-protocol-replication-name>'
+                     '<task-protocol-replication-state>{1}</task-protocol-replication-state>'.format(p, s)
+                     for p, s in self.device.replication.items()) + '</task-replication-state>')
+
+    def check_in_service_upgrade(self, package_name):
+        self.device.calls.append(('check', package_name))
+        if self.device.validation is None:
+            raise ju.RpcError()
+        return reply('<output>ISSU check</output>' + ('<success/>' if self.device.validation else ''))
+
+    def request_package_in_service_upgrade(self, package_name, force):
+        self.device.calls.append(('issu', package_name))
+        raise ju.RpcError()
+
+
+class StandInDevice(object):
+    """ Dual-RE device ready for ISSU unless told otherwise """
+    def __init__(self, **state):
+        self.facts = {'2RE': True, 'version': '16.1R6', 'version_RE0': '16.1R6', 'version_RE1': '16.1R6'}
+        self.gres = True
+        self.nsr = 'Enabled'
+        self.replication = {'BGP': 'Complete', 'OSPF': 'Complete'}
+        self.validation = True
+        self.timeout = 30
+        self.calls = []
+        self.__dict__.update(state)
+        self.rpc = StandInRpc(self)
+
+    def probe(self):
+        return True
+
+    def open(self):
+        pass
+
+    def close(self):
+        pass
+
+    def facts_refresh(self):
+        pass
+
+
+def upgrade(**state):
+    up = ju.RunUpgrade(auth={'username': 'u', 'password': 'p'})
+    up.arch = '64-bit'
+    up.issu = up.yes_all = True
+    up.config = {'CODE_DEST': '/var/tmp/', 'CODE_IMAGE64': 'junos-install-mx-x86-64-17.4R2.tgz',
+                 'CODE_NAME': '17.4R2'}
+    up.plan = [{'image': 'junos-install-mx-x86-64-17.4R2.tgz', 'path': '/var/tmp/', 'version': '17.4R2',
+                'jsu': False}]
+    up.dev = StandInDevice(**state)
+    return up
+
+
+def test_issu_possible():
+    up = upgrade()
+    assert up.issu_check()
+    assert up.dev.calls == [('check', '/var/tmp/junos-install-mx-x86-64-17.4R2.tgz')]
+
+
+@pytest.mark.parametrize('state', [
+    {'facts': {'2RE': False, 'version': '16.1R6'}},
+    {'facts': {'2RE': True, 'version': '16.1R6', 'version_RE0': '16.1R6', 'version_RE1': '15.1R7'}},
+    {'gres': False},
+    {'nsr': 'Disabled'},
+    {'replication': {'BGP': 'Complete', 'ISIS': 'InProgress'}},
+])
+def test_issu_not_possible(state):
+    up = upgrade(**state)
+    assert not up.issu_check()
+    # The device is not asked to validate the package
+    assert up.dev.calls == []
+
+
+@pytest.mark.parametrize('validation', [False, None])
+def test_issu_package_validation(validation):
+    assert not upgrade(validation=validation).issu_check()
+
+
+def test_issu_not_for_multi_step_plans():
+    up = upgrade()
+    up.two_stage = True
+    assert not up.issu_check()
+    up = upgrade()
+    up.plan.append({'image': 'jselective-update.tgz', 'path': '/var/tmp/', 'version': '17.4R2-J1',
+                    'jsu': True})
+    assert not up.issu_check()
+
+
+def test_issu_failure_before_any_change_falls_back():
+    up = upgrade()
+    # Both REs still on the old version, the standard upgrade can take over
+    assert up.upgrade_issu() is False
+    assert up.dev.calls == [('issu', '/var/tmp/junos-install-mx-x86-64-17.4R2.tgz')]
+
+
+def test_issu_half_done_stops():
+    up = upgrade(facts={'2RE': True, 'version': '16.1R6', 'version_RE0': '17.4R2', 'version_RE1': '16.1R6'})
+    with pytest.raises(SystemExit):
+        up.upgrade_issu()
@@ -0,0 +1,154 @@
+"""
+    Tests for the pull mode image server and downloads.  Pull mode runs against StandInDevice,
+    a local stand-in for a Junos device that downloads over HTTP in ranged requests like
+    [file copy http://...]
+"""
+
+import os, hashlib
+from urllib.error import HTTPError
+from urllib.request import Request, urlopen
+from lxml import etree
+import pytest
+
+import junos_upgrade as ju
+
+
+def write(path, data):
+    with open(path, 'wb') as f:
+        f.write(data)
+    return path
+
+
+@pytest.fixture
+def server(tmp_path):
+    server = ju.ImageServer('127.0.0.1', 0, ju.TransferScheduler(interval=3600))
+    yield server
+    server.httpd.shutdown()
+    server.httpd.server_close()
+
+
+def fetch(server, url, headers=None, method='GET'):
+    request = Request('http://127.0.0.1:{0}{1}'.format(server.port, url), headers=headers or {}, method=method)
+    try:
+        with urlopen(request, timeout=10) as rsp:
+            return rsp.status, dict(rsp.headers), rsp.read()
+    except HTTPError as e:
+        return e.code, dict(e.headers), e.read()
+
+
+@pytest.fixture
+def served(server, tmp_path):
+    data = bytes(range(256)) * 4
+    path = write(str(tmp_path / 'image.tgz'), data)
+    transfer = server.scheduler.start('dev:/var/tmp/image.tgz', len(data))
+    return server.register(path, 'image.tgz', transfer), data, transfer
+
+
+def test_server_full(server, served):
+    url, data, transfer = served
+    status, headers, body = fetch(server, url)
+    assert (status, body, headers['Accept-Ranges']) == (200, data, 'bytes')
+    assert transfer['sent'] == len(data)
+
+
+@pytest.mark.parametrize('header, start, end', [
+    ('bytes=0-99', 0, 99), ('bytes=1000-', 1000, 1023),
+    ('bytes=-24', 1000, 1023), ('bytes=1000-5000', 1000, 1023),
+])
+def test_server_range(server, served, header, start, end):
+    url, data, transfer = served
+    status, headers, body = fetch(server, url, {'Range': header})
+    assert (status, body) == (206, data[start:end + 1])
+    assert headers['Content-Range'] == 'bytes {0}-{1}/1024'.format(start, end)
+
+
+@pytest.mark.parametrize('header', ['bytes=1024-', 'bytes=10-5', 'bytes=-', 'items=0-1', 'bytes=0-1,5-6'])
+def test_server_bad_range(server, served, header):
+    url, data, transfer = served
+    status, headers, body = fetch(server, url, {'Range': header})
+    assert (status, body, headers['Content-Range']) == (416, b'', 'bytes */1024')
+
+
+def test_server_head_and_unknown(server, served):
+    url, data, transfer = served
+    status, headers, body = fetch(server, url, method='HEAD')
+    assert (status, headers['Content-Length'], body) == (200, '1024', b'')
+    assert fetch(server, '/image.tgz')[0] == 404
+    server.unregister(url)
+    assert fetch(server, url)[0] == 404
+
+
+class StandInRpc(object):
+    def __init__(self, device):
+        self.device = device
+
+    def file_copy(self, source, destination):
+        """ Download in ranged requests, resuming like the device does """
+        path = self.device.local(destination)
+        with open(path, 'wb') as f:
+            while True:
+                request = Request(source, headers={'Range': 'bytes={0}-{1}'.format(f.tell(), f.tell() + 999)})
+                try:
+                    with urlopen(request, timeout=10) as rsp:
+                        f.write(rsp.read())
+                except HTTPError as e:
+                    if e.code == 416:
+                        break
+                    raise ju.RpcError('fetch failed: {0}'.format(e))
+        if self.device.corrupt:
+            write(path, b'corrupt')
+
+    def get_sha256_checksum_information(self, path):
+        with open(self.device.local(path), 'rb') as f:
+            checksum = hashlib.sha256(f.read()).hexdigest()
+        return etree.fromstring('<checksum-information><file-checksum><computation-method>SHA256'
+                                '</computation-method><input-file>{0}</input-file><checksum>\n{1}\n'
+                                '</checksum></file-checksum></checksum-information>'.format(path, checksum))
+
+    def file_delete(self, path):
+        os.remove(self.device.local(path))
+
+
+class StandInDevice(object):
+    """ Local stand-in for a Junos device, its filesystem lives under root """
+    def __init__(self, root, corrupt=False):
+        self.root = root
+        self.corrupt = corrupt
+        self.timeout = 30
+        self.rpc = StandInRpc(self)
+
+    def local(self, path):
+        return os.path.join(self.root, os.path.basename(path))
+
+
+def pull_upgrade(server, tmp_path, monkeypatch, corrupt=False):
+    monkeypatch.setattr(ju, 'IMAGE_SERVER', [server])
+    monkeypatch.setattr(ju, 'TRANSFER_SCHEDULER', [server.scheduler])
+    up = ju.RunUpgrade(auth={'username': 'u', 'password': 'p'})
+    up.host = 'standin'
+    up.config = {'PULL_MODE': True, 'PULL_SERVER_ADDRESS': '127.0.0.1'}
+    os.makedirs(str(tmp_path / 'device'))
+    up.dev = StandInDevice(str(tmp_path / 'device'), corrupt)
+    data = os.urandom(5000)
+    source = write(str(tmp_path / 'image.tgz'), data)
+    transfer = server.scheduler.start('standin:/var/tmp/image.tgz', len(data))
+    return up, source, transfer, data
+
+
+def test_pull_image(server, tmp_path, monkeypatch):
+    up, source, transfer, data = pull_upgrade(server, tmp_path, monkeypatch)
+    events = []
+    up.progress_callbacks.append(events.append)
+    assert up.pull_image(source, '/var/tmp/image.tgz', transfer)
+    assert open(up.dev.local('/var/tmp/image.tgz'), 'rb').read() == data
+    assert transfer['sent'] == len(data)
+    assert server.downloads == {}
+    assert 'downloaded and verified' in events[-1]['msg']
+
+
+def test_pull_image_bad_checksum(server, tmp_path, monkeypatch):
+    up, source, transfer, data = pull_upgrade(server, tmp_path, monkeypatch, corrupt=True)
+    # Falls back to SCP, the bad copy is deleted
+    assert not up.pull_image(source, '/var/tmp/image.tgz', transfer)
+    assert not os.path.exists(up.dev.local('/var/tmp/image.tgz'))
+    assert transfer['sent'] == 0
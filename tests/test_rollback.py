@@ -0,0 +1,155 @@
+"""
+    Tests for the automated rollback paths, against a stand-in single RE device
+"""
+
+from lxml import etree
+import pytest
+
+import junos_upgrade as ju
+
+
+OLD = 'jinstall-ex-4200-12.3R12.4-domestic-signed.tgz'
+
+
+def reply(xml):
+    """ First element of an rpc-reply, like the RPCs return them """
+    return etree.fromstring('<rpc-reply>{0}</rpc-reply>'.format(xml))[0]
+
+
+class StandInRpc(object):
+    def __init__(self, device):
+        self.device = device
+
+    def request_package_rollback(self, **target):
+        self.device.calls.append('software_rollback')
+        if not self.device.package_rollback:
+            return reply('<output>error: no previous package set</output>')
+        self.device.boots = self.device.package_rollback
+        return reply('<output>Rollback complete</output>')
+
+    def request_reboot(self, **options):
+        self.device.calls.append(('reboot', options))
+        if 'slice' in options and not self.device.slices:
+            raise ju.RpcError()
+        if 'slice' in options:
+            self.device.boots = '12.3R12.4'
+
+    def file_list(self, path):
+        return reply('<directory-list><directory><file-information><file-name>{0}</file-name>'
+                     '</file-information></directory></directory-list>'.format(path))
+
+    def request_package_add(self, **options):
+        self.device.calls.append(('reinstall', options['package_name']))
+        self.device.boots = '12.3R12.4'
+        return reply('<output>Installed</output><package-result>0</package-result>')
+
+
+class StandInDevice(object):
+    """ Single RE device on the new version, the package rollback goes back to package_rollback """
+    def __init__(self, **state):
+        self.hostname = 'ex-1'
+        self.facts = {'2RE': False, 'master': 'RE0', 'version': '15.1R7.9'}
+        self.package_rollback = '12.3R12.4'
+        self.slices = True
+        self.boots = None
+        self.timeout = 30
+        self.calls = []
+        self.__dict__.update(state)
+        self.rpc = StandInRpc(self)
+
+
+def upgrade(tmp_path, methods=None, snapshot=True, installs=1, **state):
+    open(str(tmp_path / OLD), 'w').close()
+    up = ju.RunUpgrade(auth={'username': 'u', 'password': 'p'})
+    up.dev = StandInDevice(**state)
+    up.config = {'CODE_FOLDER': str(tmp_path) + '/', 'CODE_DEST': '/var/tmp/'}
+    if methods is not None:
+        up.config['ROLLBACK_METHODS'] = methods
+    up.pre_upgrade = {'RE0': {'version': '12.3R12.4', 'snapshot': snapshot, 'image': OLD, 'installs': installs}}
+    up.waited = 0
+
+    def wait_for_re(re_name, backup):
+        # The reboot takes the device to whatever was staged
+        up.waited += 1
+        if up.dev.boots:
+            up.dev.facts['version'] = up.dev.boots
+    up.wait_for_re = wait_for_re
+    return up
+
+
+def test_rollback_methods(tmp_path):
+    up = upgrade(tmp_path)
+    assert up.rollback_methods('RE0') == ['software_rollback', 'alternate_media', 'reinstall']
+    # A two-stage install can't go back in one package rollback, no snapshot, no local image
+    up = upgrade(tmp_path, snapshot=False, installs=2)
+    up.pre_upgrade['RE0']['image'] = 'missing.tgz'
+    assert up.rollback_methods('RE0') == []
+
+
+def test_rollback_methods_order(tmp_path):
+    up = upgrade(tmp_path, methods=['reinstall', 'software_rollback'])
+    assert up.rollback_methods('RE0') == ['reinstall', 'software_rollback']
+    up.config['ROLLBACK_ALTERNATE_BOOT'] = {}
+    up.config['ROLLBACK_METHODS'] = ['alternate_media', 'reinstall']
+    assert up.rollback_methods('RE0') == ['reinstall']
+
+
+def test_software_rollback_first(tmp_path):
+    up = upgrade(tmp_path)
+    assert up.rollback_re('RE0', False)
+    assert up.dev.calls == ['software_rollback', ('reboot', {})]
+    assert up.dev.facts['version'] == '12.3R12.4'
+
+
+def test_falls_through_to_the_next_method(tmp_path):
+    # The package rollback lands on the wrong version, the snapshot gets it back
+    up = upgrade(tmp_path, package_rollback='14.1X53-D47.6')
+    assert up.rollback_re('RE0', False)
+    assert up.dev.calls == ['software_rollback', ('reboot', {}),
+                            ('reboot', {'slice': 'alternate', 'media': 'internal'})]
+    assert up.waited == 2
+
+
+def test_rejected_reboot_moves_on(tmp_path):
+    # No slices (e.g. MX), the alternate media reboot is rejected and nothing restarts
+    up = upgrade(tmp_path, methods=['alternate_media', 'reinstall'], slices=False)
+    assert up.rollback_re('RE0', False)
+    assert up.dev.calls == [('reboot', {'slice': 'alternate', 'media': 'internal'}),
+                            ('reinstall', '/var/tmp/' + OLD)]
+    # Only the reinstall waited for a reboot
+    assert up.waited == 1
+
+
+def test_no_method_works(tmp_path):
+    up = upgrade(tmp_path, methods=['software_rollback', 'alternate_media'], package_rollback='', slices=False)
+    assert not up.rollback_re('RE0', False)
+    assert up.waited == 0
+
+
+def test_reboot_result(tmp_path):
+    up = upgrade(tmp_path, slices=False)
+    assert up.reboot() is True
+    assert up.reboot(slice='alternate') is False
+
+    def timeout(**options):
+        raise ju.RpcTimeoutError(up.dev, 'request-reboot', 120)
+    # The session dropping before the reply is a reboot
+    up.dev.rpc.request_reboot = timeout
+    assert up.reboot() is True
+
+
+def test_previous_image_same_platform(tmp_path):
+    images = ['jinstall-ex-4200-12.3R12.4-domestic-signed.tgz', 'jinstall-ex-4300-12.3R12.4-domestic-signed.tgz',
+              'jinstall-ex-4200-12.3R12.4-S1.1-domestic-signed.tgz', 'jinstall64-13.3R6-S1.6-domestic-signed.tgz']
+    for name in images:
+        open(str(tmp_path / name), 'w').close()
+    up = upgrade(tmp_path)
+    up.arch = '32-bit'
+    up.config.update({'CODE_IMAGE32': 'jinstall-ex-4200-15.1R7.9-domestic-signed.tgz',
+                      'CODE_2STAGE32': '', 'ROLLBACK_IMAGE32': '', 'ROLLBACK_IMAGE64': ''})
+    assert up.previous_image('12.3R12.4') == 'jinstall-ex-4200-12.3R12.4-domestic-signed.tgz'
+    assert up.previous_image('13.3R6-S1.6') == ''
+    up.config['CODE_IMAGE32'] = 'jinstall-ex-4300-15.1R7.9-domestic-signed.tgz'
+    assert up.previous_image('12.3R12.4') == 'jinstall-ex-4300-12.3R12.4-domestic-signed.tgz'
+    up.config['ROLLBACK_IMAGE32'] = 'old.tgz'
+    assert up.previous_image('12.3R12.4') == 'old.tgz'
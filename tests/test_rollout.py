@@ -0,0 +1,136 @@
+"""
+    Tests for the wave / canary rollout controller, with stand-in device upgrades
+"""
+
+import logging
+import pytest
+import yaml
+
+import junos_upgrade as ju
+
+
+def controller(tmp_path, hosts, **config):
+    template = ju.RunUpgrade(auth={'username': 'u', 'password': 'p'})
+    template.configfile = str(tmp_path / 'config.yml')
+    template.device_list = str(tmp_path / 'devices.txt')
+    template.yes_all = True
+    with open(template.configfile, 'w') as f:
+        yaml.safe_dump(config, f)
+    with open(template.device_list, 'w') as f:
+        f.write(''.join('{0} region-{1}\n'.format(h, i % 2) for i, h in enumerate(hosts)))
+    return ju.RolloutController(template)
+
+
+@pytest.fixture
+def rollout(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    handlers = list(logging.getLogger().handlers)
+    yield lambda hosts, **config: controller(tmp_path, hosts, **config)
+    for handler in logging.getLogger().handlers[len(handlers):]:
+        logging.getLogger().removeHandler(handler)
+
+
+def hosts(n):
+    return ['10.0.0.{0}'.format(i) for i in range(n)]
+
+
+@pytest.mark.parametrize('waves, sizes', [
+    (None, [20]),
+    ([1, '10%', '50%', 'rest'], [1, 1, 8, 10]),
+    ([2, 5], [2, 3, 15]),
+    (['rest', 5], [20]),
+    ([0, 0, 'rest'], [1, 1, 18]),
+    ([50], [20]),
+])
+def test_plan_waves(rollout, waves, sizes):
+    rc = rollout(hosts(20), ROLLOUT_WAVES=waves)
+    rc.setup()
+    planned = rc.plan_waves()
+    assert [len(w) for w in planned] == sizes
+    assert sum(planned, []) == hosts(20)
+
+
+def test_setup_reads_regions(rollout):
+    rc = rollout(hosts(3))
+    rc.setup()
+    assert rc.hosts == hosts(3)
+    assert rc.regions == {'10.0.0.0': 'region-0', '10.0.0.1': 'region-1', '10.0.0.2': 'region-0'}
+
+
+@pytest.mark.parametrize('limit, attempted, allowed', [
+    (0, 10, 0), (2, 10, 2), ('10%', 50, 5), ('10%', 9, 0), ('25%', 8, 2),
+])
+def test_max_failures(limit, attempted, allowed):
+    assert ju.max_failures({'ROLLOUT_MAX_FAILURES': limit}, attempted) == allowed
+
+
+def run(rc, failing):
+    """ Run the rollout with stand-in upgrades, returns the devices attempted in order """
+    attempted = []
+
+    def upgrade(host):
+        attempted.append(host)
+        return host not in failing
+    rc.upgrade_device = upgrade
+    rc.run()
+    return attempted
+
+
+def test_rollout_promotes_every_wave(rollout):
+    rc = rollout(hosts(6), ROLLOUT_WAVES=[1, 3, 'rest'], ROLLOUT_PARALLEL=2)
+    assert sorted(run(rc, [])) == hosts(6)
+    assert all(rc.results.values())
+
+
+def test_canary_failure_halts(rollout):
+    rc = rollout(hosts(6), ROLLOUT_WAVES=[1, 'rest'], ROLLOUT_MAX_FAILURES=0)
+    with pytest.raises(SystemExit):
+        run(rc, ['10.0.0.0'])
+    assert rc.results == dict([('10.0.0.0', False)] + [(h, None) for h in hosts(6)[1:]])
+
+
+def test_halt_stops_starting_devices(rollout):
+    rc = rollout(hosts(10), ROLLOUT_WAVES=[2, 'rest'], ROLLOUT_MAX_FAILURES=1, ROLLOUT_PARALLEL=1)
+    with pytest.raises(SystemExit):
+        run(rc, ['10.0.0.2', '10.0.0.3', '10.0.0.4'])
+    assert [h for h in hosts(10) if rc.results[h] is not None] == hosts(4)
+    assert rc.failures == 2
+
+
+def test_failures_within_limit_continue(rollout):
+    rc = rollout(hosts(10), ROLLOUT_WAVES=[2, 'rest'], ROLLOUT_MAX_FAILURES='20%', ROLLOUT_PARALLEL=3)
+    run(rc, ['10.0.0.5'])
+    assert list(rc.results.values()).count(False) == 1
+    assert None not in rc.results.values()
+
+
+def test_waves_share_transfer_priority(rollout, monkeypatch):
+    options = {}
+
+    def upgrade(host, opts, auth=None, config=None, progress=None):
+        options[host] = opts
+        up = ju.RunUpgrade(auth)
+        up.completed = True
+        up.no_install = True
+        return up
+    monkeypatch.setattr(ju, 'upgrade_device', upgrade)
+    rc = rollout(hosts(4), ROLLOUT_WAVES=[1, 'rest'])
+    rc.run()
+    assert all(rc.results.values())
+    # Waves run one after the other, a wave never competes with the next one for bandwidth
+    assert set(o['priority'] for o in options.values()) == set([0])
+    assert options['10.0.0.1']['site'] == 'region-1'
+
+
+def test_skipped_jsu_is_a_failure():
+    up = ju.RunUpgrade(auth={'username': 'u', 'password': 'p'})
+    up.yes_all = True
+    up.completed = up.version_match = True
+    up.config = {'CODE_NAME': '15.1R7.9'}
+
+    class Device(object):
+        facts = {'version': '15.1R7.9'}
+    up.dev = Device()
+    assert up.succeeded()
+    assert up.manual_jsu('/var/tmp/jselective-update.tgz') is False
+    assert not up.succeeded()
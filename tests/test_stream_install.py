@@ -0,0 +1,103 @@
+"""
+    Tests for the streamed package add, against a stand-in SSH session
+"""
+
+import time
+import pytest
+
+import junos_upgrade as ju
+
+PROMPT = 'user@ex4200>'
+
+
+class StandInSession(object):
+    """ Plays back (seconds after connect, output) chunks, forever if repeat is set """
+    def __init__(self, chunks, repeat=None):
+        self.chunks = list(chunks)
+        self.repeat = repeat
+        self.written = []
+        self.started = time.time()
+        self.disconnected = False
+
+    def find_prompt(self):
+        return PROMPT
+
+    def write_channel(self, data):
+        self.written.append(data)
+
+    def read_channel(self):
+        if self.chunks and time.time() - self.started >= self.chunks[0][0]:
+            return self.chunks.pop(0)[1]
+        return self.repeat or ''
+
+    def disconnect(self):
+        self.disconnected = True
+
+
+@pytest.fixture
+def install(monkeypatch):
+    def run(session, **config):
+        monkeypatch.setattr(ju, 'ConnectHandler', lambda **params: session)
+        up = ju.RunUpgrade(auth={'username': 'u', 'password': 'p'})
+        up.host = 'ex4200'
+        up.config = config
+        events = []
+        up.progress_callbacks.append(events.append)
+        ok = up.stream_package_add('/var/tmp/jinstall-ex-4200-15.1R7.9-domestic-signed.tgz')
+        return ok, [(e['phase'], e['msg']) for e in events]
+    return run
+
+
+CMD = 'request system software add /var/tmp/jinstall-ex-4200-15.1R7.9-domestic-signed.tgz no-validate'
+
+
+def test_install_completes(install):
+    session = StandInSession([
+        (0, CMD + '\r\n'),
+        (0, 'Checking pending install on fpc0\r\nVerify the signature of the new package\r\n'),
+        (0, 'Extracting jinstall-ex-4200-15.1R7.9 ...\r\nInstalling package '),
+        (0, "'/var/tmp/jinstall-ex-4200-15.1R7.9-domestic-signed.tgz' ...\r\n"),
+        (0, 'WARNING: A reboot is required to install the software\r\n\r\n' + PROMPT + ' '),
+    ])
+    ok, events = install(session)
+    assert ok
+    assert session.written == [CMD + '\n'] and session.disconnected
+    assert [phase for phase, msg in events] == ['starting', 'validating', 'validating', 'extracting',
+                                                'installing', 'complete', 'installed']
+
+
+def test_install_failure(install):
+    session = StandInSession([
+        (0, 'Verify the signature of the new package\n'),
+        (0, 'ERROR: package signature check failed\n' + PROMPT),
+    ])
+    ok, events = install(session)
+    assert not ok
+    assert ('failed', 'ERROR: package signature check failed') in events
+
+
+def test_install_stalled(install):
+    session = StandInSession([(0, 'Extracting jinstall-ex-4200-15.1R7.9 ...\n')])
+    start = time.time()
+    ok, events = install(session, INSTALL_STALL_TIMEOUT=1, INSTALL_TIMEOUT=60)
+    assert not ok
+    assert time.time() - start < 5
+    assert events[-1][0] == 'stalled' and session.written[-1] == '\x03'
+
+
+def test_install_timeout_while_output_arrives(install):
+    session = StandInSession([], repeat='Saving state for rollback ...\n')
+    start = time.time()
+    ok, events = install(session, INSTALL_STALL_TIMEOUT=60, INSTALL_TIMEOUT=0.5)
+    assert not ok
+    assert time.time() - start < 5
+    assert events[-1][0] == 'stalled' and session.written[-1] == '\x03'
+
+
+def test_connect_failure(install):
+    class Refused(StandInSession):
+        def find_prompt(self):
+            raise IOError('Connection refused')
+    ok, events = install(Refused([]))
+    assert not ok
+    assert events == [('failed', 'Connection refused')]
@@ -0,0 +1,83 @@
+"""
+    Tests for the token buckets and the transfer scheduler
+"""
+
+import threading, time
+
+import junos_upgrade as ju
+
+
+def test_token_bucket():
+    bucket = ju.TokenBucket(1024 * 1024)
+    assert bucket.burst == 512 * 1024
+    assert bucket.ready(512 * 1024)
+    bucket.tokens -= 512 * 1024
+    assert not bucket.ready(64 * 1024)
+    time.sleep(0.1)
+    bucket.refill()
+    assert bucket.ready(64 * 1024)
+    # Bigger than the burst goes through on a full bucket
+    bucket.tokens = bucket.burst
+    assert bucket.ready(10 * 1024 * 1024)
+
+
+def run_transfers(scheduler, transfers, seconds):
+    """ Send 64 KB chunks on each (name, site, priority) for seconds, returns the bytes sent.
+        The buckets start empty so the first transfer to run can't take the whole burst
+    """
+    started = [scheduler.start(name, 10 ** 9, site, priority) for name, site, priority in transfers]
+    for bucket in [scheduler.bucket] + list(scheduler.sites.values()):
+        if bucket:
+            bucket.tokens = 0
+
+    def send(t):
+        end = time.time() + seconds
+        while time.time() < end:
+            scheduler.consume(t, 64 * 1024)
+        scheduler.finish(t)
+    threads = [threading.Thread(target=send, args=(t,)) for t in started]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return dict((t['name'], t['sent']) for t in started)
+
+
+def test_scheduler_equal_priority_shares():
+    sent = run_transfers(ju.TransferScheduler(2 * 1024 * 1024, interval=3600),
+                         [('a', '', 0), ('b', '', 0), ('c', '', 0)], 1.5)
+    assert max(sent.values()) - min(sent.values()) <= 256 * 1024
+    # 1.5s at the budget
+    assert sum(sent.values()) <= 3.5 * 1024 * 1024
+
+
+def test_scheduler_priority_goes_first():
+    sent = run_transfers(ju.TransferScheduler(1024 * 1024, interval=3600),
+                         [('now', '', 0), ('later', '', 1)], 1)
+    assert sent['later'] < sent['now'] / 4
+
+
+def test_scheduler_site_budget():
+    scheduler = ju.TransferScheduler(0, {'slow': 512 * 1024}, interval=3600)
+    sent = run_transfers(scheduler, [('a', 'slow', 0), ('b', '', 0)], 1)
+    assert sent['a'] <= 512 * 1024 + 64 * 1024
+    assert sent['b'] > 4 * sent['a']
+
+
+def test_scheduler_allowed():
+    scheduler = ju.TransferScheduler(3000000, {'dc1': 1000000}, interval=3600)
+    a = scheduler.start('a', 100, 'dc1', 0)
+    b = scheduler.start('b', 100, '', 0)
+    c = scheduler.start('c', 100, '', 1)
+    # c only gets what a and b leave unused
+    a['rate'], b['rate'] = 1000000.0, 1500000.0
+    assert scheduler.allowed(a) == 1000000
+    assert scheduler.allowed(b) == 1500000
+    assert scheduler.allowed(c) == 500000
+    status = scheduler.status()
+    assert [t['allowed_mbps'] for t in status['transfers']] == [8.0, 12.0, 4.0]
+    for t in [a, b, c]:
+        scheduler.finish(t)
+    assert ju.TransferScheduler().allowed(scheduler.start('d', 100)) is None
+
+
@@ -0,0 +1,155 @@
+"""
+    Tests for the version parser, the upgrade path planner and the platform filtering of
+    the image catalog
+"""
+
+import pytest
+
+import junos_upgrade as ju
+
+V = ju.JunosVersion
+
+
+# JunosVersion
+
+@pytest.mark.parametrize('version, key', [
+    ('9.3R4.4', (9, 3, 3, 4, 0, 0, 4)),
+    ('12.3R12-S15', (12, 3, 3, 12, 0, 15, 0)),
+    ('14.1X53-D47.6', (14, 1, 2, 53, 47, 0, 6)),
+    ('16.1R6-S1.1', (16, 1, 3, 6, 0, 1, 1)),
+    ('15.1F6-S5', (15, 1, 4, 6, 0, 5, 0)),
+    ('17.4R2', (17, 4, 3, 2, 0, 0, 0)),
+])
+def test_version_formats(version, key):
+    assert V(version).key() == key
+    assert str(V(version)) == version
+
+
+@pytest.mark.parametrize('version', ['', '16.1', '16.1R', 'junos-16.1R6', '16.1Z6'])
+def test_version_invalid(version):
+    with pytest.raises(ValueError):
+        V(version)
+
+
+def test_version_ordering():
+    assert V('14.1X53-D47.6') < V('14.1R9') < V('15.1R7.9')
+    assert V('14.1X53-D46') < V('14.1X53-D47.6')
+    assert V('16.1R6') < V('16.1R6-S1') < V('16.1R6-S1.1') < V('16.1R7')
+    assert V('9.3R4.4') < V('12.3R12-S15')
+    assert V('16.1R6-S1.1') == V('16.1R6-S1.1')
+    assert V('16.1R6-S1').same_release(V('16.1R6-S1.1'))
+    assert not V('16.1R6').same_release(V('16.1R6-S1'))
+
+
+@pytest.mark.parametrize('name, version', [
+    ('jinstall64-13.3R6-S1.6-domestic-signed.tgz', '13.3R6-S1.6'),
+    ('junos-install-mx-x86-64-16.1R6-S1.1.tgz', '16.1R6-S1.1'),
+    ('jinstall-ex-4200-14.1X53-D47.6-domestic-signed.tgz', '14.1X53-D47.6'),
+    ('jinstall-ex-4200-15.1R7.9-domestic-signed.tgz', '15.1R7.9'),
+    ('jselective-update-J2-x86-64-16.1R6-S1-J2.tgz', '16.1R6-S1'),
+    ('README.txt', None),
+])
+def test_version_from_image(name, version):
+    found = V.from_image(name)
+    assert (str(found) if found else None) == version
+
+
+# plan_upgrade_path
+
+CATALOG = [V(v) for v in ['10.4R16', '12.3R12.4', '13.3R6-S1.6', '14.1R8', '15.1R7', '16.1R6-S1.1']]
+
+
+def test_plan_fewest_hops():
+    assert ju.plan_upgrade_path(V('9.3R4.4'), V('16.1R6-S1.1'), CATALOG) == \
+        [V('12.3R12.4'), V('15.1R7'), V('16.1R6-S1.1')]
+
+
+def test_plan_prefers_configured_on_tie():
+    assert ju.plan_upgrade_path(V('12.3R12.4'), V('16.1R6-S1.1'), CATALOG, preferred=[V('13.3R6-S1.6')]) == \
+        [V('13.3R6-S1.6'), V('16.1R6-S1.1')]
+    # Newest first otherwise
+    assert ju.plan_upgrade_path(V('12.3R12.4'), V('16.1R6-S1.1'), CATALOG) == [V('15.1R7'), V('16.1R6-S1.1')]
+
+
+def test_plan_direct_and_nothing():
+    assert ju.plan_upgrade_path(V('14.1X53-D47.6'), V('16.1R6-S1.1'), CATALOG) == [V('16.1R6-S1.1')]
+    assert ju.plan_upgrade_path(V('16.1R6-S1.1'), V('16.1R6-S1.1'), CATALOG) == []
+
+
+def test_plan_x_train_to_r_is_an_upgrade():
+    assert ju.plan_upgrade_path(V('14.1X53-D47.6'), V('14.1R9'), [V('14.1R9')]) == [V('14.1R9')]
+    assert ju.plan_upgrade_path(V('14.1X53-D47.6'), V('17.4R2'), CATALOG + [V('17.4R2')], max_hop=2) == \
+        [V('16.1R6-S1.1'), V('17.4R2')]
+
+
+def test_plan_downgrade_and_no_path():
+    assert ju.plan_upgrade_path(V('16.1R6-S1.1'), V('15.1R7'), CATALOG) == [V('15.1R7')]
+    assert ju.plan_upgrade_path(V('5.0R1'), V('16.1R6-S1.1'), CATALOG) is None
+
+
+# Platform filtering
+
+EX4200 = 'jinstall-ex-4200-15.1R7.9-domestic-signed.tgz'
+IMAGES = ['jinstall-ex-4200-12.3R12.4-domestic-signed.tgz',
+          'jinstall-ex-4200-13.2X50-D19.2-domestic-signed.tgz',
+          'jinstall-ex-4300-12.3R12.4-domestic-signed.tgz',
+          'junos-install-mx-x86-32-13.3R6-S1.6.tgz',
+          'jinstall64-13.3R6-S1.6-domestic-signed.tgz',
+          EX4200]
+
+
+class Facts(object):
+    def __init__(self, version):
+        self.facts = {'version': version, '2RE': False}
+
+    def close(self):
+        pass
+
+
+def ex_upgrade(tmp_path, version, **config):
+    folder = str(tmp_path) + '/'
+    for name in IMAGES:
+        open(folder + name, 'w').close()
+    up = ju.RunUpgrade(auth={'username': 'u', 'password': 'p'})
+    up.arch = '32-bit'
+    up.dev = Facts(version)
+    up.config = {'CODE_FOLDER': folder, 'CODE_DEST': '/var/tmp/', 'CODE_PRESERVE': '/var/preserve/',
+                 'CODE_NAME': '15.1R7.9', 'CODE_IMAGE32': EX4200, 'CODE_IMAGE64': EX4200,
+                 'CODE_2STAGE_NAME': '', 'CODE_2STAGE32': '', 'CODE_2STAGE64': '',
+                 'CODE_JSU_NAME': '', 'CODE_JSU32': '', 'CODE_JSU64': '',
+                 'ROLLBACK_IMAGE32': '', 'ROLLBACK_IMAGE64': '', 'UPGRADE_CATALOG': True}
+    up.config.update(config)
+    return up
+
+
+def test_catalog_same_platform_only(tmp_path):
+    catalog = ex_upgrade(tmp_path, '12.3R12.4').upgrade_catalog()
+    assert sorted(catalog.values()) == ['jinstall-ex-4200-12.3R12.4-domestic-signed.tgz',
+                                        'jinstall-ex-4200-13.2X50-D19.2-domestic-signed.tgz', EX4200]
+
+
+def test_catalog_allow_list(tmp_path):
+    up = ex_upgrade(tmp_path, '12.3R12.4', UPGRADE_PLATFORMS=['junos-install-mx-x86-32-'])
+    assert 'junos-install-mx-x86-32-13.3R6-S1.6.tgz' in up.upgrade_catalog().values()
+
+
+def test_catalog_off_by_default(tmp_path):
+    up = ex_upgrade(tmp_path, '12.3R12.4')
+    del up.config['UPGRADE_CATALOG']
+    assert list(up.upgrade_catalog().values()) == [EX4200]
+
+
+def test_plan_stays_on_platform(tmp_path):
+    up = ex_upgrade(tmp_path, '10.4R3', UPGRADE_MAX_HOP=3)
+    plan = up.plan_upgrade()
+    assert [s['image'] for s in plan] == ['jinstall-ex-4200-13.2X50-D19.2-domestic-signed.tgz', EX4200]
+    assert [s['path'] for s in plan] == ['/var/preserve/', '/var/tmp/']
+
+
+def test_plan_needs_code_preserve(tmp_path):
+    up = ex_upgrade(tmp_path, '10.4R3', CODE_PRESERVE='')
+    with pytest.raises(SystemExit):
+        up.plan_upgrade()
+    # A single install does not
+    up.dev = Facts('14.1X53-D47.6')
+    assert [s['image'] for s in up.plan_upgrade()] == [EX4200]
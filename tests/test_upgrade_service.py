@@ -0,0 +1,207 @@
+"""
+    Tests for the upgrade service and its REST API, device upgrades are played by
+    StandInUpgrade so no device is needed
+"""
+
+import os, json, logging, threading, time
+from http.server import ThreadingHTTPServer
+from urllib.error import HTTPError
+from urllib.request import Request, urlopen
+import pytest
+
+import junos_upgrade as ju
+
+
+class StandInUpgrade(object):
+    """ Stand-in for upgrade_device: logs, reports progress and finishes once released.
+        Devices named fail-* fail, crash-* raise
+    """
+    def __init__(self):
+        self.started = []
+        self.release = {}
+
+    def __call__(self, host, options, auth=None, config=None, progress=None):
+        threading.current_thread().name = host
+        self.started.append(host)
+        self.release.setdefault(host, threading.Event())
+        logging.warn('Connecting to {0}...'.format(host))
+        progress({'host': host, 'phase': 'starting', 'msg': 'request system software add', 'time': time.time()})
+        self.release[host].wait(10)
+        if host.startswith('crash-'):
+            raise RuntimeError('NETCONF session closed')
+        logging.warn('Disconnecting from {0}...'.format(host))
+        up = ju.RunUpgrade(auth)
+        up.completed = not host.startswith('fail-')
+        up.no_install = True
+        return up
+
+    def finish(self, host):
+        self.release.setdefault(host, threading.Event()).set()
+
+
+@pytest.fixture
+def service(tmp_path, monkeypatch):
+    configfile = str(tmp_path / 'config.yml')
+    with open(configfile, 'w') as f:
+        f.write("CODE_NAME: '15.1R7.9'\nDAEMON_WORKERS: 1\n")
+    upgrade = StandInUpgrade()
+    monkeypatch.setattr(ju, 'upgrade_device', upgrade)
+    template = ju.RunUpgrade(auth={'username': 'u', 'password': 'p'})
+    template.configfile = configfile
+    service = ju.UpgradeService(template)
+    service.config = service.load_config(configfile)
+    service.auth = template.auth
+    service.upgrade = upgrade
+    server = ThreadingHTTPServer(('127.0.0.1', 0), ju.UpgradeRequestHandler)
+    server.daemon_threads = True
+    server.service = service
+    threading.Thread(target=server.serve_forever, args=(0.05,), daemon=True).start()
+    service.url = 'http://127.0.0.1:{0}'.format(server.server_address[1])
+    service.start_worker = lambda: threading.Thread(target=service.worker, name='worker-0', daemon=True).start()
+    yield service
+    for host in list(upgrade.release):
+        upgrade.finish(host)
+    server.shutdown()
+    server.server_close()
+
+
+def call(service, method, path, body=None):
+    data = json.dumps(body).encode() if body is not None else None
+    request = Request(service.url + path, data=data, method=method)
+    try:
+        with urlopen(request, timeout=10) as rsp:
+            raw = rsp.read()
+            status = rsp.status
+    except HTTPError as e:
+        raw, status = e.read(), e.code
+    try:
+        return status, json.loads(raw)
+    except ValueError:
+        return status, raw.decode()
+
+
+def wait_for(condition, timeout=10):
+    end = time.time() + timeout
+    while not condition():
+        assert time.time() < end, 'timed out'
+        time.sleep(0.02)
+
+
+def test_submit_and_run(service):
+    status, job = call(service, 'POST', '/jobs', {'device': 'ex4200-1', 'priority': 5, 'force': True,
+                                                   'port': '8830'})
+    assert status == 201
+    assert (job['id'], job['state'], job['priority']) == ('1', 'queued', 5)
+    assert job['options']['force'] is True and job['options']['port'] == 8830
+    service.start_worker()
+    service.upgrade.finish('ex4200-1')
+    wait_for(lambda: service.jobs['1']['state'] == 'succeeded')
+    status, job = call(service, 'GET', '/jobs/1')
+    assert job['succeeded'] and job['events'][0]['phase'] == 'starting'
+    assert job['log_lines'] == 2
+    assert call(service, 'GET', '/jobs')[1][0]['id'] == '1'
+
+
+@pytest.mark.parametrize('body, error', [
+    ({}, '"device" is required'),
+    ({'device': 'ex4200-1', 'priority': 'high'}, '"priority" must be a number'),
+    ({'device': 'ex4200-1', 'no_install': 'false'}, '"no_install" must be true or false'),
+    ({'device': 'ex4200-1', 'issu': 1}, '"issu" must be true or false'),
+    ({'device': 'ex4200-1', 'port': 'ssh'}, '"port" must be a number'),
+    ({'device': 'ex4200-1', 'port': True}, '"port" must be a number'),
+    ({'device': 'ex4200-1', 'site': 5}, '"site" must be a string'),
+    ({'device': 'ex4200-1', 'config': '/missing.yml'}, 'Issues opening config file'),
+])
+def test_submit_rejected(service, body, error):
+    status, rsp = call(service, 'POST', '/jobs', body)
+    assert status == 400 and rsp['error'].startswith(error)
+    assert service.jobs == {}
+
+
+def test_one_job_per_device(service):
+    assert call(service, 'POST', '/jobs', {'device': 'ex4200-1'})[0] == 201
+    status, rsp = call(service, 'POST', '/jobs', {'device': 'ex4200-1'})
+    assert status == 400 and 'already has job 1' in rsp['error']
+
+
+def test_priority_order(service):
+    service.start_worker()
+    call(service, 'POST', '/jobs', {'device': 'busy'})
+    wait_for(lambda: service.upgrade.started == ['busy'])
+    for device, priority in [('low', 20), ('high', 1), ('normal', 10), ('normal-2', 10)]:
+        call(service, 'POST', '/jobs', {'device': device, 'priority': priority})
+    for device in ['busy', 'low', 'high', 'normal', 'normal-2']:
+        service.upgrade.finish(device)
+    wait_for(lambda: len(service.upgrade.started) == 5)
+    assert service.upgrade.started == ['busy', 'high', 'normal', 'normal-2', 'low']
+
+
+def test_cancel(service):
+    service.start_worker()
+    call(service, 'POST', '/jobs', {'device': 'busy'})
+    call(service, 'POST', '/jobs', {'device': 'queued'})
+    wait_for(lambda: service.jobs['1']['state'] == 'running')
+    status, job = call(service, 'DELETE', '/jobs/2')
+    assert (status, job['state']) == (200, 'cancelled')
+    assert call(service, 'DELETE', '/jobs/1')[0] == 409
+    assert call(service, 'DELETE', '/jobs/2')[0] == 409
+    assert call(service, 'DELETE', '/jobs/9')[0] == 404
+    service.upgrade.finish('busy')
+    service.upgrade.finish('queued')
+    wait_for(lambda: service.jobs['1']['state'] == 'succeeded')
+    time.sleep(0.1)
+    assert service.upgrade.started == ['busy']
+
+
+def test_log_follow(service):
+    service.start_worker()
+    call(service, 'POST', '/jobs', {'device': 'ex4200-1'})
+    wait_for(lambda: service.jobs['1']['log'])
+    threading.Timer(0.5, service.upgrade.finish, ['ex4200-1']).start()
+    # Streams until the job is done
+    status, log = call(service, 'GET', '/jobs/1/log?follow=1')
+    assert status == 200
+    assert [line.split(': ', 1)[1] for line in log.splitlines()] == \
+        ['Connecting to ex4200-1...', 'Disconnecting from ex4200-1...']
+    status, log = call(service, 'GET', '/jobs/1/log?offset=1')
+    assert log.splitlines()[0].endswith('Disconnecting from ex4200-1...')
+
+
+@pytest.mark.parametrize('query', ['offset=abc', 'offset=-1'])
+def test_log_bad_offset(service, query):
+    call(service, 'POST', '/jobs', {'device': 'ex4200-1'})
+    status, rsp = call(service, 'GET', '/jobs/1/log?' + query)
+    assert status == 400 and 'offset' in rsp['error']
+
+
+def test_not_found(service):
+    assert call(service, 'GET', '/jobs/1')[0] == 404
+    assert call(service, 'GET', '/jobs/1/log')[0] == 404
+    assert call(service, 'GET', '/devices')[0] == 404
+    assert call(service, 'POST', '/jobs/1', {})[0] == 404
+
+
+def test_worker_survives_failed_jobs(service, tmp_path):
+    service.start_worker()
+    badconfig = str(tmp_path / 'bad.yml')
+    with open(badconfig, 'w') as f:
+        f.write('CODE_NAME: 1\n')
+    call(service, 'POST', '/jobs', {'device': 'crash-1'})
+    call(service, 'POST', '/jobs', {'device': 'fail-1'})
+    call(service, 'POST', '/jobs', {'device': 'badconfig', 'config': badconfig})
+    call(service, 'POST', '/jobs', {'device': 'ex4200-1'})
+    # The config disappears after the job was queued
+    os.remove(badconfig)
+    for device in ['crash-1', 'fail-1', 'ex4200-1']:
+        service.upgrade.finish(device)
+    wait_for(lambda: service.jobs['4']['state'] == 'succeeded')
+    assert [service.jobs[i]['state'] for i in '123'] == ['failed'] * 3
+    assert service.jobs['1']['error'] == 'NETCONF session closed'
+    assert service.jobs['2']['error'] is None
+    assert 'Issues opening config file' in service.jobs['3']['error']
+    assert service.upgrade.started == ['crash-1', 'fail-1', 'ex4200-1']
+
+
+def test_transfers(service):
+    status, rsp = call(service, 'GET', '/transfers')
+    assert status == 200 and 'transfers' in rsp
@@ -0,0 +1,148 @@
+"""
+    Tests for virtual chassis discovery, the NSSU pre-checks and the fallback to a
+    parallel install, against a stand-in EX stack
+"""
+
+from lxml import etree
+import pytest
+
+import junos_upgrade as ju
+
+
+def reply(xml):
+    """ First element of an rpc-reply, like the RPCs return them """
+    return etree.fromstring('<rpc-reply>{0}</rpc-reply>'.format(xml))[0]
+
+
+class StandInRpc(object):
+    def __init__(self, device):
+        self.device = device
+
+    def get_virtual_chassis_information(self):
+        return reply('<virtual-chassis-information>' + ''.join(
+                     '<member-list><member><member-status>{0}</member-status><member-id>{1}</member-id>'
+                     '<model>ex4200-48t</model><member-role>{2}</member-role></member></member-list>'.format(*m)
+                     for m in self.device.members) + '</virtual-chassis-information>')
+
+    def get_config(self, filter_xml):
+        if not self.device.gres:
+            return etree.fromstring('<configuration/>')
+        return etree.fromstring('<configuration><chassis><redundancy><graceful-switchover/>'
+                                '</redundancy></chassis></configuration>')
+
+    def get_nonstop_routing_information(self):
+        return reply('<nonstop-routing-information><nonstop-routing-enabled>{0}</nonstop-routing-enabled>'
+                     '</nonstop-routing-information>'.format(self.device.nsr))
+
+    def get_software_information(self, all_members=False):
+        items = []
+        for member, version in sorted(self.device.versions.items()):
+            if version.startswith('['):
+                # Older releases only list the packages
+                info = ('<package-information><comment>JUNOS Base OS boot {0}</comment>'
+                        '</package-information>'.format(version))
+            else:
+                info = '<junos-version>{0}</junos-version>'.format(version)
+            items.append('<multi-routing-engine-item><re-name>fpc{0}</re-name><software-information>{1}'
+                         '</software-information></multi-routing-engine-item>'.format(member, info))
+        return reply('<multi-routing-engine-results>{0}</multi-routing-engine-results>'.format(''.join(items)))
+
+    def request_package_nonstop_upgrade(self, package_name, reboot, force):
+        self.device.calls.append(('nssu', package_name))
+        raise ju.RpcError()
+
+
+class StandInDevice(object):
+    """ Three member EX stack ready for NSSU unless told otherwise """
+    def __init__(self, **state):
+        self.facts = {'vc_capable': True, '2RE': False, 'version': '12.3R12.4'}
+        self.members = [('Prsnt', '0', 'Master*'), ('Prsnt', '1', 'Backup'), ('Prsnt', '2', 'Linecard'),
+                        ('NotPrsnt', '3', '')]
+        self.versions = {'0': '12.3R12.4', '1': '12.3R12.4', '2': '12.3R12.4'}
+        self.gres = True
+        self.nsr = 'Enabled'
+        self.timeout = 30
+        self.calls = []
+        self.__dict__.update(state)
+        self.rpc = StandInRpc(self)
+
+    def probe(self):
+        return True
+
+    def open(self):
+        pass
+
+    def close(self):
+        pass
+
+    def facts_refresh(self):
+        pass
+
+
+def upgrade(**state):
+    up = ju.RunUpgrade(auth={'username': 'u', 'password': 'p'})
+    up.arch = '32-bit'
+    up.yes_all = True
+    up.config = {'CODE_DEST': '/var/tmp/', 'CODE_IMAGE32': 'jinstall-ex-4200-15.1R7.9-domestic-signed.tgz',
+                 'CODE_NAME': '15.1R7.9'}
+    up.plan = [{'image': up.config['CODE_IMAGE32'], 'path': '/var/tmp/', 'version': '15.1R7.9', 'jsu': False}]
+    up.dev = StandInDevice(**state)
+    up.members = up.vc_members()
+    return up
+
+
+def test_vc_members():
+    up = upgrade()
+    assert up.members == [{'id': '0', 'model': 'ex4200-48t', 'role': 'Master'},
+                          {'id': '1', 'model': 'ex4200-48t', 'role': 'Backup'},
+                          {'id': '2', 'model': 'ex4200-48t', 'role': 'Linecard'}]
+    assert up.vc_master() == '0'
+
+
+@pytest.mark.parametrize('state', [
+    {'facts': {'vc_capable': False}},
+    {'members': [('Prsnt', '0', 'Master*'), ('NotPrsnt', '1', '')]},
+])
+def test_not_a_virtual_chassis(state):
+    assert upgrade(**state).members == []
+
+
+def test_member_versions():
+    up = upgrade(versions={'0': '15.1R7.9', '1': '[12.3R12.4]'})
+    assert up.member_versions() == {'0': '15.1R7.9', '1': '12.3R12.4'}
+
+
+def test_nssu_possible():
+    assert upgrade().nssu_check()
+
+
+@pytest.mark.parametrize('state', [
+    {'members': [('Prsnt', '0', 'Master*'), ('Prsnt', '1', 'Linecard')]},
+    {'gres': False},
+    {'nsr': 'Disabled'},
+])
+def test_nssu_not_possible(state):
+    assert not upgrade(**state).nssu_check()
+
+
+def test_nssu_not_for_multi_step_plans():
+    up = upgrade()
+    up.two_stage = True
+    assert not up.nssu_check()
+    up = upgrade()
+    up.plan.append({'image': 'jselective-update.tgz', 'path': '/var/tmp/', 'version': '15.1R7-J1', 'jsu': True})
+    assert not up.nssu_check()
+
+
+def test_nssu_failure_before_any_change_falls_back():
+    up = upgrade()
+    assert up.upgrade_nssu() is False
+    assert up.dev.calls == [('nssu', '/var/tmp/jinstall-ex-4200-15.1R7.9-domestic-signed.tgz')]
+
+
+def test_nssu_half_done_stops():
+    up = upgrade()
+    up.dev.rpc.request_package_nonstop_upgrade = \
+        lambda **kw: up.dev.versions.update({'1': '15.1R7.9'}) or reply('<output>rebooting</output>')
+    with pytest.raises(SystemExit):
+        up.upgrade_nssu()